@@ -4,4 +4,9 @@ __version__ = '0.1.1'
 from GNSSTools.devices import Spectracom
 from GNSSTools.devices import Ublox
 from GNSSTools.devices import Device
-from GNSSTools import tools
\ No newline at end of file
+from GNSSTools.devices import Capture
+from GNSSTools.devices import CaptureManager
+from GNSSTools.devices import TelemetryLogger
+from GNSSTools import tools
+from GNSSTools import positioning
+from GNSSTools import trajectory
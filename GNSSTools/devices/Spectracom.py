@@ -7,67 +7,253 @@
 # AUTHOR
 # Anne-Marie Tobie
 
+import contextlib
+import datetime
+import json
+import os
 import time
+import numpy as np
 import pyvisa
-import interval
+from GNSSTools import positioning
 from GNSSTools import tools
+from GNSSTools import trajectory
 from GNSSTools.devices.device import Device
+from GNSSTools.devices.logpoller import LogPoller
+from GNSSTools.devices.transfer import block, read_block
+from GNSSTools.devices.waypoint import WaypointPlanner
+from GNSSTools.devices.visaworker import CONTROL, LOGGING, DIAGNOSTICS, VisaWorker
+
+
+def numbers(answer):
+    # Return:
+    # tuple of the values of an answer holding several numbers separated by commas
+    return tuple(float(value) for value in answer.split(','))
 
 
 class Spectracom(Device):
 
+    # settings kept by the generator as they are written, which are not sent again when unchanged. The motion
+    # state (position, heading, speeds) is always sent, the generator making it evolve during the scenario.
+    MIRRORED = ('SOURCE:POWER', 'SOURCE:EXTATT', 'SOURCE:SCENARIO:ACCELERATION', 'SOURCE:SCENARIO:RATEHEADING',
+                'SOURCE:SCENARIO:TURNRATE', 'SOURCE:SCENARIO:TURNRADIUS', 'SOURCE:NOISE:CONTROL',
+                'SOURCE:NOISE:CNO', 'SOURCE:SCENARIO:PROPENV', 'SOURCE:SCENARIO:ANTENNAMODEL',
+                'SOURCE:SCENARIO:TROPOMODEL', 'SOURCE:SCENARIO:IONOMODEL', 'SOURCE:SCENARIO:KEEPALTITUDE',
+                'SOURCE:SCENARIO:MULTIPATH', 'SOURCE:SCENARIO:VACCEL', 'SOURCE:SCENARIO:ENUACCEL',
+                'SOURCE:SCENARIO:ECEFACCEL', 'SOURCE:SCENARIO:KEPLER')
+    # commands after which the settings of MIRRORED are unknown
+    RESETS = ('*RST', '*CLS', 'SOURCE:SCENARIO:CONTROL', 'SOURCE:SCENARIO:LOAD')
+
+    # state of the scenario read by snapshot: (name, query, conversion of the answer)
+    STATE = (('position', 'SOURce:SCENario:POSition?', numbers),
+             ('ecef_position', 'SOURce:SCENario:ECEFPOSition?', numbers),
+             ('heading', 'SOURce:SCENario:HEADing?', float),
+             ('speed', 'SOURce:SCENario:SPEed?', float),
+             ('acceleration', 'SOURce:SCENario:ACCeleration?', float),
+             ('rate_heading', 'SOURce:SCENario:RATEHEading?', float),
+             ('turn_rate', 'SOURce:SCENario:TURNRATE?', float),
+             ('turn_radius', 'SOURce:SCENario:TURNRADIUS?', float),
+             ('noise_control', 'SOURce:NOISE:CONTRol?', str),
+             ('noise_cno', 'SOURce:NOISE:CNO?', float),
+             ('propagation_model', 'SOURce:SCENario:PROPenv?', str),
+             ('antenna_model', 'SOURce:SCENario:ANTennamodel?', str),
+             ('tropospheric_model', 'SOURce:SCENario:TROPOmodel?', str),
+             ('ionospheric_model', 'SOURce:SCENario:IONOmodel?', str),
+             ('speed_over_ground', 'SOURce:SCENario:VELocity?', numbers),
+             ('vertical_speed', 'SOURce:SCENario:VSPEed?', float),
+             ('enu_velocity', 'SOURce:SCENario:ENUVELocity?', numbers),
+             ('ecef_velocity', 'SOURce:SCENario:ECEFVELocity?', numbers),
+             ('vertical_acceleration', 'SOURce:SCENario:VACCel?', float),
+             ('enu_acceleration', 'SOURce:SCENario:ENUACCel?', numbers),
+             ('ecef_acceleration', 'SOURce:SCENario:ECEFACCel?', numbers),
+             ('pry_attitude', 'SOURce:SCENario:PRYattitude?', numbers),
+             ('dpry_attitude', 'SOURce:SCENario:DPRYattitude?', numbers),
+             ('kepler', 'SOURce:SCENario:KEPLER?', str))
+
     def __init__(self, com, datafile='datatxt/spectracom_data.txt', currentposfile='datatxt/current_pos.txt',
-                 almanach='datatxt/almanach.txt', latest='datatxt/latest.txt'):
+                 almanach='datatxt/almanach.txt', latest='datatxt/latest.txt', max_message=512, log_rate=1.0,
+                 resource=None, snapshot_every=10, statefile=None):
         super(Spectracom, self).__init__()
         self.com = com
         self.datafile = datafile
         self.currentposfile = currentposfile
         self.almanach = almanach
         self.latest = latest
+        # NMEA output rate of the scenario in Hz, at which the log is polled
+        self.log_rate = log_rate
+        # sections between two snapshots of the state by scenario_reading, 0 for none
+        self.snapshot_every = snapshot_every
+        # file where the snapshots are appended as JSON lines, for instance 'datatxt/spectracom_state.jsonl', None to
+        # only keep them in snapshots
+        self.statefile = statefile
+        self.snapshots = []
+        # start of the scenario and its GPS week, given by set_datetime, and almanacs downloaded for each week
+        self.date = None
+        self.week = None
+        self.almanacs = {}
+        # longest SCPI message sent when commands are joined
+        self.max_message = max_message
+        # last value written for each setting of MIRRORED
+        self.mirror = {}
+        # commands waiting to be sent, None when not batching
+        self.pending = None
+        self.depth = 0
+        if resource is not None:
+            # object with the write, query and close methods of a pyvisa resource, a SimulatedSpectracom for instance
+            self.spectracom = resource
+        else:
+            try:
+                self.spectracom = pyvisa.ResourceManager().open_resource(self.com)
+            except:
+                raise ValueError('Connection with spectracom device failed')
+        # all the I/O with the generator goes through the worker
+        self.io = VisaWorker(self.spectracom)
+
+    def write(self, command):
+        # Sends a command, unless it sets a setting of MIRRORED to the value it already has. While batching, the
+        # command is kept to be sent with the others of the batch. The value of a setting is only remembered once
+        # it has been sent.
+        # Input:
+        # command: SCPI command
+        # Return:
+        # result of the pyvisa write, None if the command was not sent now
+        header, _, value = command.partition(' ')
+        header = header.upper()
+        if header in self.MIRRORED and self.current(header) == value:
+            return None
+        if self.pending is not None:
+            self.pending.append(command)
+            return None
         try:
-            self.spectracom = pyvisa.ResourceManager().open_resource(self.com)
-        except:
-            raise ValueError('Connection with spectracom device failed')
+            result = self.io.write(command, CONTROL).result()
+        except Exception:
+            self.mirror.pop(header, None)
+            raise
+        self.remember([command])
+        return result
+
+    def current(self, header):
+        # Return:
+        # value a setting of MIRRORED will have once the pending commands are sent, None if unknown
+        for command in reversed(self.pending or []):
+            name, _, value = command.partition(' ')
+            name = name.upper()
+            if name == header:
+                return value
+            if name in self.RESETS:
+                return None
+        return self.mirror.get(header)
+
+    def remember(self, commands):
+        # Updates the mirror with commands sent
+        for command in commands:
+            header, _, value = command.partition(' ')
+            header = header.upper()
+            if header in self.RESETS:
+                self.mirror = {}
+            elif header in self.MIRRORED:
+                self.mirror[header] = value
+
+    def ask(self, command, priority=DIAGNOSTICS):
+        # Queries the generator through the I/O worker
+        # Input:
+        # command: SCPI query
+        # priority: CONTROL, LOGGING or DIAGNOSTICS
+        # Return:
+        # the answer
+        return self.io.query(command, priority).result()
+
+    @contextlib.contextmanager
+    def batching(self):
+        # Gathers the commands written in the with block into as few messages as possible, each command after the
+        # first one of a message starting from the root of the SCPI tree:
+        #   SOURce:SCENario:SPEed imm, 0.000000;:SOURce:SCENario:ACCeleration IMM, 0.000000
+        # The commands are sent when leaving the outermost block.
+        if self.pending is None:
+            self.pending = []
+        self.depth += 1
+        try:
+            yield self
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                commands, self.pending = self.pending, None
+                self.flush(commands)
+
+    def flush(self, commands):
+        # Sends commands joined into messages shorter than max_message
+        # Return:
+        # number of messages sent
+        messages = []
+        for command in commands:
+            if messages and len(';:'.join(messages[-1])) + 2 + len(command) <= self.max_message:
+                messages[-1].append(command)
+            else:
+                messages.append([command])
+        futures = [self.io.write(';:'.join(message), CONTROL) for message in messages]
+        for i, (message, future) in enumerate(zip(messages, futures)):
+            try:
+                future.result()
+            except Exception:
+                # the settings of the messages not known to be sent are forgotten
+                for command in sum(messages[i:], []):
+                    self.mirror.pop(command.partition(' ')[0].upper(), None)
+                raise
+            self.remember(message)
+        return len(messages)
+
+    def close(self):
+        # Stops the I/O worker and closes the connection
+        self.io.close()
+        self.spectracom.close()
 
     def clear(self):
         # Clears the status data structures by clearing all event registers and the error queue
         # also possible executing of scenario or signal generator is stopped
-        return self.spectracom.write('*CLS')
+        return self.write('*CLS')
 
     def reset(self):
         # Resets the device, any ongoing activity is stopped and the device is prepared to start new
         # operations
-        return self.spectracom.write('*RST')
+        return self.write('*RST')
 
     def set_datetime(self, date, hour):
         # Sets the scenario start time as GPS time
         # Inputs: string format:
         # date: MM-DD-YYYY,  MM=Month {01- 12}, DD=day of month {01- 31}, YYYY=year
         # hour: hh:mm:ss.s, hh=hours {00- 23}, mm=minutes {00-59}
-        return self.spectracom.write('SOURce:SCENario:DATEtime %s %s' % (date, hour))
+        for shape in ('%m-%d-%Y %H:%M:%S.%f', '%m-%d-%Y %H:%M:%S'):
+            try:
+                self.date = datetime.datetime.strptime('%s %s' % (date, hour), shape)
+                break
+            except ValueError:
+                pass
+        else:
+            raise ValueError('Invalid scenario start %s %s' % (date, hour))
+        self.week = positioning.gps_week(self.date.date())
+        return self.write('SOURce:SCENario:DATEtime %s %s' % (date, hour))
 
     def control(self, control):
         # Launches, holds, arms or stops the scenario
         # Inputs:
         # control: {START,STOP,HOLD,ARM}
-        return self.spectracom.write('SOURce:SCENario:CONTrol %s' % control)
+        return self.write('SOURce:SCENario:CONTrol %s' % control)
 
     def set_power(self, power):
         # sets the transmit power of the device. The power for ublox integrity must be less (or
         # equal) than-130 dBm!!
         # Input:
         # power: decimal [-160,-65] dBm
-        return self.spectracom.write('SOURce:POWer %f' % power)
+        return self.write('SOURce:POWer %f' % power)
 
     def set_observation(self):
-        self.spectracom.write('SOURce:SCENario:OBS 10,3800, 1')
+        self.write('SOURce:SCENario:OBS 10,3800, 1')
 
     def set_ext_attenuation(self, extatt):
         # Sets the external attenuation of the device. Note : Setting not stored during
         # scenario or 1-channel mode execution.
         # Input:
         # extatt: decimal = [0, 30] in dB
-        return self.spectracom.write('SOURce:EXTATT %f' % extatt)
+        return self.write('SOURce:EXTATT %f' % extatt)
 
     def set_position(self, lat, long, alt):
         # Sets the position to the generator
@@ -75,7 +261,7 @@ class Spectracom(Device):
         # lat: Decimal Latitude [-89.99999999, +89.99999999] degrees North
         # long: Decimal Longitude [-360.00000000, +360.00000000] degrees East
         # alt: Decimal Altitude [-1000.00, +20,200,000.00] meters
-        return self.spectracom.write('SOURce:SCENario:POSition IMM, %f, %f, %f' % (lat, long, alt))
+        return self.write('SOURce:SCENario:POSition IMM, %f, %f, %f' % (lat, long, alt))
 
     def set_ecefpos(self, x, y, z):
         # Sets the ECEF position in X, Y, Z coordinates as the start position for the loaded scenario
@@ -84,7 +270,7 @@ class Spectracom(Device):
         # x: Decimal X Position [-26 500 000.00, +26 500 000.00] meters
         # y: Decimal Y Position [-26 500 000.00, +26�500 000.00] meters
         # z: Decimal Z Position [-26�500 000.00, +26�500 000.00] meters
-        return self.spectracom.write('SOURce:SCENario:ECEFPOSition IMM, %f, %f, %f' % x, y, z)
+        return self.write('SOURce:SCENario:ECEFPOSition IMM, %f, %f, %f' % x, y, z)
 
     def set_duration(self, start, duration, inter):
         # Turn on scenario observations.
@@ -93,57 +279,57 @@ class Spectracom(Device):
         #        received number of seconds from scenario start.
         # duration: length of observations from start.
         # interval: the interval between the individual observations in the resulting Rinex OBS file
-        return self.spectracom.write('SOURce:SCENario:OBS %f, %f, %f' % (start, tools.get_sec(duration), inter))
+        return self.write('SOURce:SCENario:OBS %f, %f, %f' % (start, tools.get_sec(duration), inter))
 
     def set_heading(self, heading):
         # Sets the vehicle true heading.
         # Input:
         # heading: Decimal Heading [0, 359.999] true heading in decimal degrees the heading is expressed
         #          in clockwise direction from the true north representing 0 degrees, increasing to 359.999 degrees
-        return self.spectracom.write('SOURce:SCENario:HEADing imm, %f' % heading)
+        return self.write('SOURce:SCENario:HEADing imm, %f' % heading)
 
     def set_speed(self, speed):
         # Sets the vehicle's speed over ground (WGS84 ellipsoid)
         # Input:
         # speed: decimal 1D speed [0.00 to +20000.00] m/s
-        return self.spectracom.write('SOURce:SCENario:SPEed imm, %f' % speed)
+        return self.write('SOURce:SCENario:SPEed imm, %f' % speed)
 
     def set_acceleration(self, acceleration):
         # Sets the 1D acceleration expressed in m/s2 when scenario is running.
         # Input:
         # acceleration: decimal 1d acceleration [-981 to +981] m/s2, ie [-100G to +100g]
-        return self.spectracom.write('SOURce:SCENario:ACCeleration IMM, %f' % acceleration)
+        return self.write('SOURce:SCENario:ACCeleration IMM, %f' % acceleration)
 
     def set_rateheadind(self, rateheading):
         # Set the heading change rate.
         # Input:
         # rateheading: Decimal RateHeading [-180.000, 180.000] true heading change in decimal degrees per second
         #              Positive value correspond to right turn, negative � left turn.
-        return self.spectracom.write('SOURce:SCENario:RATEHEading IMM, %f' % rateheading)
+        return self.write('SOURce:SCENario:RATEHEading IMM, %f' % rateheading)
 
     def set_turnrate(self, turnrate):
         # Set the rate of turning.
         # Input:
         # turnrate: Decimal TurnRate [- 180.000, 180.000] desired average heading rate (over single full closed circle)
         #           in decimal degrees per second. Positive value correspond to right turn, negative � left turn.
-        return self.spectracom.write('SOURce:SCENario:TURNRATE IMM, %f' % turnrate)
+        return self.write('SOURce:SCENario:TURNRATE IMM, %f' % turnrate)
 
     def set_turnradius(self, turnradius):
         # Sets the radius of turning. Radius is expressed in meters
         # Input:
         # turnradius: Decimal TurnRadius [-5 000 000.000, 5�000 000.000] radius of turning in meters. Positive value
         #             correspond to right turn, negative � left turn.
-        return self.spectracom.write('SOURce:SCENario:TURNRADIUS IMM %f' % turnradius)
+        return self.write('SOURce:SCENario:TURNRADIUS IMM %f' % turnradius)
 
     def set_noise(self, noise):
         # set the noise simulation ON OFF
-        return self.spectracom.write('SOURce:NOISE:CONTrol %s' % noise)
+        return self.write('SOURce:NOISE:CONTrol %s' % noise)
 
     def set_cno(self, cno):
         # set the maximum carrier to noise density of the simulated signals
         # Input:
         # cno: in dB.Hz, a decimal number, within the range [0.0, 56]
-        return self.spectracom.write('SOURce:NOISE:CNO %f' % cno)
+        return self.write('SOURce:NOISE:CNO %f' % cno)
 
     def set_propa(self, env, sky, obstruction, nlos):
         # Sets built-in propagation environment model. The scenario must be running
@@ -154,25 +340,25 @@ class Spectracom(Device):
         # obstruction: decimal [00.0, 90.0] obstruction_limit: elevation below ther is no line of sight satellites
         # nlos: decimal [0.0,1.0] nlos_probability: probability for a satellite with elevation between sky limit
         #       and obstruction limit to be non line of sight
-        return self.spectracom.write('SOURce:SCENario:PROPenv %s, %f, %f, %f' % (env, sky, obstruction, nlos))
+        return self.write('SOURce:SCENario:PROPenv %s, %f, %f, %f' % (env, sky, obstruction, nlos))
 
     def set_antenna(self, antenna):
         # Set the antenna model for the current scenario
         # Input:
         # antenna: model can be : Zero model, Helix, Patch, Cardioid
-        return self.spectracom.write('SOURce:SCENario:ANTennamodel %s' % antenna)
+        return self.write('SOURce:SCENario:ANTennamodel %s' % antenna)
 
     def set_tropo(self, tropo):
         # set the tropospheric model for the current scenario
         # Input:
         # tropo: tropospheric model can be : Saastamoinen, black, Goad&Goodman, Stanag
-        return self.spectracom.write('SOURce:SCENario:TROPOmodel %s' % tropo)
+        return self.write('SOURce:SCENario:TROPOmodel %s' % tropo)
 
     def set_iono(self, iono):
         # Select the ionospheric model to be used in the current scenario.
         # Input:
         # iono: Permitted values are ON and OFF
-        return self.spectracom.write('SOURce:SCENario:IONOmodel %s' % iono)
+        return self.write('SOURce:SCENario:IONOmodel %s' % iono)
 
     def set_keepalt(self, keepalt):
         # sets the altitude model setting for the current scenario. Default setting is ON.
@@ -180,7 +366,7 @@ class Spectracom(Device):
         # from the difference between the ENU plane and the ellipsoid model of the earth.
         # Input:
         # keepalt: Permitted values are ON and OFF
-        return self.spectracom.write('SOURce:SCENario:KEEPALTitude %s' % keepalt)
+        return self.write('SOURce:SCENario:KEEPALTitude %s' % keepalt)
 
     def set_multipath(self, multipath):
         # This command sets the multipath parameters for satellite with a satID.
@@ -197,20 +383,20 @@ class Spectracom(Device):
         #                       poweroffset: Power Offset in meters [-30.0, 0.0]
         #                       powerchange: Power Change rate in dB/interval [-30.0, 0,0] and
         #                       powerinterval: Power Interval in seconds [0.0, 600.0].
-        return self.spectracom.write('SOURce:SCENario:MULtipath IMM, %s' % multipath)
+        return self.write('SOURce:SCENario:MULtipath IMM, %s' % multipath)
 
     def set_velocity(self, speed, heading):
         # Sets the vehicle's speed over ground (WGS84 ellipsoid) and heading in degrees
         # Input:
         # speed: Decimal 1D speed [0.000 to +20000.000] m/s
         # heading: Decimal bearing [0, 359.999] true bearing in decimal degrees
-        return self.spectracom.write('SOURce:SCENario:VELocity IMM, %f, %f' % (speed, heading))
+        return self.write('SOURce:SCENario:VELocity IMM, %f, %f' % (speed, heading))
 
     def set_verticalspeed(self, vspeed):
         # Sets the vehicle's vertical speed
         # Input:
         # vspeed: Decimal 1D Speed [-20000.00 to +20000.00] m/s
-        return self.spectracom.write('SOURce:SCENario:VSPEed IMM, %f' % vspeed)
+        return self.write('SOURce:SCENario:VSPEed IMM, %f' % vspeed)
 
     def set_enuvel(self, vest, vnorth, vup):
         # Sets the velocity expressed in ENU coordinates when scenario is running
@@ -218,7 +404,7 @@ class Spectracom(Device):
         # vest: velocity East in [-20000.00 to +20000.00] m/s
         # vnorth: velocity North in [-20000.00 to +20000.00] m/s
         # vup: velocity Up in [-20000.00 to +20000.00] m/s
-        return self.spectracom.write('SOURce:SCENario:ENUVELocity IMM, %f, %f, %f' % (vest, vnorth, vup))
+        return self.write('SOURce:SCENario:ENUVELocity IMM, %f, %f, %f' % (vest, vnorth, vup))
 
     def set_ecefvel(self, velx, vely, velz):
         # Sets the current ECEF velocity in X, Y and Z coordinates when the scenario is running
@@ -226,13 +412,13 @@ class Spectracom(Device):
         # velx: velocity X in [-20000.00 to +20000.00] m/s
         # vely: velocity Y in [-20000.00 to +20000.00] m/s
         # velz: velocity Z in [-20000.00 to +20000.00] m/s
-        return self.spectracom.write('SOURce:SCENario:ECEFVELocity IMM, %f, %f, %f' % (velx, vely, velz))
+        return self.write('SOURce:SCENario:ECEFVELocity IMM, %f, %f, %f' % (velx, vely, velz))
 
     def set_vacceleration(self, vaccel):
         # Sets the vehicle's vertical acceleration
         # Input:
         # vaccel: Decimal 1D Acceleration [-981 to +981] m/s^2 equivalent to [-100G to +100G]
-        return self.spectracom.write('SOURce:SCENario:VACCel IMM, %f' % vaccel)
+        return self.write('SOURce:SCENario:VACCel IMM, %f' % vaccel)
 
     def set_enuaccel(self, aest, anorth, aup):
         # Sets the acceleration expressed in ENU coordinates when scenario is running
@@ -240,7 +426,7 @@ class Spectracom(Device):
         # aest: Acceleration East [-981 to +981] m/s^2 equivalent to [-100G to +100G]
         # anorth: Acceleration North [-981 to +981] m/s^2 equivalent to [-100G to +100G]
         # aup: Acceleration Up [-981 to +981] m/s^2 equivalent to [-100G to +100G]
-        return self.spectracom.write('SOURce:SCENario:ENUACCel IMM, %f, %f, %f' % (aest, anorth, aup))
+        return self.write('SOURce:SCENario:ENUACCel IMM, %f, %f, %f' % (aest, anorth, aup))
 
     def set_ecefaccel(self, accelx, accely, accelz):
         # Sets the ECEF acceleration in 3-dimensions as acceleration X, Y, Z when scenario is running
@@ -248,7 +434,7 @@ class Spectracom(Device):
         # accelx: Acceleration X [-981 to +981] m/s^2 equivalent to [-100G to +100G]
         # accely: Acceleration Y [-981 to +981] m/s^2 equivalent to [-100G to +100G]
         # accelz: Acceleration Z [-981 to +981] m/s^2 equivalent to [-100G to +100G]
-        return self.spectracom.write('SOURce:SCENario:ECEFACCel IMM, %f, %f, %f' % (accelx, accely, accelz))
+        return self.write('SOURce:SCENario:ECEFACCel IMM, %f, %f, %f' % (accelx, accely, accelz))
 
     def set_pryattitude(self, pitch, roll, yaw):
         # Sets the vehicle attitude in 3-dimension about the center of mass as Pitch, Roll and Yaw
@@ -257,7 +443,7 @@ class Spectracom(Device):
         # pitch: Decimal Pitch [-?, +?] Radians
         # roll: Decimal Roll [-?, +?] Radians
         # yaw: Decimal Yaw [-?, +?] Radians
-        return self.spectracom.write('SOURce:SCENario:PRYattitude IMM, %f, %f, %f' % (pitch, roll, yaw))
+        return self.write('SOURce:SCENario:PRYattitude IMM, %f, %f, %f' % (pitch, roll, yaw))
 
     def set_dpryatt(self, pitch, roll, yaw):
         # Sets the vehicle attitude in 3-dimension about the center of mass as Pitch, Roll and Yaw
@@ -267,7 +453,7 @@ class Spectracom(Device):
         #                   pitch: Decimal Pitch [-180, +180] Degrees
         #                   roll: Decimal Roll [-180, +180] Degrees
         #                   yaw: Decimal Yaw [-180, +180] Degrees
-        return self.spectracom.write('SOURce:SCENario:DPRYattitude IMM, %f, %f, %f' % (pitch, roll, yaw))
+        return self.write('SOURce:SCENario:DPRYattitude IMM, %f, %f, %f' % (pitch, roll, yaw))
 
     def set_kepler(self, kepler):
         # Sets the Kepler orbit parameters
@@ -279,7 +465,7 @@ class Spectracom(Device):
         #                       ascension: Decimal Ascension of ascending node [-?, +?] Radians
         #                       inclination: Decimal Inclination [-?, +?] Radians
         #                       argperigee: Decimal Argument of perigee [-?, +?] Radians
-        return self.spectracom.write('SOURce:SCENario:KEPLER IMM, %s' % kepler)
+        return self.write('SOURce:SCENario:KEPLER IMM, %s' % kepler)
 
     def info_available(self, scenario, section):
         # Traverse the array containing the scenario data and if there is an information available,
@@ -287,64 +473,65 @@ class Spectracom(Device):
         # Inputs:
         # scenario: array containing information of the test.ini file
         # section: section of the scenario
-        if scenario[section][4] != '':
-            self.set_heading(float(scenario[section][4]))
-        if scenario[section][5] != '':
-            self.set_speed(float(scenario[section][5]))
-        if scenario[section][6] != '':
-            self.set_acceleration(float(scenario[section][6]))
-        if scenario[section][7] != '':
-            self.set_rateheadind(float(scenario[section][7]))
-        if scenario[section][8] != '':
-            self.set_turnrate(float(scenario[section][8]))
-        if scenario[section][9] != '':
-            self.set_turnradius(float(scenario[section][9]))
-        if scenario[section][10] != '':
-            self.set_noise('ON')
-            self.set_cno(float(scenario[section][10]))
-        if scenario[section][11] != '':
-            info = scenario[section][11].split(',')
-            self.set_propa(info[0], float(info[1]), float(info[2]), float(info[3]))
-        if scenario[section][12] != '':
-            self.set_antenna(scenario[section][12])
-        if scenario[section][13] != '':
-            self.set_tropo(scenario[section][13])
-        if scenario[section][14] != '':
-            self.set_iono(scenario[section][14])
-        if scenario[section][15] != '':
-            self.set_keepalt(scenario[section][15])
-        if scenario[section][16] != '':
-            info = scenario[section][16].split(',')
-            self.set_ecefpos(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][17] != '':
-            self.set_multipath(scenario[section][17])
-        if scenario[section][18] != '':
-            info = scenario[section][18].split(',')
-            self.set_velocity(float(info[0]), float(info[1]))
-        if scenario[section][19] != '':
-            self.set_verticalspeed(scenario[section][19])
-        if scenario[section][20] != '':
-            info = scenario[section][20].split(',')
-            self.set_enuvel(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][21] != '':
-            info = scenario[section][21].split(',')
-            self.set_ecefvel(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][22] != '':
-            self.set_vacceleration(scenario[section][22])
-        if scenario[section][23] != '':
-            info = scenario[section][23].split(',')
-            self.set_enuaccel(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][24] != '':
-            info = scenario[section][24].split(',')
-            self.set_ecefaccel(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][25] != '':
-            info = scenario[section][25].split(',')
-            self.set_pryattitude(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][26] != '':
-            info = scenario[section][26].split(',')
-            self.set_dpryatt(float(info[0]), float(info[1]), float(info[2]))
-        if scenario[section][27] != '':
-            self.set_kepler(scenario[section][27])
+        with self.batching():
+            if scenario[section][4] != '':
+                self.set_heading(float(scenario[section][4]))
+            if scenario[section][5] != '':
+                self.set_speed(float(scenario[section][5]))
+            if scenario[section][6] != '':
+                self.set_acceleration(float(scenario[section][6]))
+            if scenario[section][7] != '':
+                self.set_rateheadind(float(scenario[section][7]))
+            if scenario[section][8] != '':
+                self.set_turnrate(float(scenario[section][8]))
+            if scenario[section][9] != '':
+                self.set_turnradius(float(scenario[section][9]))
+            if scenario[section][10] != '':
+                self.set_noise('ON')
+                self.set_cno(float(scenario[section][10]))
+            if scenario[section][11] != '':
+                info = scenario[section][11].split(',')
+                self.set_propa(info[0], float(info[1]), float(info[2]), float(info[3]))
+            if scenario[section][12] != '':
+                self.set_antenna(scenario[section][12])
+            if scenario[section][13] != '':
+                self.set_tropo(scenario[section][13])
+            if scenario[section][14] != '':
+                self.set_iono(scenario[section][14])
+            if scenario[section][15] != '':
+                self.set_keepalt(scenario[section][15])
+            if scenario[section][16] != '':
+                info = scenario[section][16].split(',')
+                self.set_ecefpos(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][17] != '':
+                self.set_multipath(scenario[section][17])
+            if scenario[section][18] != '':
+                info = scenario[section][18].split(',')
+                self.set_velocity(float(info[0]), float(info[1]))
+            if scenario[section][19] != '':
+                self.set_verticalspeed(scenario[section][19])
+            if scenario[section][20] != '':
+                info = scenario[section][20].split(',')
+                self.set_enuvel(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][21] != '':
+                info = scenario[section][21].split(',')
+                self.set_ecefvel(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][22] != '':
+                self.set_vacceleration(scenario[section][22])
+            if scenario[section][23] != '':
+                info = scenario[section][23].split(',')
+                self.set_enuaccel(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][24] != '':
+                info = scenario[section][24].split(',')
+                self.set_ecefaccel(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][25] != '':
+                info = scenario[section][25].split(',')
+                self.set_pryattitude(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][26] != '':
+                info = scenario[section][26].split(',')
+                self.set_dpryatt(float(info[0]), float(info[1]), float(info[2]))
+            if scenario[section][27] != '':
+                self.set_kepler(scenario[section][27])
 
     def set_default(self, scenario,  section):
         # Traverse the array containing the scenario data and if there is no information available,
@@ -352,46 +539,47 @@ class Spectracom(Device):
         # Inputs:
         # scenario: array containing information of the test.ini file
         # section: section of the scenario
-        if scenario[section][5] == '':
-            self.set_speed(0.0)
-        if scenario[section][6] == '':
-            self.set_acceleration(0.0)
-        if scenario[section][7] == '':
-            self.set_rateheadind(0.0)
-        if scenario[section][8] == '':
-            self.set_turnrate(0.0)
-        if scenario[section][9] == '':
-            self.set_turnradius(0.0)
-        if scenario[section][10] == '':
-            self.set_noise('OFF')
-        if scenario[section][11] == '':
-            self.set_propa('OPEN', 0.0, 0.0, 0.0)
-        if scenario[section][12] == '':
-            self.set_antenna('Zero model')
-        if scenario[section][13] == '':
-            self.set_tropo('Saastamoinen')
-        if scenario[section][14] == '':
-            self.set_iono('OFF')
-        if scenario[section][15] == '':
-            self.set_keepalt('OFF')
-        if scenario[section][18] != '':
-            self.set_velocity(0.0, 0)
-        if scenario[section][19] != '':
-            self.set_verticalspeed(0.0)
-        if scenario[section][20] != '':
-            self.set_enuvel(0.0, 0.0, 0.0)
-        if scenario[section][21] != '':
-            self.set_ecefvel(0.0, 0.0, 0.0)
-        if scenario[section][22] != '':
-            self.set_vacceleration(0.0)
-        if scenario[section][23] != '':
-            self.set_enuaccel(0.0, 0.0, 0.0)
-        if scenario[section][24] != '':
-            self.set_ecefaccel(0.0, 0.0, 0.0)
-        if scenario[section][25] != '':
-            self.set_pryattitude(0, 0, 0)
-        if scenario[section][26] != '':
-            self.set_dpryatt(0, 0, 0)
+        with self.batching():
+            if scenario[section][5] == '':
+                self.set_speed(0.0)
+            if scenario[section][6] == '':
+                self.set_acceleration(0.0)
+            if scenario[section][7] == '':
+                self.set_rateheadind(0.0)
+            if scenario[section][8] == '':
+                self.set_turnrate(0.0)
+            if scenario[section][9] == '':
+                self.set_turnradius(0.0)
+            if scenario[section][10] == '':
+                self.set_noise('OFF')
+            if scenario[section][11] == '':
+                self.set_propa('OPEN', 0.0, 0.0, 0.0)
+            if scenario[section][12] == '':
+                self.set_antenna('Zero model')
+            if scenario[section][13] == '':
+                self.set_tropo('Saastamoinen')
+            if scenario[section][14] == '':
+                self.set_iono('OFF')
+            if scenario[section][15] == '':
+                self.set_keepalt('OFF')
+            if scenario[section][18] != '':
+                self.set_velocity(0.0, 0)
+            if scenario[section][19] != '':
+                self.set_verticalspeed(0.0)
+            if scenario[section][20] != '':
+                self.set_enuvel(0.0, 0.0, 0.0)
+            if scenario[section][21] != '':
+                self.set_ecefvel(0.0, 0.0, 0.0)
+            if scenario[section][22] != '':
+                self.set_vacceleration(0.0)
+            if scenario[section][23] != '':
+                self.set_enuaccel(0.0, 0.0, 0.0)
+            if scenario[section][24] != '':
+                self.set_ecefaccel(0.0, 0.0, 0.0)
+            if scenario[section][25] != '':
+                self.set_pryattitude(0, 0, 0)
+            if scenario[section][26] != '':
+                self.set_dpryatt(0, 0, 0)
 
     def scenario_reading(self, scenario):
         # Run the scenario chosen, set parameters and save data in a file
@@ -401,20 +589,16 @@ class Spectracom(Device):
         # when a section is done, gives a set of information specified in query function
         print('Running...')
         savefile = open(self.datafile, 'w')
+        poller = LogPoller(self, savefile, rate=self.log_rate)
+        planner = WaypointPlanner(self, poller)
         for section in range(len(scenario)-2):
             section += 1
             if scenario[section][3] == '':
-                # if there is no duration given in the scenario for the section
-                precision = 0.00006
-                while ((self.get_current_pos()[0][1] not in interval.Interval.between(
-                        float(scenario[section][0]) - precision, float(scenario[section][0]) + precision)) and
-                        ((self.get_current_pos()[0][2] not in interval.Interval.between(
-                        float(scenario[section][0]) - precision, float(scenario[section][0]) + precision)))):
-                    self.set_heading(tools.heading_compute(
-                        self.get_current_pos()[0][1], (float(scenario[section][0])),
-                        self.get_current_pos()[0][2], (float(scenario[section][1]))))
-                    self.info_available(scenario, section)
-                    self.data(savefile)
+                # if there is no duration given in the scenario for the section, heads to the section position,
+                # the heading being only corrected at the predicted arrival
+                self.info_available(scenario, section)
+                speed = float(scenario[section][5]) if scenario[section][5] != '' else None
+                planner.steer(float(scenario[section][0]), float(scenario[section][1]), speed)
                 self.set_default(scenario, section)
 
             else:
@@ -422,102 +606,205 @@ class Spectracom(Device):
                     self.set_position(float(scenario[section][0]), float(scenario[section][1]),
                                       float(scenario[section][2]))
                 self.info_available(scenario, section)
-                self.data(savefile)
-                duration = tools.get_sec(scenario[section][3])
-                tps = time.time()
-                while time.time() - tps < duration:
-                    self.data(savefile)
+                poller.poll()
+                poller.run(tools.get_sec(scenario[section][3]))
                 self.set_default(scenario, section)
-            self.query()
+            if self.snapshot_every and (section % self.snapshot_every == 0 or section == len(scenario) - 2):
+                self.record(section)
         savefile.close()
-        self.query()
+        print('LOG polling', poller.stats())
+        print('VISA', self.io.stats())
         print('End')
 
-    def query(self):
-        print('LLA position', self.spectracom.query('SOURce:SCENario:POSition?'))
-        print('ECEF position', self.spectracom.query('SOURce:SCENario:ECEFPOSition?'))
-        print('heading', self.spectracom.query('SOURce:SCENario:HEADing?'))
-        print('speed', self.spectracom.query('SOURce:SCENario:SPEed?'))
-        print('acceleration', self.spectracom.query('SOURce:SCENario:ACCeleration?'))
-        print('rate heading', self.spectracom.query('SOURce:SCENario:RATEHEading?'))
-        print('turn rate', self.spectracom.query('SOURce:SCENario:TURNRATE?'))
-        print('turn radius', self.spectracom.query('SOURce:SCENario:TURNRADIUS?'))
-        print('noise control', self.spectracom.query('SOURce:NOISE:CONTRol?'))
-        print('noise cno', self.spectracom.query('SOURce:NOISE:CNO?'))
-        print('propagation model', self.spectracom.query('SOURce:SCENario:PROPenv?'))
-        print('antenna model', self.spectracom.query('SOURce:SCENario:ANTennamodel?'))
-        print('tropospheric model', self.spectracom.query('SOURce:SCENario:TROPOmodel?'))
-        print('ionospheric model', self.spectracom.query('SOURce:SCENario:IONOmodel?'))
-        print('speed over ground', self.spectracom.query('SOURce:SCENario:VELocity?'))
-        print('vertical speed', self.spectracom.query('SOURce:SCENario:VSPEed?'))
-        print('ENU velocity', self.spectracom.query('SOURce:SCENario:ENUVELocity?'))
-        print('ECEF velocity', self.spectracom.query('SOURce:SCENario:ECEFVELocity?'))
-        print('vertical acceleration', self.spectracom.query('SOURce:SCENario:VACCel?'))
-        print('ENU acceleration', self.spectracom.query('SOURce:SCENario:ENUACCel?'))
-        print('ECEF acceleration', self.spectracom.query('SOURce:SCENario:ECEFACCel?'))
-        print('PRY attitude', self.spectracom.query('SOURce:SCENario:PRYattitude?'))
-        print('DPRY attitude', self.spectracom.query('SOURce:SCENario:DPRYattitude?'))
-        print('Kepler', self.spectracom.query('SOURce:SCENario:KEPLER?'))
+    def snapshot(self, names=None):
+        # Reads the state of the scenario with as few compound queries as possible
+        # Input:
+        # names: names of STATE to read, all of them by default
+        # Return:
+        # dictionary {name: value}, the value being a float, a tuple of floats or a string as given by STATE
+        state = [entry for entry in self.STATE if names is None or entry[0] in names]
+        messages = []
+        for _, command, _ in state:
+            if messages and len(messages[-1][0]) + 2 + len(command) <= self.max_message:
+                messages[-1] = (messages[-1][0] + ';:' + command, messages[-1][1] + 1)
+            else:
+                messages.append((command, 1))
+        futures = [self.io.query(message, DIAGNOSTICS) for message, _ in messages]
+        answers = []
+        for (message, count), future in zip(messages, futures):
+            answer = future.result().strip().split(';')
+            if len(answer) != count:
+                # the instrument did not answer the compound query, each command is sent alone
+                answer = [self.ask(command).strip() for command in message.split(';:')]
+            answers += answer
+        return {name: convert(answer.strip()) for (name, _, convert), answer in zip(state, answers)}
+
+    def record(self, section):
+        # Appends a snapshot of the state at the end of a section to the run record
+        # Input:
+        # section: number of the section
+        # Return:
+        # the snapshot, with the section and the time it was taken
+        state = {'section': section, 'time': time.time()}
+        state.update(self.snapshot())
+        self.snapshots.append(state)
+        if self.statefile is not None:
+            with open(self.statefile, 'a') as file:
+                file.write(json.dumps(state) + '\n')
+        return state
+
+    def upload(self, name, data, directory=None):
+        # Writes a file on the generator, the content being sent as an IEEE-488.2 definite length block
+        # Input:
+        # name: name of the file
+        # data: content of the file
+        # directory: directory of the file, the current one if None
+        if directory is not None:
+            self.write('MMEMory:CDIRectory %s' % directory)
+        return self.io.write('MMEMory:DATA "%s",%s' % (name, block(data)), CONTROL).result()
+
+    def download(self, name, filename, directory='observations', chunk_size=1 << 16, progress=None, retries=3):
+        # Downloads a file of the generator by chunks, straight into a file. A failed transfer is started again
+        # from the beginning of the file, the part already received in filename.part being checked rather than
+        # written again until the file is complete.
+        # Input:
+        # name: name of the file on the generator
+        # filename: where the file is written
+        # directory: directory of the file, the current one if None
+        # chunk_size: number of bytes read at once
+        # progress: function called with (bytes received, size of the file) after each chunk
+        # retries: number of times a failed transfer is started again
+        # Return:
+        # size of the file
+        if directory is not None:
+            self.write('MMEMory:CDIRectory %s' % directory)
+        part = filename + '.part'
+
+        def fetch(resource, attempt):
+            if attempt and hasattr(resource, 'clear'):
+                # the end of the interrupted answer is dropped
+                resource.clear()
+            resource.write('MMEMory:DATA? %s' % name)
+            return read_block(resource, part, chunk_size, progress)
+
+        for attempt in range(retries + 1):
+            try:
+                length = self.io.call(lambda resource: fetch(resource, attempt), DIAGNOSTICS).result()
+                break
+            except (pyvisa.errors.VisaIOError, OSError):
+                if attempt == retries:
+                    raise
+        os.replace(part, filename)
+        return length
+
+    def play(self, scenario, name='gnsstools', rate=1.0):
+        # Runs the motion of a scenario on the generator instead of driving it section by section: the reference
+        # trajectory is uploaded once as a NMEA trajectory file with a scenario file using it, which is loaded
+        # and started. The other settings of the sections (C/N0, propagation...) are not played.
+        # Input:
+        # scenario: array containing information of the test.ini file
+        # name: name of the trajectory (name.nmea) and scenario (name.scen) files
+        # rate: rate of the trajectory in Hz
+        # Return:
+        # the reference trajectory played, array of trajectory.TRUTH_DTYPE records
+        # Raises:
+        # ValueError: if the scenario start was not set by set_datetime
+        if self.date is None:
+            raise ValueError('The start of the scenario must be set by set_datetime')
+        truth = trajectory.reference(scenario, rate)
+        self.upload(name + '.nmea', trajectory.nmea(truth, self.date), 'trajectories')
+        self.upload(name + '.scen', '[scenario]\nstart=%s\ntrajectory=%s.nmea\n' %
+                    (self.date.strftime('%m-%d-%Y %H:%M:%S.%f')[:-5], name), 'scenarios')
+        with self.batching():
+            self.write('SOURce:SCENario:LOAD "%s.scen"' % name)
+            self.control('start')
+        return truth
 
+    def query(self):
+        # Prints the state of the scenario
+        # Return:
+        # the snapshot printed
+        state = self.snapshot()
+        for name, value in state.items():
+            print(name, value)
+        return state
 
     def data(self, savefile):
         # take the data and print the result into the savefile chosen
         # Input:
         # savefile: chosen savefile tu store data
-        data = self.spectracom.query('SOURce:SCENario:LOG?')
+        data = self.ask('SOURce:SCENario:LOG?', LOGGING)
         savefile.write(data)
 
     def get_data(self):
         # take the nmea data for the duration of the scenario sent by the spectracom and store them into the file
         savefile = open(self.datafile, 'w')
-        while True:
-            data = self.spectracom.query('SOURce:SCENario:LOG?')
-            savefile.write(data)
-            time.sleep(0.8)
-        savefile.close()
+        try:
+            LogPoller(self, savefile, rate=self.log_rate).run()
+        finally:
+            savefile.close()
         return savefile
 
+    def position(self, savefile=None):
+        # Current position of the scenario, read from a single LOG query parsed in memory
+        # Input:
+        # savefile: file where the answer is also stored, None to only read the position
+        # Return:
+        # tools.Position(time, lat, long, alt), None if the answer has no GGA sentence with a position
+        data = self.ask('SOURce:SCENario:LOG?', LOGGING)
+        if savefile is not None:
+            savefile.write(data)
+        return tools.gga_position(data)
+
     def get_current_pos(self):
         # save the current position in this shape [time in HHMMSS.DD, LAT in DMS, LONG in DMS, ALT in m]
         savefile = open(self.currentposfile, 'w')
-        data = self.spectracom.query('SOURce:SCENario:LOG?')
+        data = self.ask('SOURce:SCENario:LOG?', LOGGING)
         savefile.write(data)
         savefile.close()
         pos = (tools.data(self.currentposfile))
         return pos
 
-    def get_almanach(self):
+    def get_almanach(self, week=None):
+        # Downloads the almanac once per GPS week, the parsed almanac being kept in memory and saved next to
+        # the almanach file (almanach_<week>.npy)
+        # Input:
+        # week: full GPS week number, the week of the scenario date (set_datetime) by default
         # Return:
-        # a matrix of almanach data, almanach[i] contains:
-        # [ID, Health, Eccentricity, Time of Applicability in seconds, Orbital Inclination in rad,
-        # Rate of Right Ascen in rad/s, SQRT(A) in m 1/2, Right Ascen at Week(rad), Argument of Perigee in rad
-        # Mean Anom in rad, Af0 in s, Af1 in s/s, week]
-        self.spectracom.write('MMEMory:CDIRectory observations')
-        file = open(self.almanach, 'w')
-        file.write(self.spectracom.query('MMEMory:DATA? alm_gps.txt'))
-        file.close()
-        file = open(self.almanach, 'r')
-        i = 0
-        almanach = []
-        inter = []
-        for line in file:
-            if line[0] == '#' or line[0] == '\n':
-                pass
-            elif line[0] == '*':
-                i += 1
-                almanach.append(inter)
-                inter = []
-            else:
-                b = 0
-                while line[27 + b] != '\n':
-                    b += 1
-                inter.append(line[27:(27 + b)])
-        almanach.append(inter)
-        file.close()
-        return almanach
-
-    def get_latest(self):
-        file = open(self.latest, 'w')
-        self.spectracom.write('MMEMory:CDIRectory observations')
-        file.write(self.spectracom.query('MMEMory:DATA? latest.obs'))
-        file.close()
+        # array of positioning.ALM_DTYPE records: svid, health, eccentricity, time of applicability in s,
+        # inclination in rad, rate of right ascension in rad/s, sqrt(A) in m 1/2, right ascension at week in rad,
+        # argument of perigee in rad, mean anomaly in rad, af0 in s, af1 in s/s, week
+        if week is None:
+            week = self.week
+        if week in self.almanacs:
+            return self.almanacs[week]
+        cache = '%s_%s.npy' % (os.path.splitext(self.almanach)[0], week)
+        if week is not None and os.path.exists(cache):
+            almanac = np.load(cache)
+        else:
+            self.download('alm_gps.txt', self.almanach)
+            with open(self.almanach) as file:
+                almanac = positioning.read_almanac(file.read())
+            if week is not None:
+                np.save(cache, almanac)
+        self.almanacs[week] = almanac
+        return almanac
+
+    def visibility(self, trajectory, elevation_mask=5.0, week=None):
+        # Predicts the satellites seen along a trajectory from the almanac
+        # Input:
+        # trajectory: (tow, lat, long, alt) arrays, GPS times of week in s, positions in decimal degrees and m
+        # elevation_mask: elevation in degrees under which the satellites are not seen
+        # week: GPS week of the almanac, as for get_almanach
+        # Return:
+        # az, elev, count, gdop as given by positioning.visibility
+        tow, lat, long, alt = trajectory
+        return positioning.visibility(self.get_almanach(week), tow, lat, long, alt, elevation_mask)
+
+    def get_latest(self, progress=None):
+        # Downloads the latest observation file into latest
+        # Input:
+        # progress: function called with (bytes received, size of the file) after each chunk
+        # Return:
+        # size of the file
+        return self.download('latest.obs', self.latest, progress=progress)
@@ -1,3 +1,11 @@
 from GNSSTools.devices.Spectracom import Spectracom
 from GNSSTools.devices.ublox import Ublox
 from GNSSTools.devices.device import Device
+from GNSSTools.devices.capture import Capture, CaptureManager, TelemetryLogger
+from GNSSTools.devices.segments import RotatingWriter
+from GNSSTools.devices.container import ContainerReader, ContainerWriter
+from GNSSTools.devices.replay import ReplaySerial
+from GNSSTools.devices.logpoller import LogPoller
+from GNSSTools.devices.visaworker import VisaWorker
+from GNSSTools.devices.waypoint import WaypointPlanner
+from GNSSTools.devices.simulator import SimulatedSpectracom, SimulatorServer
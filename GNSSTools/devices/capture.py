@@ -0,0 +1,319 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Acquisition of the data coming from a Ublox receiver: a reader thread empties the serial port by large
+# chunks, splits them into messages and sends the scheduled polls, a writer thread stores the messages into the
+# raw data file. CaptureManager acquires several receivers with a single thread
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import binascii
+import json
+import os
+import queue
+import selectors
+import threading
+import time
+from GNSSTools.devices import ubx
+
+
+class Capture:
+
+    def __init__(self, device, file, queuesize=1024, listeners=(), poller=None, source=0):
+        # Input:
+        # device: serial port of the receiver (serial.Serial or any object with in_waiting and read)
+        # file: file opened in binary mode where the data are written, in the format of Ublox.store_data, or a
+        #       container.ContainerWriter, which also stores the time of arrival of the messages
+        # queuesize: number of chunks of messages waiting for the writer before the reader blocks
+        # listeners: functions called by the reader thread with each list of messages, they must not block
+        # poller: ubx.PollScheduler whose polls are written by the reader thread, or None
+        # source: id of the device in a container
+        self.device = device
+        self.file = file
+        self.listeners = list(listeners)
+        self.poller = poller
+        self.source = source
+        self.framer = ubx.Framer()
+        self.queue = queue.Queue(queuesize)
+        self.running = threading.Event()
+        self.reader = None
+        self.writer = None
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.started = None
+        # counters of the messages, by class and id for UBX and by address for NMEA
+        self.frames = {}
+        self.lock = threading.Lock()
+        self.writer_lag = 0.0
+        self.max_writer_lag = 0.0
+
+    def start(self):
+        # Launches the reader and writer threads
+        self.running.set()
+        self.started = time.monotonic()
+        self.reader = threading.Thread(target=self.read, name='ublox-reader', daemon=True)
+        self.writer = threading.Thread(target=self.write, name='ublox-writer', daemon=True)
+        self.writer.start()
+        self.reader.start()
+        return self
+
+    def stop(self):
+        # Stops reading, waits until every message read has been written and flushes the file
+        self.running.clear()
+        if self.reader is not None:
+            self.reader.join()
+            self.queue.put(None)
+            self.writer.join()
+        self.file.flush()
+
+    def read(self):
+        # Reader thread: reads everything waiting on the port in one call, or waits up to the port timeout for
+        # the next byte when nothing is waiting
+        while self.running.is_set():
+            self.tick(time.monotonic())
+            data = self.device.read(self.device.in_waiting or 1)
+            stamp = time.monotonic_ns()
+            frames = self.receive(data)
+            if frames:
+                self.queue.put((stamp, frames))
+
+    def write(self):
+        # Writer thread: writes each chunk of messages with a single call
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.store(*item)
+
+    def tick(self, now):
+        # Sends the polls due
+        if self.poller is not None:
+            polls = self.poller.due(now)
+            if polls:
+                self.device.write(polls)
+
+    def receive(self, data):
+        # Splits the bytes read into messages and gives them to the listeners
+        # Return:
+        # the complete messages
+        if not data:
+            return []
+        self.bytes_read += len(data)
+        frames = self.framer.feed(data)
+        if frames:
+            with self.lock:
+                for kind, frame in frames:
+                    key = frame[2] << 8 | frame[3] if kind == 'UBX' else frame[1:frame.find(b',')]
+                    self.frames[key] = self.frames.get(key, 0) + 1
+            for listener in self.listeners:
+                listener(frames)
+        return frames
+
+    def store(self, stamp, frames):
+        # Writes messages into the file
+        # Input:
+        # stamp: time.monotonic_ns() of their arrival
+        # frames: list of messages given by receive
+        if hasattr(self.file, 'write_frames'):
+            self.bytes_written += self.file.write_frames(frames, self.source, stamp)
+        else:
+            data = b''.join(self.format(kind, frame) for kind, frame in frames)
+            self.file.write(data)
+            self.bytes_written += len(data)
+        self.writer_lag = (time.monotonic_ns() - stamp) / 1e9
+        self.max_writer_lag = max(self.max_writer_lag, self.writer_lag)
+
+    def throughput(self):
+        # Return:
+        # mean number of bytes read per second since the start
+        if self.started is None:
+            return 0.0
+        return self.bytes_read / max(time.monotonic() - self.started, 1e-9)
+
+    def utilization(self, rate=None):
+        # Share of the serial link used by the receiver output
+        # Input:
+        # rate: bytes read per second, the throughput since the start by default
+        # Return:
+        # rate times bits per character (start, data, parity and stop bits) over the baud rate of the port, 1.0
+        # being saturated, None if the port has no baud rate
+        baudrate = getattr(self.device, 'baudrate', None)
+        if not baudrate:
+            return None
+        if rate is None:
+            rate = self.throughput()
+        bits = 1 + getattr(self.device, 'bytesize', 8) + getattr(self.device, 'stopbits', 1) + \
+            (getattr(self.device, 'parity', 'N') != 'N')
+        return rate * bits / baudrate
+
+    def snapshot(self, previous=None):
+        # State of the acquisition
+        # Input:
+        # previous: snapshot the rate is measured from, the start by default
+        # Return:
+        # dictionary of:
+        #   elapsed: time since the start in seconds
+        #   bytes_read, bytes_written: bytes since the start
+        #   frames: {'UBX 02-10': count, 'NMEA GPGGA': count...}
+        #   checksum_failures, resyncs: errors of the framing
+        #   queue_depth: chunks of messages waiting for the writer
+        #   writer_lag, max_writer_lag: time between the arrival of the last (the slowest) message and its writing
+        #   rate: bytes read per second since previous
+        #   utilization: share of the link used by rate, see utilization
+        elapsed = time.monotonic() - self.started if self.started is not None else 0.0
+        with self.lock:
+            frames = dict(self.frames)
+        counts = {}
+        for key, count in frames.items():
+            if isinstance(key, int):
+                name = 'UBX %02X-%02X' % (key >> 8, key & 0xff)
+            else:
+                name = 'NMEA ' + key.decode('latin1')
+            counts[name] = counts.get(name, 0) + count
+        previous = previous or {'elapsed': 0.0, 'bytes_read': 0}
+        rate = (self.bytes_read - previous['bytes_read']) / max(elapsed - previous['elapsed'], 1e-9)
+        return {'elapsed': elapsed, 'bytes_read': self.bytes_read, 'bytes_written': self.bytes_written,
+                'frames': counts, 'checksum_failures': self.framer.checksum_failures,
+                'resyncs': self.framer.resyncs, 'queue_depth': self.queue.qsize(), 'writer_lag': self.writer_lag,
+                'max_writer_lag': self.max_writer_lag, 'rate': rate, 'utilization': self.utilization(rate)}
+
+    @staticmethod
+    def format(kind, frame):
+        # UBX messages are stored in hexadecimal and NMEA sentences as they are, like Ublox.store_data does. A
+        # UBX message ends with a new line, so that the NMEA sentence following it starts a line of its own.
+        if kind == 'UBX':
+            return binascii.hexlify(frame) + b'\n'
+        return frame
+
+
+class CaptureManager:
+    # Acquisition of several receivers by a single thread. Each receiver keeps its own Capture (framing, listeners,
+    # polls and file), the thread reading the ports which have data and writing the messages at once. On POSIX
+    # the ports are watched with a selector, otherwise, as on Windows where serial ports can not be selected,
+    # they are polled every interval seconds while no data comes.
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.captures = {}
+        # receivers whose acknowledgements are read by the manager
+        self.ubloxes = []
+        # set by stop, waited for while the ports are idle
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add(self, ublox, file, name=None):
+        # Input:
+        # ublox: Ublox receiver, its acknowledgements and scheduled polls being handled by the manager
+        # file: where its data are written, see Capture
+        # name: name of the receiver in the reports, its port by default
+        # Return:
+        # the Capture of the receiver
+        capture = Capture(ublox.device, file, listeners=[ublox.tracker.feed], poller=ublox.poller,
+                          source=len(self.captures))
+        ublox.acquisition = capture
+        self.ubloxes.append(ublox)
+        self.captures[name or ublox.com] = capture
+        return capture
+
+    def start(self):
+        self.stopped.clear()
+        for capture in self.captures.values():
+            capture.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name='capture-manager', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Stops the acquisition, the receivers reading their acknowledgements themselves again
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        for capture in self.captures.values():
+            capture.file.flush()
+        for ublox in self.ubloxes:
+            if ublox.acquisition in self.captures.values():
+                ublox.acquisition = None
+
+    def run(self):
+        captures = list(self.captures.values())
+        selector = None
+        if os.name != 'nt' and all(hasattr(capture.device, 'fileno') for capture in captures):
+            selector = selectors.DefaultSelector()
+            for capture in captures:
+                selector.register(capture.device.fileno(), selectors.EVENT_READ, capture)
+        while not self.stopped.is_set():
+            now = time.monotonic()
+            for capture in captures:
+                capture.tick(now)
+            if selector is not None:
+                ready = [key.data for key, _ in selector.select(self.interval)]
+            else:
+                ready = captures
+            idle = True
+            for capture in ready:
+                waiting = capture.device.in_waiting
+                if waiting:
+                    idle = False
+                    data = capture.device.read(waiting)
+                    frames = capture.receive(data)
+                    if frames:
+                        capture.store(time.monotonic_ns(), frames)
+            if idle and selector is None:
+                self.stopped.wait(self.interval)
+        if selector is not None:
+            selector.close()
+
+    def throughput(self):
+        # Return:
+        # dictionary {name: mean number of bytes read per second}
+        return {name: capture.throughput() for name, capture in self.captures.items()}
+
+    def snapshot(self, previous=None):
+        # Input:
+        # previous: snapshot the rates are measured from, the start by default
+        # Return:
+        # dictionary {name: Capture.snapshot()}
+        previous = previous or {}
+        return {name: capture.snapshot(previous.get(name)) for name, capture in self.captures.items()}
+
+
+class TelemetryLogger:
+    # Writes the snapshot of a Capture or a CaptureManager as a JSON line every interval seconds, its rates being
+    # measured since the previous line
+
+    def __init__(self, source, file, interval=10):
+        # Input:
+        # source: object with a snapshot method taking the previous snapshot
+        # file: file opened in text mode
+        # interval: time between two lines in seconds
+        self.source = source
+        self.file = file
+        self.interval = interval
+        # set by stop, waited for between two lines
+        self.stopped = threading.Event()
+        self.thread = None
+        # snapshot of the last line
+        self.last = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='telemetry', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # Stops the logger after writing a last line
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.log()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.log()
+
+    def log(self):
+        self.last = self.source.snapshot(self.last)
+        self.file.write(json.dumps(dict(time=time.time(), **self.last)) + '\n')
+        self.file.flush()
@@ -0,0 +1,161 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Binary container for captures: each message is stored with the monotonic time of its arrival on the host and
+# the id of the device it comes from, and an index written at the end gives random access to the messages
+#
+# File layout:
+#   MAGIC
+#   records: length (u4), timestamp in ns (u8), source id (u2), message bytes
+#   index: offset (u8) of each record
+#   footer: index offset (u8), number of records (u8), INDEX_MAGIC
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import array
+import mmap
+import os
+import struct
+import threading
+import time
+import numpy as np
+from GNSSTools.devices import ubx
+from GNSSTools.devices.capture import Capture
+
+MAGIC = b'GNSSCAP1'
+INDEX_MAGIC = b'GNSSIDX1'
+RECORD = struct.Struct('<IQH')
+FOOTER = struct.Struct('<QQ8s')
+EXTENSION = '.gcap'
+
+
+class ContainerWriter:
+    # File-like object to give to Capture: the capture gives the messages and their time of arrival to
+    # write_frames. Several sources can write into the same container from different threads.
+
+    def __init__(self, filename, buffersize=1 << 20):
+        self.filename = filename
+        self.file = open(filename, 'wb', buffering=buffersize)
+        self.file.write(MAGIC)
+        self.position = len(MAGIC)
+        self.offsets = array.array('Q')
+        self.lock = threading.Lock()
+
+    def write_frames(self, frames, source=0, timestamp=None):
+        # Input:
+        # frames: list of ('UBX', message) or ('NMEA', sentence) tuples, as given by ubx.Framer.feed
+        # source: id of the device
+        # timestamp: time.monotonic_ns() of the arrival of the messages, now by default
+        # Return:
+        # number of bytes written
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        with self.lock:
+            chunks = []
+            position = self.position
+            for _, frame in frames:
+                self.offsets.append(position)
+                chunks.append(RECORD.pack(len(frame), timestamp, source))
+                chunks.append(frame)
+                position += RECORD.size + len(frame)
+            data = b''.join(chunks)
+            self.file.write(data)
+            self.position = position
+        return len(data)
+
+    def write(self, data, source=0):
+        # Stores bytes already split into messages by the caller as one record
+        return self.write_frames([(None, data)], source)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        # Writes the index and the footer
+        with self.lock:
+            self.file.write(self.offsets.tobytes())
+            self.file.write(FOOTER.pack(self.position, len(self.offsets), INDEX_MAGIC))
+            self.file.close()
+
+
+class ContainerReader:
+    # Random access to the records of a container. A container whose writer was not closed has no index: it is
+    # rebuilt by reading the records one after the other, the last incomplete one being ignored.
+
+    def __init__(self, filename, start=0):
+        # Input:
+        # filename: container file
+        # start: position in the file of the first record to read, the records before it being left out
+        self.filename = filename
+        self.start = max(start, len(MAGIC))
+        file = open(filename, 'rb')
+        size = os.fstat(file.fileno()).st_size
+        self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        file.close()
+        if self.data[0:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a capture container')
+        self.offsets = self.index()
+
+    def index(self):
+        data = self.data
+        if len(data) >= len(MAGIC) + FOOTER.size:
+            end, count, magic = FOOTER.unpack_from(data, len(data) - FOOTER.size)
+            if magic == INDEX_MAGIC and end + 8 * count + FOOTER.size == len(data):
+                offsets = np.frombuffer(data, dtype='<u8', count=count, offset=end)
+                return offsets[np.searchsorted(offsets, self.start):]
+        offsets = array.array('Q')
+        position = self.start
+        while position + RECORD.size <= len(data):
+            length = RECORD.unpack_from(data, position)[0]
+            if position + RECORD.size + length > len(data):
+                break
+            offsets.append(position)
+            position += RECORD.size + length
+        return np.frombuffer(offsets, dtype='<u8')
+
+    def end(self):
+        # Return:
+        # position in the file after the last complete record read
+        if len(self.offsets) == 0:
+            return self.start
+        position = int(self.offsets[-1])
+        return position + RECORD.size + RECORD.unpack_from(self.data, position)[0]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        # Return:
+        # (timestamp in ns, source id, message bytes) of the record i
+        position = int(self.offsets[i])
+        length, timestamp, source = RECORD.unpack_from(self.data, position)
+        start = position + RECORD.size
+        return timestamp, source, bytes(self.data[start:start + length])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def timestamps(self):
+        # Return:
+        # array of the arrival times of all the records in ns
+        return np.array([RECORD.unpack_from(self.data, int(position))[1] for position in self.offsets],
+                        dtype='<u8')
+
+    def raw(self, source=None):
+        # Converts the records into the format of Ublox.store_data, readable by miseenforme and the decoders
+        # Input:
+        # source: only keep the records of this source, all of them by default
+        # Return:
+        # the raw data bytes
+        chunks = []
+        for _, origin, frame in self:
+            if source is None or origin == source:
+                chunks.append(Capture.format('UBX' if frame[0:2] == ubx.SYNC else 'NMEA', frame))
+        return b''.join(chunks)
+
+    def close(self):
+        self.offsets = None
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
@@ -0,0 +1,136 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Polling of the NMEA output of the Spectracom (SOURce:SCENario:LOG?) at the rate of the generator output. Each
+# answer holds the sentences of the last epoch, which are only stored the first time they are read.
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import collections
+import math
+import time
+from GNSSTools.devices.visaworker import LOGGING
+
+# position of the time field in the sentences giving it
+TIME_FIELDS = {'RMC': 1, 'GGA': 1, 'GLL': 5, 'ZDA': 1, 'GBS': 1, 'GST': 1}
+
+
+def epoch(line):
+    # Return:
+    # time of the sentence, None if the sentence has no time
+    field = TIME_FIELDS.get(line[3:6])
+    if field is None:
+        return None
+    split = line.split(',')
+    if len(split) <= field or split[field] == '':
+        return None
+    return split[field]
+
+
+class LogPoller:
+    # The queries are scheduled on a grid of the monotonic clock: a late query does not shift the following ones
+    # and the periods missed are skipped rather than caught up.
+
+    def __init__(self, spectracom, savefile, rate=1.0, offset=0.0, history=16):
+        # Input:
+        # spectracom: Spectracom generator
+        # savefile: file opened in text mode where the sentences are stored
+        # rate: output rate of the generator in Hz, one query per output epoch
+        # offset: delay of the queries after the start of each period, in seconds
+        # history: number of epochs remembered to find the sentences already stored
+        self.spectracom = spectracom
+        self.savefile = savefile
+        self.period = 1.0 / rate
+        self.offset = offset
+        self.history = history
+        # sentences stored for each of the last epochs
+        self.seen = collections.OrderedDict()
+        self.start = None
+        # last answer of the generator
+        self.last = ''
+        self.polls = 0
+        self.epochs = 0
+        self.duplicates = 0
+        self.late = [0, 0.0, 0.0, 0.0]  # count, sum, sum of squares, maximum
+
+    def poll(self):
+        # Queries the log once and stores the sentences not stored yet
+        # Return:
+        # the answer of the generator
+        if self.start is None:
+            self.start = time.monotonic()
+        data = self.spectracom.ask('SOURce:SCENario:LOG?', LOGGING)
+        self.polls += 1
+        self.last = data
+        self.store(data)
+        return data
+
+    def store(self, data):
+        # Writes the sentences of the answer which were not written yet, the sentences without time (GSV...)
+        # belonging to the epoch of the previous one, or of the first timed one when they start the answer. The
+        # sentences of an answer without time are all written, their epoch being unknown.
+        lines = [line for line in data.splitlines(True) if line.strip()]
+        current = next((epoch(line) for line in lines if epoch(line) is not None), None)
+        new = []
+        for line in lines:
+            current = epoch(line) or current
+            if current is None:
+                new.append(line)
+                continue
+            sentences = self.seen.get(current)
+            if sentences is None:
+                sentences = self.seen[current] = set()
+                self.epochs += 1
+                if len(self.seen) > self.history:
+                    self.seen.popitem(last=False)
+            if line in sentences:
+                self.duplicates += 1
+            else:
+                sentences.add(line)
+                new.append(line)
+        if new:
+            self.savefile.write(''.join(new))
+
+    def run(self, duration=None):
+        # Polls once per period
+        # Input:
+        # duration: time to poll for in seconds, None to poll forever
+        begin = time.monotonic()
+        if self.start is None:
+            self.start = begin
+        k = math.ceil((begin - self.start - self.offset) / self.period)
+        while True:
+            deadline = self.start + self.offset + k * self.period
+            # a period ending exactly with the duration is not polled, whatever the rounding of the clock
+            if duration is not None and deadline - begin >= duration - 1e-9:
+                wait = begin + duration - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                break
+            wait = deadline - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            late = time.monotonic() - deadline
+            self.late[0] += 1
+            self.late[1] += late
+            self.late[2] += late * late
+            self.late[3] = max(self.late[3], late)
+            self.poll()
+            k = max(k + 1, math.floor((time.monotonic() - self.start - self.offset) / self.period) + 1)
+
+    def stats(self):
+        # Return:
+        # dictionary of:
+        #   polls, epochs, duplicates: number of queries, of epochs stored and of sentences read again
+        #   poll_rate, epoch_rate: queries and epochs per second since the first query
+        #   lateness, jitter, max_lateness: mean, standard deviation and maximum of the delay of the scheduled
+        #                                   queries, in seconds
+        elapsed = max(time.monotonic() - self.start, 1e-9) if self.start is not None else 0.0
+        count, total, squares, maximum = self.late
+        mean = total / count if count else 0.0
+        jitter = math.sqrt(max(squares / count - mean * mean, 0.0)) if count else 0.0
+        return {'polls': self.polls, 'epochs': self.epochs, 'duplicates': self.duplicates,
+                'poll_rate': self.polls / elapsed if elapsed else 0.0,
+                'epoch_rate': self.epochs / elapsed if elapsed else 0.0,
+                'lateness': mean, 'jitter': jitter, 'max_lateness': maximum}
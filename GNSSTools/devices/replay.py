@@ -0,0 +1,190 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Replay of recorded receiver data: ReplaySerial can be given to Ublox instead of the serial port to run the
+# acquisition without the receiver, in real time, faster or as fast as possible, with corrupted bytes if wanted
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import binascii
+import random
+import re
+import time
+import numpy as np
+from GNSSTools.devices.container import EXTENSION, ContainerReader
+
+HEX = re.compile('[0-9a-f]*')
+
+
+def log_stream(filename):
+    # Rebuilds the bytes sent by the receiver from a processed data file (miseenforme output, data/database logs):
+    # UBX messages and NMEA sentences which were hexlified with them are decoded back, the lines cut by
+    # miseenforme are joined back
+    # Return:
+    # the byte stream
+    out = []
+    group = []
+
+    def decode():
+        if group:
+            text = ''.join(group)
+            del group[:]
+            data = binascii.unhexlify(text[:len(text) // 2 * 2])
+            # miseenforme drops the end of line of an hexlified NMEA sentence followed by a plain one
+            if data[:1] == b'$' and data[-1:] != b'\n':
+                data += b'\r\n'
+            out.append(data)
+
+    for line in open(filename):
+        line = line.rstrip('\r\n')
+        dollar = line.find('$')
+        head = line if dollar < 0 else line[:dollar]
+        if head and not HEX.fullmatch(head):
+            # end of a NMEA sentence cut before '2447'
+            decode()
+            if out and out[-1][:1] == b'$':
+                out[-1] = out[-1][:-2] + line.encode() + b'\r\n'
+            continue
+        if head:
+            if head[0:4] in ('b562', '2447'):
+                decode()
+            group.append(head)
+        if dollar >= 0:
+            decode()
+            out.append(line[dollar:].encode() + b'\r\n')
+    decode()
+    return b''.join(out)
+
+
+class ReplaySerial:
+    # Stand-in for the serial.Serial object of Ublox. The bytes become available to read at the pace of the
+    # recording: arrival times of a capture container, or the baud rate for the other recordings.
+
+    def __init__(self, source, speed=1.0, baudrate=4800, timeout=1, corruption=0.0, seed=None, loop=False,
+                 clock=time.monotonic):
+        # Input:
+        # source: capture container (.gcap), processed data file or bytes
+        # speed: 1 for real time, N for N times faster, None for as fast as possible
+        # baudrate: rate of the replayed link, used to pace recordings without arrival times
+        # timeout: longest time a read waits for data in seconds
+        # corruption: probability for each byte read to have one bit flipped
+        # seed: seed of the corruption, to replay the same errors
+        # loop: start the recording again once finished, with the same corruption for a given seed
+        # clock: function giving the time in seconds the pace is measured with
+        self.timing = None
+        if isinstance(source, bytes):
+            self.data = source
+        elif source.endswith(EXTENSION):
+            container = ContainerReader(source)
+            frames = list(container)
+            container.close()
+            self.data = b''.join(frame for _, _, frame in frames)
+            stamps = np.array([stamp for stamp, _, _ in frames], dtype=np.int64)
+            # bytes available at the arrival time of each record, in seconds from the first one
+            self.timing = ((stamps - stamps[0]) / 1e9 if len(stamps) else stamps,
+                           np.cumsum([len(frame) for _, _, frame in frames]))
+        else:
+            self.data = log_stream(source)
+        self.speed = speed
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.corruption = corruption
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.loop = loop
+        self.clock = clock
+        self.position = 0
+        self.written = []
+        self.is_open = True
+        self.start = clock()
+        # position in the recording of the next corrupted byte
+        self.next_corruption = self.corruption_gap() if corruption else None
+
+    def corruption_gap(self):
+        return int(self.random.expovariate(self.corruption))
+
+    def corrupt(self, end, data=None):
+        # Draws the corruptions scheduled up to the position end, flipping their bit in data, the bytes of the
+        # recording from the current position. The corrupted positions do not depend on how the recording is read.
+        while self.next_corruption is not None and self.next_corruption < end:
+            bit = 1 << self.random.randrange(8)
+            if data is not None:
+                data[self.next_corruption - self.position] ^= bit
+            self.next_corruption += 1 + self.corruption_gap()
+
+    def available(self, now=None):
+        # Return:
+        # number of bytes of the recording which have arrived
+        if self.speed is None:
+            return len(self.data)
+        elapsed = ((self.clock() if now is None else now) - self.start) * self.speed
+        if self.timing is None:
+            # start bit, 8 data bits and stop bit
+            return min(int(elapsed * self.baudrate / 10), len(self.data))
+        times, ends = self.timing
+        count = np.searchsorted(times, elapsed, side='right')
+        return int(ends[count - 1]) if count else 0
+
+    def arrival(self, position):
+        # Return:
+        # time when the byte at position arrives
+        if self.timing is None:
+            return self.start + (position + 1) * 10 / self.baudrate / self.speed
+        times, ends = self.timing
+        return self.start + times[np.searchsorted(ends, position, side='right')] / self.speed
+
+    @property
+    def in_waiting(self):
+        return self.available() - self.position
+
+    def read(self, size=1):
+        if self.position >= len(self.data) and self.loop:
+            self.position = 0
+            self.start = self.clock()
+            self.random.seed(self.seed)
+            self.next_corruption = self.corruption_gap() if self.corruption else None
+        if self.position >= len(self.data):
+            if self.timeout:
+                time.sleep(self.timeout)
+            return b''
+        if self.in_waiting <= 0:
+            wait = self.arrival(self.position) - self.clock()
+            if self.timeout is not None and wait > self.timeout:
+                time.sleep(self.timeout)
+                return b''
+            time.sleep(max(wait, 0))
+        end = min(self.position + size, self.available())
+        data = self.data[self.position:end]
+        if self.next_corruption is not None and self.next_corruption < end:
+            data = bytearray(data)
+            self.corrupt(end, data)
+            data = bytes(data)
+        self.position = end
+        return data
+
+    def readline(self):
+        line = b''
+        while line[-1:] != b'\n':
+            data = self.read(1)
+            if not data:
+                break
+            line += data
+        return line
+
+    def write(self, data):
+        # The commands are kept in written, the recording does not answer them
+        self.written.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        # The corruptions of the bytes dropped are drawn all the same
+        end = max(self.position, self.available())
+        self.corrupt(end)
+        self.position = end
+
+    def close(self):
+        self.is_open = False
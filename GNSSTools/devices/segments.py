@@ -0,0 +1,204 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Raw data files of long acquisitions: the data are written by large buffers into segments rotated by size or
+# duration, the closed segments are compressed in the background and a manifest lists them in order so that
+# the whole set can be read back as one continuous stream
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import gzip
+import io
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+from GNSSTools.devices.container import EXTENSION, ContainerReader
+
+MANIFEST = '_manifest.json'
+
+
+def read_manifest(manifest):
+    # Return:
+    # list of the segments, each one a dictionary {'name', 'start', 'end', 'bytes', 'compressed'}
+    with open(manifest) as file:
+        return json.load(file)
+
+
+def open_raw(filename):
+    # Opens a raw data file in binary mode. The set of segments of a manifest is read as a single file, and a
+    # capture container as the raw data file store_data would have written.
+    if filename.endswith(MANIFEST):
+        return io.BufferedReader(SegmentStream(filename), 1 << 20)
+    if filename.endswith(EXTENSION):
+        container = ContainerReader(filename)
+        data = container.raw()
+        container.close()
+        return io.BytesIO(data)
+    return open(filename, 'rb')
+
+
+class RotatingWriter:
+    # File-like object to give to Capture instead of an open file. A segment is only rotated between two writes,
+    # so that a message written in one call is never split over two segments.
+
+    def __init__(self, directory, prefix='ublox_raw_data', max_bytes=64 << 20, max_seconds=3600,
+                 buffersize=1 << 20, compress=True):
+        # Input:
+        # directory: where the segments and the manifest are written
+        # prefix: name of the segments, prefix_0000.txt, prefix_0001.txt... and of the manifest prefix_manifest.json
+        # max_bytes: size of a segment before rotation
+        # max_seconds: duration of a segment before rotation
+        # buffersize: size of the write buffer in bytes
+        # compress: gzip the closed segments
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.buffersize = buffersize
+        self.manifest = os.path.join(directory, prefix + MANIFEST)
+        self.segments = []
+        self.lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self.opened = None
+        self.compressor = None
+        if compress:
+            self.queue = queue.Queue()
+            self.compressor = threading.Thread(target=self.compress, name='segment-compressor', daemon=True)
+            self.compressor.start()
+        self.rotate()
+
+    def write(self, data):
+        if self.size >= self.max_bytes or time.monotonic() - self.opened >= self.max_seconds:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        # Closes the last segment and waits until all the segments are compressed
+        self.close_segment()
+        if self.compressor is not None:
+            self.queue.put(None)
+            self.compressor.join()
+
+    def rotate(self):
+        # Closes the current segment and opens the next one
+        self.close_segment()
+        name = '%s_%04d.txt' % (self.prefix, len(self.segments))
+        self.file = open(os.path.join(self.directory, name), 'wb', buffering=self.buffersize)
+        self.size = 0
+        self.opened = time.monotonic()
+        with self.lock:
+            self.segments.append({'name': name, 'start': time.time(), 'end': None, 'bytes': None,
+                                  'compressed': False})
+            self.save()
+
+    def close_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        with self.lock:
+            segment = self.segments[-1]
+            segment['end'] = time.time()
+            segment['bytes'] = self.size
+            self.save()
+        if self.compressor is not None:
+            self.queue.put(segment)
+
+    def save(self):
+        # Rewrites the manifest, replacing the previous one in a single step
+        temporary = self.manifest + '.tmp'
+        with open(temporary, 'w') as file:
+            json.dump(self.segments, file, indent=1)
+        os.replace(temporary, self.manifest)
+
+    def compress(self):
+        # Compressor thread
+        while True:
+            segment = self.queue.get()
+            if segment is None:
+                break
+            path = os.path.join(self.directory, segment['name'])
+            with open(path, 'rb') as source, gzip.open(path + '.gz.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target, 1 << 20)
+            os.replace(path + '.gz.tmp', path + '.gz')
+            with self.lock:
+                segment['compressed'] = True
+                self.save()
+            os.remove(path)
+
+
+class SegmentStream(io.RawIOBase):
+    # The segments listed in a manifest read as a single file. The last segment may still be written: its size is
+    # the one of the file when it is reached.
+
+    def __init__(self, manifest):
+        self.directory = os.path.dirname(manifest)
+        self.segments = read_manifest(manifest)
+        self.index = 0
+        self.position = 0
+        self.file = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def open_segment(self, index):
+        segment = self.segments[index]
+        path = os.path.join(self.directory, segment['name'])
+        if segment['compressed'] or not os.path.exists(path):
+            return gzip.open(path + '.gz', 'rb')
+        return open(path, 'rb')
+
+    def readinto(self, buffer):
+        while self.index < len(self.segments):
+            if self.file is None:
+                self.file = self.open_segment(self.index)
+            count = self.file.readinto(buffer)
+            if count:
+                self.position += count
+                return count
+            if self.index == len(self.segments) - 1:
+                return 0
+            self.file.close()
+            self.file = None
+            self.index += 1
+        return 0
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence != io.SEEK_SET:
+            raise ValueError('Only absolute positions are supported')
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        start = 0
+        for index, segment in enumerate(self.segments):
+            size = segment['bytes']
+            if size is None or start + size > offset or index == len(self.segments) - 1:
+                self.index = index
+                self.file = self.open_segment(index)
+                self.file.seek(offset - start)
+                break
+            start += size
+        self.position = offset
+        return offset
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        super(SegmentStream, self).close()
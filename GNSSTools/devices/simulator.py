@@ -0,0 +1,341 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Simulated Spectracom to run the scenarios without the generator: SimulatedSpectracom can be given to Spectracom
+# as its resource, and SimulatorServer makes it reachable as a SCPI socket instrument (TCPIP::host::port::SOCKET).
+# The vehicle moves from its heading, speed and acceleration while the scenario runs, or follows the NMEA
+# trajectory of a loaded scenario file, and SOURce:SCENario:LOG? answers the GGA, RMC and GSV sentences of the last
+# output epoch.
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import bisect
+import datetime
+import math
+import re
+import socketserver
+import threading
+import time
+from GNSSTools import tools
+from GNSSTools.devices.transfer import block
+
+# satellites in view: (id, elevation, azimuth)
+SATELLITES = ((2, 67, 52), (5, 45, 90), (9, 22, 301), (12, 38, 208), (15, 71, 163), (21, 12, 27), (25, 30, 128),
+              (29, 55, 248))
+# longest step of the motion integration in seconds
+STEP = 0.1
+
+
+class SimulatedSpectracom:
+    # Stand-in for the pyvisa resource of the Spectracom. The settings without effect on the motion are kept and
+    # answered back as they were written.
+
+    def __init__(self, lat=0.0, long=0.0, alt=0.0, rate=1.0, latency=0.0, files=None, clock=time.monotonic):
+        # Input:
+        # lat, long, alt: position of the vehicle in decimal degrees and m
+        # rate: output rate of the NMEA sentences in Hz
+        # latency: time taken by the instrument to handle each message in seconds
+        # files: dictionary {name: content} of the files answered to MMEMory:DATA? as blocks
+        # clock: time source in seconds
+        self.start_position = (lat, long, alt)
+        self.rate = rate
+        self.latency = latency
+        self.files = files or {}
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.written = 0
+        self.queried = 0
+        # answers of the queries sent by write, read by read_bytes
+        self.answer = bytearray()
+        self.reset()
+
+    def reset(self):
+        self.lat, self.long, self.alt = self.start_position
+        self.heading = self.speed = self.acceleration = self.rateheading = self.vspeed = 0.0
+        self.settings = {}
+        self.date = datetime.datetime(2001, 1, 1)
+        self.running = False
+        # scenario time in seconds of the state and of the log
+        self.time = 0.0
+        self.started = None
+        self.log = (None, '')
+        # (times, positions) of the trajectory of the loaded scenario, None when the vehicle is driven by commands
+        self.trajectory = None
+
+    def elapsed(self):
+        # Return:
+        # scenario time of now in seconds
+        if self.started is None:
+            return self.time
+        return self.clock() - self.started
+
+    def advance(self, until):
+        # Moves the vehicle up to the scenario time until
+        if self.trajectory is not None:
+            self.follow(until)
+        while self.time < until:
+            dt = min(STEP, until - self.time)
+            speed = max(self.speed + self.acceleration * dt, 0.0)
+            distance = (self.speed + speed) / 2 * dt
+            self.lat, self.long = tools.destination(self.lat, self.long, self.heading, distance)
+            self.alt += self.vspeed * dt
+            self.heading = (self.heading + self.rateheading * dt) % 360
+            self.speed = speed
+            self.time += dt
+
+    def follow(self, until):
+        # Moves the vehicle along the trajectory, linearly between its positions
+        times, positions = self.trajectory
+        i = min(max(bisect.bisect_right(times, until) - 1, 0), len(times) - 1)
+        j = min(i + 1, len(times) - 1)
+        ratio = (until - times[i]) / (times[j] - times[i]) if j > i else 0.0
+        ratio = min(max(ratio, 0.0), 1.0)
+        self.lat, self.long, self.alt, self.speed = (a + (b - a) * ratio for a, b in
+                                                     zip(positions[i][:4], positions[j][:4]))
+        self.heading = positions[i][4]
+        self.time = until
+
+    def load(self, name):
+        # Loads a scenario file: its trajectory= line names the NMEA trajectory followed once started
+        self.trajectory = None
+        for line in self.files.get(name, '').splitlines():
+            key, _, value = line.partition('=')
+            if key.strip().lower() == 'trajectory':
+                times, positions = [], []
+                speed = heading = 0.0
+                for sentence in self.files.get(value.strip(), '').splitlines():
+                    split = sentence.split(',')
+                    if sentence[3:6] == 'RMC' and len(split) > 8:
+                        speed, heading = float(split[7]) * 1852 / 3600, float(split[8])
+                        if positions:
+                            positions[-1] = positions[-1][:3] + (speed, heading)
+                    position = tools.gga_position(sentence)
+                    if position is not None:
+                        stamp = int(position.time[0:2]) * 3600 + int(position.time[2:4]) * 60 + \
+                            float(position.time[4:])
+                        if not times:
+                            start = stamp
+                        elif stamp < start + times[-1]:
+                            # across midnight
+                            stamp += 86400
+                        times.append(stamp - start)
+                        positions.append((position.lat, position.long, position.alt, speed, heading))
+                if times:
+                    self.trajectory = (times, positions)
+                    self.lat, self.long, self.alt = positions[0][:3]
+
+    def store(self, message):
+        # MMEMory:DATA "name",#<digits><length><content>
+        name, _, block = message.partition(' ')[2].partition(',')
+        digits = int(block[1])
+        length = int(block[2:2 + digits])
+        self.files[name.strip().strip('"')] = block[2 + digits:2 + digits + length]
+
+    def write(self, message):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.written += 1
+            if message[:13].upper() == 'MMEMORY:DATA ':
+                # the block is sent as it is, with its ends of line
+                self.store(message)
+                return len(message) + 2
+            answers = [self.command(command.strip()) for command in re.split(';:?', message) if command.strip()]
+            answers = [answer for answer in answers if answer is not None]
+            if answers:
+                self.answer += (';'.join(answers) + '\n').encode()
+        return len(message) + 2
+
+    def read_bytes(self, count):
+        with self.lock:
+            if len(self.answer) < count:
+                raise TimeoutError('%d bytes asked, %d available' % (count, len(self.answer)))
+            data = bytes(self.answer[:count])
+            del self.answer[:count]
+        return data
+
+    def clear(self):
+        with self.lock:
+            self.answer.clear()
+
+    def query(self, message):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.queried += 1
+            commands = [command.strip() for command in re.split(';:?', message) if command.strip()]
+            answers = [self.command(command) for command in commands]
+        return ';'.join(answer for answer in answers if answer is not None)
+
+    def close(self):
+        pass
+
+    def command(self, command):
+        # Handles one SCPI command
+        # Return:
+        # the answer of a query, None for the other commands
+        header, _, value = command.partition(' ')
+        header = header.upper()
+        values = [field for field in re.split('[ ,]+', value.strip()) if field]
+        if values and values[0].upper() == 'IMM':
+            values = values[1:]
+        if header in ('SOURCE:SCENARIO:LOG?', 'SOURCE:SCENARIO:LOG'):
+            return self.output()
+        if header == '*IDN?':
+            return 'Spectracom,GSG-SIM,0,1.0'
+        if header == 'MMEMORY:DATA?':
+            return block(self.files.get(value.strip().strip('"'), ''))
+        # the motion follows the scenario up to now before being changed or read
+        if self.running:
+            self.advance(self.elapsed())
+        if header == '*RST':
+            self.reset()
+        elif header == 'SOURCE:SCENARIO:LOAD':
+            self.load(value.strip().strip('"'))
+        elif header == 'SOURCE:SCENARIO:CONTROL':
+            self.control(value.strip().upper())
+        elif header == 'SOURCE:SCENARIO:DATETIME':
+            for shape in ('%m-%d-%Y %H:%M:%S.%f', '%m-%d-%Y %H:%M:%S'):
+                try:
+                    self.date = datetime.datetime.strptime(' '.join(values), shape)
+                    break
+                except ValueError:
+                    pass
+        elif header == 'SOURCE:SCENARIO:POSITION':
+            self.lat, self.long, self.alt = (float(field) for field in values[:3])
+        elif header == 'SOURCE:SCENARIO:POSITION?':
+            return '%f,%f,%f' % (self.lat, self.long, self.alt)
+        elif header == 'SOURCE:SCENARIO:HEADING':
+            self.heading = float(values[0]) % 360
+        elif header == 'SOURCE:SCENARIO:HEADING?':
+            return '%f' % self.heading
+        elif header == 'SOURCE:SCENARIO:SPEED':
+            self.speed = float(values[0])
+        elif header == 'SOURCE:SCENARIO:SPEED?':
+            return '%f' % self.speed
+        elif header == 'SOURCE:SCENARIO:VELOCITY':
+            self.speed, self.heading = float(values[0]), float(values[1]) % 360
+        elif header == 'SOURCE:SCENARIO:VELOCITY?':
+            return '%f,%f' % (self.speed, self.heading)
+        elif header == 'SOURCE:SCENARIO:ACCELERATION':
+            self.acceleration = float(values[0])
+        elif header == 'SOURCE:SCENARIO:ACCELERATION?':
+            return '%f' % self.acceleration
+        elif header in ('SOURCE:SCENARIO:RATEHEADING', 'SOURCE:SCENARIO:TURNRATE'):
+            self.rateheading = float(values[0])
+        elif header in ('SOURCE:SCENARIO:RATEHEADING?', 'SOURCE:SCENARIO:TURNRATE?'):
+            return '%f' % self.rateheading
+        elif header == 'SOURCE:SCENARIO:VSPEED':
+            self.vspeed = float(values[0])
+        elif header == 'SOURCE:SCENARIO:VSPEED?':
+            return '%f' % self.vspeed
+        elif header.endswith('?'):
+            return self.settings.get(header[:-1], '0')
+        else:
+            self.settings[header] = ','.join(values)
+        return None
+
+    def control(self, control):
+        if control == 'START' and not self.running:
+            self.running = True
+            self.started = self.clock() - self.time
+        elif control in ('STOP', 'HOLD') and self.running:
+            self.running = False
+            self.time = self.elapsed()
+            self.started = None
+
+    def output(self):
+        # Return:
+        # the sentences of the last output epoch, the same ones until the next epoch
+        if not self.running:
+            return ''
+        epoch = math.floor(self.elapsed() * self.rate) / self.rate
+        if self.log[0] != epoch:
+            self.advance(epoch)
+            self.log = (epoch, self.sentences(self.date + datetime.timedelta(seconds=epoch)))
+        return self.log[1]
+
+    def sentences(self, date):
+        cno = int(float(self.settings.get('SOURCE:NOISE:CNO', '45') or 45))
+        lines = [tools.nmea_fix(date, self.lat, self.long, self.alt, self.speed, self.heading, len(SATELLITES))]
+        count = (len(SATELLITES) + 3) // 4
+        for i in range(count):
+            fields = ','.join('%02d,%02d,%03d,%02d' % (svid, elevation, azimuth, cno)
+                              for svid, elevation, azimuth in SATELLITES[4 * i:4 * i + 4])
+            lines.append(tools.nmea_sentence('GPGSV,%d,%d,%02d,%s' % (count, i + 1, len(SATELLITES), fields)))
+        return ''.join(lines)
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    # SCPI socket server of a SimulatedSpectracom: each message ends with a new line, the content of a definite
+    # length block being read by its length, and the answer of a query with termination. The NMEA sentences
+    # answered to LOG? having their own ends of line, the client reads until termination,
+    # open_resource(server.address, read_termination='\x04') with the default one.
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, instrument, host='127.0.0.1', port=0, termination='\x04'):
+        # Input:
+        # instrument: SimulatedSpectracom served
+        # host, port: address listened to, any free port when port is 0
+        # termination: end of the answers
+        self.instrument = instrument
+        self.termination = termination
+        super(SimulatorServer, self).__init__((host, port), SimulatorHandler)
+        self.thread = None
+
+    @property
+    def address(self):
+        # Return:
+        # the VISA resource name of the server
+        host, port = self.server_address[:2]
+        return 'TCPIP::%s::%d::SOCKET' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='spectracom-simulator', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class SimulatorHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if line[:13].upper() == b'MMEMORY:DATA ':
+                message = self.block(line)
+            else:
+                message = line.decode('ascii', 'replace').strip()
+            if not message:
+                continue
+            if '?' in message:
+                answer = self.server.instrument.query(message)
+                self.wfile.write((answer + self.server.termination).encode('ascii'))
+            else:
+                self.server.instrument.write(message)
+
+    def block(self, line):
+        # Reads the end of a message holding a definite length block, whose content may hold ends of line
+        # Input:
+        # line: first line of the message
+        # Return:
+        # the message up to the end of the block
+        start = line.find(b'#')
+        if start < 0 or not line[start + 1:start + 2].isdigit():
+            return line.decode('ascii', 'replace').strip()
+        end = start + 2 + int(line[start + 1:start + 2])
+        length = int(line[start + 2:end])
+        content = line[end:]
+        if len(content) < length:
+            content += self.rfile.read(length - len(content))
+        # the end of the message after the block is read as an empty line
+        return (line[:end] + content[:length]).decode('ascii', 'replace').lstrip()
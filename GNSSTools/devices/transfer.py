@@ -0,0 +1,61 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# File transfers with the Spectracom as IEEE-488.2 definite length blocks: #<digits><length><content>. The
+# answer to MMEMory:DATA? is read by chunks and written straight into the file, so that the size of the file does
+# not matter. MMEMory:DATA? having no offset, a failed download is not resumed: the block is read again from its
+# beginning, the bytes already in the file being only checked against it instead of being written again.
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import os
+
+
+def block(data):
+    # Return:
+    # the definite length block of a text
+    size = str(len(data.encode()))
+    return '#%d%s%s' % (len(size), size, data)
+
+
+def read_block(resource, filename, chunk_size=1 << 16, progress=None):
+    # Reads the block answered by the resource into a file
+    # Input:
+    # resource: pyvisa resource to which the query was written
+    # filename: file where the content is written, its bytes equal to the block being kept
+    # chunk_size: number of bytes read at once
+    # progress: function called with (bytes received, length of the block) after each chunk
+    # Return:
+    # length of the block
+    # Raises:
+    # ValueError: if the answer is not a definite length block
+    header = resource.read_bytes(2)
+    if header[0:1] != b'#' or not header[1:2].isdigit() or header[1:2] == b'0':
+        raise ValueError('Not a definite length block: %r' % header)
+    length = int(resource.read_bytes(int(header[1:2])))
+    kept = os.path.getsize(filename) if os.path.exists(filename) else 0
+    with open(filename, 'r+b' if kept else 'wb') as file:
+        position = 0
+        while position < length:
+            data = resource.read_bytes(min(chunk_size, length - position))
+            if position < kept:
+                overlap = min(len(data), kept - position)
+                file.seek(position)
+                if file.read(overlap) != data[:overlap]:
+                    # the file is not the one downloaded before: written again from here
+                    kept = position
+            if position + len(data) > kept:
+                start = max(kept - position, 0)
+                file.seek(position + start)
+                file.write(data[start:])
+            position += len(data)
+            if progress is not None:
+                progress(position, length)
+        file.truncate(length)
+    # end of the answer, up to the read termination of the resource
+    termination = (getattr(resource, 'read_termination', None) or '\n').encode()
+    end = b''
+    while not end.endswith(termination):
+        end += resource.read_bytes(1)
+    return length
@@ -10,16 +10,218 @@
 import serial
 import time
 import binascii
+import io
 import math
-import json
+import os
+import struct
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+import numpy as np
 from GNSSTools.devices.device import Device
+from GNSSTools.devices.capture import Capture
+from GNSSTools.devices import ubx
+from GNSSTools.devices.container import EXTENSION, ContainerReader
+from GNSSTools.devices.segments import MANIFEST, open_raw
 import GNSSTools.tools as tools
 
+# RXM-RAW measurement record, one per satellite and epoch
+RAW_DTYPE = np.dtype([('epoch', '<u4'), ('rcvtow', '<i4'), ('week', '<i2'), ('sv', 'u1'),
+                      ('prmes', '<f8'), ('cpmes', '<f8'), ('domes', '<f4'), ('cno', 'i1'),
+                      ('mesqi', 'i1'), ('lli', 'u1')])
+
+# RXM-RAW repeated block, as laid out in the UBX payload (24 bytes per satellite)
+_RXM_RAW_SV = np.dtype([('cpmes', '<f8'), ('prmes', '<f8'), ('domes', '<f4'), ('sv', 'u1'),
+                        ('mesqi', 'i1'), ('cno', 'i1'), ('lli', 'u1')])
+
+# Fixed size of the .npy header written by RawArchive, so that the record count can be rewritten in place
+_NPY_HEADER_SIZE = 320
+
+
+def rxm_raw_records(line, epoch=0):
+    # Decodes one hexadecimal RXM-RAW message
+    # Input:
+    # line: hexadecimal UBX message, starting with b5620210
+    # epoch: epoch index given to the measurements
+    # Return:
+    # array of RAW_DTYPE records, or None if the message is truncated
+    try:
+        message = binascii.unhexlify(line)
+    except (binascii.Error, ValueError):
+        return None
+    if len(message) < 14:
+        return None
+    length = struct.unpack_from('<H', message, 4)[0]
+    payload = message[6:6 + length]
+    rcvtow, week, numsv = struct.unpack_from('<ihB', payload)
+    if len(payload) < 8 + _RXM_RAW_SV.itemsize * numsv:
+        return None
+    sats = np.frombuffer(payload, dtype=_RXM_RAW_SV, count=numsv, offset=8)
+    records = np.zeros(numsv, dtype=RAW_DTYPE)
+    records['epoch'] = epoch
+    records['rcvtow'] = rcvtow
+    records['week'] = week
+    for name in _RXM_RAW_SV.names:
+        records[name] = sats[name]
+    return records
+
+
+def load_raw(filename):
+    # Loads an archive of RXM-RAW measurements
+    # Input:
+    # filename: .npy file written by RawArchive (memory-mapped) or .npz file written by RawArchive.export
+    # Return:
+    # array of RAW_DTYPE records
+    if filename.endswith('.npz'):
+        with np.load(filename) as archive:
+            return archive['raw']
+    return np.load(filename, mmap_mode='r')
+
+
+class RawArchive:
+    # Append-only .npy file of RXM-RAW measurements. The file stays a valid .npy file after every append, so
+    # that hours of measurements can be memory-mapped with load_raw while the acquisition is still running.
+
+    def __init__(self, filename):
+        # An existing .npy file whose header is not the one of RawArchive, written by np.save for instance, is
+        # rewritten with it before anything is appended.
+        self.filename = filename
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            file = open(filename, 'rb')
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+            size = file.tell()
+            file.close()
+            if dtype != RAW_DTYPE or len(shape) != 1:
+                raise ValueError('%s is not a RXM-RAW archive' % filename)
+            self.count = shape[0]
+            if size != _NPY_HEADER_SIZE or version != (1, 0):
+                raw = np.load(filename)
+                file = open(filename, 'wb')
+                file.write(self.header(self.count))
+                file.write(raw.tobytes())
+                file.close()
+            else:
+                raw = np.load(filename, mmap_mode='r')
+            self.epochs = int(raw['epoch'][-1]) + 1 if self.count else 0
+            del raw
+        else:
+            self.count = 0
+            self.epochs = 0
+            file = open(filename, 'wb')
+            file.write(self.header(0))
+            file.close()
+
+    @staticmethod
+    def header(count):
+        # Builds a .npy version 1.0 header padded to _NPY_HEADER_SIZE bytes
+        # Input:
+        # count: number of records in the file
+        descr = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+            np.lib.format.dtype_to_descr(RAW_DTYPE), count)
+        descr = descr.ljust(_NPY_HEADER_SIZE - 11) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(descr)) + descr.encode('latin1')
+
+    def append(self, raw):
+        # Appends measurements at the end of the archive, epochs are renumbered to follow the stored ones
+        # Input:
+        # raw: array of RAW_DTYPE records, as returned by Ublox.raw_data
+        if len(raw) == 0:
+            return
+        raw = np.array(raw, dtype=RAW_DTYPE)
+        raw['epoch'] = raw['epoch'] - raw['epoch'][0] + self.epochs
+        file = open(self.filename, 'r+b')
+        file.seek(_NPY_HEADER_SIZE + self.count * RAW_DTYPE.itemsize)
+        file.write(raw.tobytes())
+        self.count += len(raw)
+        self.epochs = int(raw['epoch'][-1]) + 1
+        file.seek(0)
+        file.write(self.header(self.count))
+        file.close()
+
+    def load(self):
+        # Return:
+        # memory-mapped array of the whole archive
+        return load_raw(self.filename)
+
+    def export(self, filename):
+        # Writes the archive into a compressed .npz file, under the key 'raw'
+        np.savez_compressed(filename, raw=self.load())
+
+
+class TailParser:
+    # Resumable version of Ublox.miseenforme: remembers how many bytes of the raw data file have been consumed
+    # (for a capture container, the position of the next record) and the raw text of the last, possibly incomplete,
+    # message. Each update only reads what has been appended
+    # to the raw data file, appends the processed lines to the processed data file and returns them.
+
+    # strings before which miseenforme puts a new line, in the order of the replacements
+    MARKERS = (('b562', '\nb562'), ('2447', '\n2447'), ('0d0a$G', '\n$G'))
+
+    def __init__(self, rawdatafile, procdatafile, offset=0, partial=''):
+        self.rawdatafile = rawdatafile
+        self.procdatafile = procdatafile
+        self.offset = offset
+        self.partial = partial
+        if offset == 0:
+            open(self.procdatafile, 'w').close()
+
+    def cut(self, text):
+        # Finds the start of the last message of the text, no marker overlapping it
+        cut = max(text.rfind(marker) for marker, _ in self.MARKERS)
+        moved = cut > 0
+        while moved:
+            moved = False
+            for marker, _ in self.MARKERS:
+                j = text.find(marker, max(cut - len(marker) + 1, 0))
+                if 0 <= j < cut:
+                    cut = j
+                    moved = True
+        return cut
+
+    def update(self, final=False):
+        # Processes the data appended to the raw data file since the last update
+        # Input:
+        # final: also process the last message, to be used once the acquisition is over
+        # Return:
+        # lines: list of the new processed lines, to be given to the decoders
+        if self.rawdatafile.endswith(EXTENSION):
+            # only the records written since the last update are converted
+            container = ContainerReader(self.rawdatafile, self.offset)
+            new = container.raw()
+            self.offset = container.end()
+            container.close()
+        else:
+            file = open_raw(self.rawdatafile)
+            file.seek(self.offset)
+            new = file.read()
+            file.close()
+            self.offset += len(new)
+        text = self.partial + new.decode('latin1')
+        cut = len(text) if final else self.cut(text)
+        if cut <= 0:
+            self.partial = text
+            return []
+        head, self.partial = text[:cut], text[cut:]
+        for marker, replacement in self.MARKERS:
+            head = head.replace(marker, replacement)
+        head = head.replace('\r\n', '\n').replace('\r', '\n')
+        data = open(self.procdatafile, 'a')
+        data.write(head)
+        data.close()
+        # the last line is complete, the next message starting with a new line
+        return [line.rstrip('\n') + '\n' for line in io.StringIO(head).readlines() if line != '\n']
+
 
 class Ublox(Device):
 
+    # port rates supported by the receiver, fastest first
+    BAUD_RATES = (460800, 230400, 115200, 57600, 38400, 19200, 9600, 4800)
+
     def __init__(self, com, baud_rate=4800, data_bits=8, parity='N', stop_bit=1, timeout=1,
-                 rawdatafile='datatxt/ublox_raw_data.txt', procdatafile='datatxt/ublox_processed_data.txt'):
+                 rawdatafile='datatxt/ublox_raw_data.txt', procdatafile='datatxt/ublox_processed_data.txt',
+                 link_rate=None, device=None):
         super(Ublox, self).__init__()
         self.com = com
         self.baud_rate = baud_rate
@@ -29,25 +231,121 @@ class Ublox(Device):
         self.timeout = timeout
         self.rawdatafile = rawdatafile
         self.procdatafile = procdatafile
-        try:
-            self.device = serial.Serial(self.com, timeout=timeout, stopbits=stop_bit, write_timeout=None,
-                                        bytesize=data_bits, rtscts=False, xonxoff=False, parity=parity,
-                                        baudrate=baud_rate, inter_byte_timeout=None, dsrdtr=False)
-        except:
-            raise ValueError('connexion with Ublox device failed')
-
-    def find_message(self):
-        # look after a ack or nack message
+        self.tail = None
+        self.acquisition = None
+        self.tracker = ubx.AckTracker()
+        self.poller = ubx.PollScheduler()
+        # time between two navigation solutions in seconds, unit of the CFG-MSG rates
+        self.measurement_period = 1.0
+        # an already opened port, replay.ReplaySerial for instance, can be given instead of opening com
+        self.device = device
+        if device is None:
+            try:
+                self.device = serial.Serial(self.com, timeout=timeout, stopbits=stop_bit, write_timeout=None,
+                                            bytesize=data_bits, rtscts=False, xonxoff=False, parity=parity,
+                                            baudrate=baud_rate, inter_byte_timeout=None, dsrdtr=False)
+            except:
+                raise ValueError('connexion with Ublox device failed')
+        if link_rate is not None:
+            self.negotiate(link_rate)
+
+    def wait_for(self, cls, id, timeout=1):
+        # Reads the port until a given UBX message is received, the other data being dropped.
+        # Only to be used while no capture is running.
+        # Input:
+        # cls, id: class and id of the expected message
+        # timeout: time to wait for in seconds
+        # Return:
+        # the message received, or None
+        framer = ubx.Framer()
+        end = time.time() + timeout
+        while time.time() < end:
+            for kind, frame in framer.feed(self.device.read(self.device.in_waiting or 1)):
+                if kind == 'UBX' and frame[2] == cls and frame[3] == id:
+                    return frame
+        return None
+
+    def port_config(self, baud_rate):
+        # Builds the CFG-PRT message setting the UART1 rate, keeping the current character framing
+        # Input:
+        # baud_rate: new rate of the port in bauds
+        # Return:
+        # the CFG-PRT message
+        parity = {'N': 0b100, 'E': 0b000, 'O': 0b001}[self.parity]
+        stop = {1: 0, 1.5: 1, 2: 2}[self.stop_bit]
+        mode = 0x10 | (self.data_bits - 5) << 6 | parity << 9 | stop << 12
+        # in: UBX + NMEA + RTCM, out: UBX + NMEA
+        payload = struct.pack('<BBHIIHHHH', 1, 0, 0, mode, baud_rate, 0x0007, 0x0003, 0, 0)
+        return ubx.message(0x06, 0x00, payload)
+
+    def set_baud_rate(self, baud_rate, timeout=1):
+        # Changes the rate of the receiver port with CFG-PRT, reopens the serial port at the new rate and
+        # confirms by polling the port configuration. The previous rate is restored if nothing answers.
+        # Input:
+        # baud_rate: new rate in bauds
+        # timeout: time to wait for the answer in seconds
+        # Return:
+        # True if the receiver answers at the new rate
+        old = self.device.baudrate
+        self.device.write(self.port_config(baud_rate))
+        self.device.flush()
+        # the receiver finishes sending at the old rate before switching
+        time.sleep(0.1)
+        self.device.baudrate = baud_rate
+        self.device.reset_input_buffer()
+        self.device.write(ubx.message(0x06, 0x00, b'\x01'))
+        if self.wait_for(0x06, 0x00, timeout) is not None:
+            self.baud_rate = baud_rate
+            return True
+        self.device.baudrate = old
+        self.device.reset_input_buffer()
+        return False
+
+    def negotiate(self, link_rate):
+        # Sets the fastest port rate up to link_rate accepted by the receiver
+        # Input:
+        # link_rate: wanted rate in bauds
+        # Return:
+        # the rate in use
+        for baud_rate in self.BAUD_RATES:
+            if baud_rate <= link_rate and baud_rate > self.baud_rate and self.set_baud_rate(baud_rate):
+                break
+        return self.baud_rate
+
+    def link_utilization(self):
+        # Measures the share of the serial link used by the receiver output during the running capture
+        # Return:
+        # utilization: see Capture.utilization
+        if self.acquisition is None:
+            raise ValueError('No capture running')
+        return self.acquisition.utilization()
+
+    def acknowledge(self, futures, timeout=1):
+        # Waits for the answers of the configuration messages sent. While a capture is running its reader thread
+        # feeds the tracker, otherwise the port is read here, the other data being dropped.
+        # Input:
+        # futures: futures given by AckTracker.expect
+        # timeout: time to wait for all the answers in seconds
         # Return:
-        # Nak or ack received
-        msgsent = time.time()
-        wait = 1
-        while time.time() < wait + msgsent:
-            line = self.device.readline()
-            if line[0:4] == b'\xb5b\x05\x01':
-                print('ack received')
-            elif line[0:4] == b'\xb5b\x05\x00':
-                print('nak received')
+        # list of True for ACK-ACK, False for ACK-NAK and None when no answer came in time
+        end = time.time() + timeout
+        if self.acquisition is None:
+            framer = ubx.Framer()
+            while time.time() < end and not all(future.done() for future in futures):
+                self.tracker.feed(framer.feed(self.device.read(self.device.in_waiting or 1)))
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(max(end - time.time(), 0)))
+            except (FutureTimeoutError, CancelledError):
+                self.tracker.forget(future)
+                results.append(None)
+        return results
+
+    def transaction(self):
+        # Return:
+        # a Transaction gathering UBX messages into a single write, see ubx.Transaction
+        return ubx.Transaction(self.device, self.tracker)
 
     def reset(self, command):
         # Permits to make a cold, warm or a hot start reset on the Ublox receiver
@@ -55,23 +353,10 @@ class Ublox(Device):
         # command: which reset you want to, valid commands: 'Cold RST', 'Warm RST', 'Hot RST'
         # Raise:
         # an error is raised if the command is not valid
-        if command == 'Cold RST':
-            reset = b'\xB5\x62\x06\x04\x04\x00\xFF\xA1\x02\x00\xB0\x47'
-            self.device.write(reset)
-            self.find_message()
-
-        elif command == 'Warm RST':
-            reset = b'\xB5\x62\x06\x04\x04\x00\x01\x00\x02\x00\x11\x6C'
-            self.device.write(reset)
-            self.find_message()
-
-        elif command == 'Hot RST':
-            reset = b'\xB5\x62\x06\x04\x04\x00\x00\x00\x02\x00\x10\x68'
-            self.device.write(reset)
-            self.find_message()
-
-        else:
+        if command not in ubx.RESETS:
             raise ValueError('Unknown resetting command')
+        # CFG-RST is not acknowledged
+        self.device.write(ubx.cfg_rst(ubx.RESETS[command]))
 
     def enable(self, command):
         # Sets enable messages specified by the command argument
@@ -85,129 +370,11 @@ class Ublox(Device):
         #               'NMEA' to set al nmea messages enable
         # Raise:
         # an error is raised if the command is not valid
-        if command == 'EPH':
-            eph_on = b'\xB5\x62\x06\x01\x03\x00\x0B\x31\x01\x47\xC3'
-            self.device.write(eph_on)
-            self.find_message()
-
-        elif command == 'HUI':
-            hui_on = b'\xB5\x62\x06\x01\x03\x00\x0B\x02\x01\x18\x65 '
-            self.device.write(hui_on)
-            self.find_message()
-
-        elif command == 'RAW':
-            raw_on = b'\xB5\x62\x06\x01\x03\x00\x02\x10\x01\x1D\x66'
-            self.device.write(raw_on)
-            self.find_message()
-
-        elif command == 'GGA':
-            gga = b'\xB5\x62\x06\x01\x03\x00\xF0\x00\x01\xFB\x10'
-            self.device.write(gga)
-            self.find_message()
-
-        elif command == 'NMEA':  # receive an ack when test
-            # DTM   GBS    GGA    GLL    GRS    GSA    GST    GSV    RMC
-            # VTG   ZDA    PUBX 00     PUBX 03    PUBX 04
-            nmea_on = b'\xB5\x62\x06\x01\x03\x00\xF0\x0A\x01\x05\x24'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x09\x01\x04\x22'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x00\x01\xFB\x10'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x01\x01\xFC\x12'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x06\x01\x01\x1C'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x02\x01\xFD\x14'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x07\x01\x02\x1E'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x03\x01\xFE\x16'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x04\x01\xFF\x18'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x05\x01\x00\x1A'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x08\x01\x03\x20'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF1\x00\x01\xFC\x13'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF1\x03\x01\xFF\x19'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF1\x04\x01\x00\x1B'
-            self.device.write(nmea_on)
-            self.find_message()
-        elif command == 'UBX':
-            ubx_on = b'\xB5\x62\x06\x01\x03\x00\x0B\x30\x01\x46\xC1'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x50\x01\x66\x01'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x33\x01\x49\xC7'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x31\x01\x47\xC3'\
-                     b'\xB5\x62\x06\x01\x03\x00\x10\x02\x01\x1D\x74'\
-                     b'\xB5\x62\x06\x01\x03\x00\x10\x10\x01\x2B\x90'\
-                     b'\xB5\x62\x06\x01\x03\x00\x28\x00\x01\x33\xB8'\
-                     b'\xB5\x62\x06\x01\x03\x00\x21\x0E\x01\x3A\xBF'\
-                     b'\xB5\x62\x06\x01\x03\x00\x21\x08\x01\x34\xB3'\
-                     b'\xB5\x62\x06\x01\x03\x00\x21\x0B\x01\x37\xB9'\
-                     b'\xB5\x62\x06\x01\x03\x00\x21\x0F\x01\x3B\xC1'\
-                     b'\xB5\x62\x06\x01\x03\x00\x21\x0D\x01\x39\xBD'\
-                     b'\xB5\x62\x06\x01\x03\x00\x13\x80\x01\x9E\x79'\
-                     b'\xB5\x62\x06\x01\x03\x00\x13\x21\x01\x3F\xBB'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x05\x01\x1A\x68'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x09\x01\x1E\x70'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x0B\x01\x20\x74'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x02\x01\x17\x62'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x06\x01\x1B\x6A'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x07\x01\x1C\x6C'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x21\x01\x36\xA0'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x2E\x01\x43\xBA'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0A\x08\x01\x1D\x6E'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x60\x01\x6C\x03'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x22\x01\x2E\x87'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x31\x01\x3D\xA5'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x04\x01\x10\x4B'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x40\x01\x4C\xC3'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x01\x01\x0D\x45'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x02\x01\x0E\x47'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x32\x01\x3E\xA7'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x06\x01\x12\x4F'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x03\x01\x0F\x49'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x30\x01\x3C\xA3'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x20\x01\x2C\x83'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x21\x01\x2D\x85'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x11\x01\x1D\x65'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x12\x01\x1E\x67'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x30\x01\x3D\xA6'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x31\x01\x3E\xA8'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x10\x01\x1D\x66'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x13\x01\x20\x6C'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x20\x01\x2D\x86'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x04\x01\x1C\x6F'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x03\x01\x1B\x6D'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x01\x01\x19\x69'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x06\x01\x1E\x73'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x32\x01\x48\xC5'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x02\x01\x18\x65'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x01\x01\x17\x63'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0B\x00\x01\x16\x61'\
-                     b'\xB5\x62\x06\x01\x03\x00\x10\x15\x01\x30\x9A'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x05\x01\x11\x4D'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x3A\x01\x46\xB7'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x61\x01\x6D\x05'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x39\x01\x45\xB5'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x09\x01\x15\x55'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x34\x01\x40\xAB'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x07\x01\x13\x51'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x3C\x01\x48\xBB'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x35\x01\x41\xAD'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x3B\x01\x47\xB9'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x24\x01\x30\x8B'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x25\x01\x31\x8D'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x23\x01\x2F\x89'\
-                     b'\xB5\x62\x06\x01\x03\x00\x01\x26\x01\x32\x8F'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x61\x01\x6E\x08'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x14\x01\x21\x6E'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x15\x01\x22\x70'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x59\x01\x66\xF8'\
-                     b'\xB5\x62\x06\x01\x03\x00\x02\x11\x01\x1E\x68'\
-                     b'\xB5\x62\x06\x01\x03\x00\x27\x01\x01\x33\xB7'\
-                     b'\xB5\x62\x06\x01\x03\x00\x27\x03\x01\x35\xBB'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x11\x01\x29\x89'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x16\x01\x2E\x93'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x13\x01\x2B\x8D'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x12\x01\x2A\x8B'\
-                     b'\xB5\x62\x06\x01\x03\x00\x0D\x15\x01\x2D\x91'\
-                     b'\xB5\x62\x06\x01\x03\x00\x09\x14\x01\x28\x83'
-            self.device.write(ubx_on)
-            self.find_message()
-        else:
+        messages = {'EPH': [ubx.AID_EPH], 'HUI': [ubx.AID_HUI], 'RAW': [ubx.RXM_RAW], 'GGA': [ubx.NMEA_GGA],
+                    'NMEA': ubx.NMEA_MESSAGES, 'UBX': ubx.UBX_MESSAGES}
+        if command not in messages:
             raise ValueError('Unknown Enabling Command')
+        return self.set_rates(messages[command], 1)
 
     def poll(self, command):
         # poll messages
@@ -219,27 +386,13 @@ class Ublox(Device):
         #               'random' to set CFG-NAV5,NAV-DOP and RXM-SVSI available
         # Raise:
         # an error is raised if the command is not valid
-        if command == 'EPH':
-            eph_get = b'\xB5\x62\x0B\x31\x00\x00\x3C\xBF'
-            self.device.write(eph_get)
-
-        elif command == 'HUI':
-            hui_get = b'\xB5\x62\x0B\x02\x00\x00\x0D\x32'
-            self.device.write(hui_get)
-
-        elif command == 'RAW':
-            raw_get = b'\xB5\x62\x02\x10\x00\x00\x12\x38'
-            self.device.write(raw_get)
-
-        elif command == 'random':
-            # CFG-NAV5  NAV-DOP  RXM-SVSI
-            random_get = b'\xB5\x62\x06\x24\x00\x00\x2A\x84'\
-                         b'\xB5\x62\x01\x04\x00\x00\x05\x10'\
-                         b'\xB5\x62\x02\x20\x00\x00\x22\x68'
-            self.device.write(random_get)
-
-        else:
+        messages = {'EPH': [ubx.AID_EPH], 'HUI': [ubx.AID_HUI], 'RAW': [ubx.RXM_RAW],
+                    'random': [ubx.CFG_NAV5, ubx.NAV_DOP, ubx.RXM_SVSI]}
+        if command not in messages:
             raise ValueError('Unknown Polling Command')
+        with self.transaction() as transaction:
+            for cls, id in messages[command]:
+                transaction.add(cls, id)
 
     def disable(self, command):
         # disable UBX or NMEA message
@@ -249,115 +402,73 @@ class Ublox(Device):
         #               'NMEA' to set all NMEA messages disable
         # Raise:
         # an error is raised if the command is not valid
-        if command == 'UBX':  # Receive a Nac when test -- pb : UBX msg turn off by default
-            disable = b'\xB5\x62\x06\x01\x03\x00\x0B\x30\x01\x45\xC0'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x50\x00\x65\x00'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x33\x00\x48\xC6'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x31\x00\x46\xC2'\
-                      b'\xB5\x62\x06\x01\x03\x00\x10\x02\x00\x1C\x73'\
-                      b'\xB5\x62\x06\x01\x03\x00\x10\x10\x00\x2A\x8F'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x05\x00\x19\x67'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x09\x00\x1D\x6F'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x0B\x00\x1F\x73'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x02\x00\x16\x61'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x06\x00\x1A\x69'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x07\x00\x1B\x6B'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x21\x00\x35\x9F'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x08\x00\x1C\x6D'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x60\x00\x6B\x02'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x22\x00\x2D\x86'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x31\x00\x3C\xA4'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x04\x00\x0F\x4A'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x40\x00\x4B\xC2'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x01\x00\x0C\x44'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x02\x00\x0D\x46'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x32\x00\x3D\xA6'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x06\x00\x11\x4E'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x03\x00\x0E\x48'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x30\x00\x3B\xA2'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x20\x00\x2B\x82'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x21\x00\x2C\x84'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x11\x00\x1C\x64'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x12\x00\x1D\x66'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x30\x00\x3C\xA5'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x31\x00\x3D\xA7'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x10\x00\x1C\x65'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x11\x00\x1D\x67'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x13\x00\x1F\x6B'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x20\x00\x2C\x85'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x04\x00\x1B\x6E'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x03\x00\x1A\x6C'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x01\x00\x18\x68'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x06\x00\x1D\x72'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x32\x00\x47\xC4'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x02\x00\x17\x64'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x01\x00\x16\x62'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0B\x00\x00\x15\x60'\
-                      b'\xB5\x62\x06\x01\x03\x00\x10\x15\x00\x2F\x99'\
-                      b'\xB5\x62\x06\x01\x03\x00\x28\x00\x00\x32\xB7'\
-                      b'\xB5\x62\x06\x01\x03\x00\x21\x0E\x00\x39\xBE'\
-                      b'\xB5\x62\x06\x01\x03\x00\x21\x08\x00\x33\xB2'\
-                      b'\xB5\x62\x06\x01\x03\x00\x21\x0B\x00\x36\xB8'\
-                      b'\xB5\x62\x06\x01\x03\x00\x21\x0F\x00\x3A\xC0'\
-                      b'\xB5\x62\x06\x01\x03\x00\x21\x0D\x00\x38\xBC'\
-                      b'\xB5\x62\x06\x01\x03\x00\x13\x80\x00\x9D\x78'\
-                      b'\xB5\x62\x06\x01\x03\x00\x13\x21\x00\x3E\xBA'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0A\x2E\x00\x42\xB9'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x05\x00\x10\x4C'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x3A\x00\x45\xB6'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x61\x00\x6C\x04'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x39\x00\x44\xB4'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x09\x00\x14\x54'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x34\x00\x3F\xAA'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x07\x00\x12\x50'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x3C\x00\x47\xBA'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x35\x00\x40\xAC'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x3B\x00\x46\xB8'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x24\x00\x2F\x8A'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x25\x00\x30\x8C'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x23\x00\x2E\x88'\
-                      b'\xB5\x62\x06\x01\x03\x00\x01\x26\x00\x31\x8E'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x61\x00\x6D\x07'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x14\x00\x20\x6D'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x15\x00\x21\x6F'\
-                      b'\xB5\x62\x06\x01\x03\x00\x02\x59\x00\x65\xF7'\
-                      b'\xB5\x62\x06\x01\x03\x00\x27\x01\x00\x32\xB6'\
-                      b'\xB5\x62\x06\x01\x03\x00\x27\x03\x00\x34\xBA'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x11\x00\x28\x88'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x16\x00\x2D\x92'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x13\x00\x2A\x8C'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x12\x00\x29\x8A'\
-                      b'\xB5\x62\x06\x01\x03\x00\x0D\x15\x00\x2C\x90'\
-                      b'\xB5\x62\x06\x01\x03\x00\x09\x14\x00\x27\x82'
-            self.device.write(disable)
-            self.find_message()
-
-        elif command == 'NMEA':
-            # DTM   GBS    GGA    GLL    GRS    GSA    GST    GSV    RMC
-            # VTG   ZDA    PUBX 00     PUBX 03    PUBX 04
-            disable = b'\xB5\x62\x06\x01\x03\x00\xF0\x0A\x00\x04\x23'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x09\x00\x03\x21'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x00\x00\xFA\x0F'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x01\x00\xFB\x11'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x06\x00\x00\x1B'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x02\x00\xFC\x13'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x07\x00\x01\x1D'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x03\x00\xFD\x15'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x04\x00\xFE\x17'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x05\x00\xFF\x19'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF0\x08\x00\x02\x1F'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF1\x00\x00\xFB\x12'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF1\x03\x00\xFE\x18'\
-                      b'\xB5\x62\x06\x01\x03\x00\xF1\x04\x00\xFF\x1A'
-            self.device.write(disable)
-            self.find_message()
-
-        else:
+        messages = {'NMEA': ubx.NMEA_MESSAGES, 'UBX': ubx.UBX_MESSAGES}
+        if command not in messages:
             raise ValueError('Unknown Disabling Command')
+        return self.set_rates(messages[command], 0)
+
+    def set_rates(self, messages, rate, timeout=1):
+        # Sets the output rate of several messages with one CFG-MSG each, all sent in a single write
+        # Input:
+        # messages: (class, id) of the messages
+        # rate: one message every rate navigation solutions, 0 to switch the messages off
+        # timeout: time to wait for the acknowledgements in seconds
+        # Return:
+        # answer of the receiver to each message, see acknowledge
+        with self.transaction() as transaction:
+            for cls, id in messages:
+                transaction.set_rate(cls, id, rate)
+        return self.acknowledge(transaction.futures, timeout)
+
+    def schedule(self, intervals, timeout=1):
+        # Sets the output interval of messages. A message is output periodically by the receiver (CFG-MSG) when
+        # its interval is a whole number of navigation solutions and the receiver acknowledges the rate,
+        # otherwise it is polled by the reader thread of the capture.
+        # Input:
+        # intervals: dictionary {message: seconds}, message being 'EPH', 'HUI', 'RAW' or a (class, id) tuple,
+        #            None to stop the message
+        # timeout: time to wait for the acknowledgements in seconds
+        # Return:
+        # dictionary {message: 'periodic', 'poll' or None when stopped}
+        names = {'EPH': ubx.AID_EPH, 'HUI': ubx.AID_HUI, 'RAW': ubx.RXM_RAW}
+        modes = {}
+        rates = {}
+        for key, interval in intervals.items():
+            if key not in names and not isinstance(key, tuple):
+                raise ValueError('Unknown message ' + str(key))
+            cls, id = names.get(key, key)
+            self.poller.remove(cls, id)
+            if interval is None:
+                rates[key] = 0
+                modes[key] = None
+                continue
+            rate = round(interval / self.measurement_period)
+            if 1 <= rate <= 255 and math.isclose(rate * self.measurement_period, interval):
+                rates[key] = rate
+            else:
+                modes[key] = 'poll'
+        with self.transaction() as transaction:
+            for key, rate in rates.items():
+                transaction.set_rate(*names.get(key, key), rate=rate)
+        answers = self.acknowledge(transaction.futures, timeout)
+        now = time.monotonic()
+        for (key, rate), answer in zip(rates.items(), answers):
+            if rate and answer:
+                modes[key] = 'periodic'
+            elif rate:
+                modes[key] = 'poll'
+        for key, mode in modes.items():
+            if mode == 'poll':
+                self.poller.add(*names.get(key, key), interval=intervals[key], now=now)
+        return modes
 
     def miseenforme(self):
-        # UBX messages doesn't include \n at the end of each messages, this function explicitly put them
-        data = self.fileopen(self.rawdatafile)
+        # UBX messages doesn't include \n at the end of each messages, this function explicitly put them.
+        # rawdatafile can be the manifest of a rotated capture (segments.RotatingWriter) or a capture container
+        if self.rawdatafile.endswith((MANIFEST, EXTENSION)):
+            data = io.TextIOWrapper(open_raw(self.rawdatafile), encoding='latin1')
+        else:
+            data = self.fileopen(self.rawdatafile)
         thing = data.read()
         data.close()
 
@@ -369,8 +480,29 @@ class Ublox(Device):
         data.write(third)
         data.close()
 
-    def klobuchar_data(self):
+    def refresh(self, final=False):
+        # Incremental miseenforme: only processes the data appended to rawdatafile since the previous call,
+        # the first call starting a new procdatafile
+        # Input:
+        # final: also process the last message, to be used once the acquisition is over
+        # Return:
+        # lines: list of the new processed lines, e.g. self.raw_data(lines) decodes only the new measurements
+        if self.tail is None:
+            self.tail = TailParser(self.rawdatafile, self.procdatafile)
+        return self.tail.update(final)
+
+    def procfile(self, lines=None):
+        # Opens the processed data to decode
+        # Input:
+        # lines: processed lines (see refresh), None to open the whole procdatafile
+        if lines is None:
+            return self.fileopen(self.procdatafile)
+        return io.StringIO(''.join(lines))
+
+    def klobuchar_data(self, lines=None):
         # creates the dictionnary of ionospheric data decimal values
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # klobuchar: {
         #    "0": {
@@ -393,8 +525,7 @@ class Ublox(Device):
         #        "utctow": reference time of week
         #    }
         # }
-        #file = self.fileopen(self.procdatafile)
-        file = open(self.procdatafile, 'r')
+        file = self.procfile(lines)
         join = ''
         klobuchar = {}
         i = 0
@@ -481,8 +612,10 @@ class Ublox(Device):
         else:
             return number & mask
 
-    def ephemeris_data(self):
+    def ephemeris_data(self, lines=None):
         # Stores the EPH data under this way :
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # ephemeris: {'svid': svid, 'wn': wn, 'l2': l2, 'ura': ura, 'health': health,
         #             'iodc': iodc, 'tgd': tgd, 'toc': toc, 'af2': af2, 'af1': af1,
@@ -523,7 +656,7 @@ class Ublox(Device):
         #       omegadot - rate of right ascension - radians/second
         #       iodesf3 - issue of data ephemeris subframe 3
         #       idot - rate of inclination angle - radians/second
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         ephemeris = {}
         i = 0
         inter = {}
@@ -639,64 +772,46 @@ class Ublox(Device):
         file.close()
         return ephemeris
 
-    def raw_data(self):
-        # Stores the PRN data under this way :
+    def raw_data(self, lines=None):
+        # Stores the RXM-RAW measurements into a NumPy structured array, one record per satellite and epoch
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
-        # raw: {{rcvtow, week, numsv, {{cpmes, prmes, domes, sv, mesqi, cno, lli},{...}}}{...}}
-        # where:
+        # raw: array of RAW_DTYPE records with the fields:
+        #       epoch, index of the RXM-RAW message the measurement comes from
         #       rcvtow in ms, Measurement time of week in receiver local time
         #       week in weeks,  Measurement week number in receiver local time
-        #       numsv,
-        #       cpmes in cycles, Carrier phase measurement [L1 cycles]
+        #       sv, Space Vehicle number
         #       prmes in m, Pseudorange measurement [m]
+        #       cpmes in cycles, Carrier phase measurement [L1 cycles]
         #       domes in Hz, Doppler measurement (positive sign for approaching satellites) [Hz]
-        #       sv, Space Vehicle number
+        #       cno in dBHz,  Signal strength C/No
         #       mesqi,  Nav Measurements Quality Indicator: >=4 : PR+DO OK   >=5 : PR+DO+CP OK
         #                                   <6 : likely loss of carrier lock in previous interval
-        #       cno in dBHz,  Signal strength C/No
-        file = self.fileopen(self.procdatafile)
-        raw = {}
-        r = 0
-        join = ''
+        #       lli, Loss of lock indicator (RINEX definition)
+        file = self.procfile(lines)
+        epochs = []
         for line in file:
             if line[0:8] == 'b5620210':
                 # RXM-RAW
-                inter = {}
-                i = 0
-                rcvtow = int(line[12:20], 16)
-                week = int(line[20:24], 16)
-                numsv = int(line[24:26], 16)
-                for sat in range(numsv):
-                    cpmes = int(join.join((line[(42 + 24*sat):(44 + 24*sat)], line[(40 + 24*sat):(42 + 24*sat)],
-                                           line[(38 + 24*sat):(40 + 24*sat)], line[(36 + 24*sat):(38 + 24*sat)],
-                                           line[(34 + 24*sat):(36 + 24*sat)], line[(32 + 24*sat):(34 + 24*sat)],
-                                           line[(30 + 24*sat):(32 + 24*sat)], line[(28 + 24*sat):(30 + 24*sat)])), 16)
-                    prmes = int(join.join((line[(58 + 24*sat):(60 + 24*sat)], line[(56 + 24*sat):(58 + 24*sat)],
-                                           line[(54 + 24*sat):(56 + 24*sat)], line[(52 + 24*sat):(54 + 24*sat)],
-                                           line[(50 + 24*sat):(52 + 24*sat)], line[(48 + 24*sat):(50 + 24*sat)],
-                                           line[(46 + 24*sat):(48 + 24*sat)], line[(44 + 24*sat):(46 + 24*sat)])), 16)
-                    domes = int(join.join((line[(66 + 24*sat):(68 + 24*sat)], line[(64 + 24*sat):(66 + 24*sat)],
-                                           line[(62 + 24*sat):(64 + 24*sat)], line[(60 + 24*sat):(62 + 24*sat)])), 16)
-                    sv = int(line[(68 + 24*sat):(70 + 24*sat)], 16)
-                    mesqi = int(line[(70 + 24*sat):(72 + 24*sat)], 16)
-                    cno = int(line[(72 + 24*sat):(74 + 24*sat)], 16)
-                    lli = int(line[(74 + 24*sat):(76 + 24*sat)], 16)
-                    inter[i] = {'cpmes': cpmes, 'prmes': prmes, 'domes': domes, 'sv': sv,
-                                'mesqui': mesqi, 'C/N0': cno, 'lli': lli}
-                    i += 1
-                raw[r] = {rcvtow, week, numsv, inter}
-                r += 1
+                records = rxm_raw_records(line.strip(), len(epochs))
+                if records is not None:
+                    epochs.append(records)
         file.close()
-        return json.dumps(raw, indent=4)
+        if epochs:
+            return np.concatenate(epochs)
+        return np.zeros(0, dtype=RAW_DTYPE)
 
-    def random_data(self):
+    def random_data(self, lines=None):
         # Stores navigation data, DOP data and SVSI data into dictionaries
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # nav: {{dynmodel, fixmode, fixedalt, fixedaltvar, minelev, pdop, tdop,
         #           pacc, tacc, staticholdthresh, dgpstimeout, cnothreshnumsv, cnothresh}{...}}
         # dop: {{itow, gdop, pdop, tdop, vdop, hdop, ndop, edop}{...}}
         # svsi: {{itow, week, numvis, numsv, {{svid, elev, az, age}{...}}}{...}}
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         nav = {}
         n = 0
         dop = {}
@@ -765,8 +880,10 @@ class Ublox(Device):
         file.close()
         return nav, dop, svsi
 
-    def navclock_data(self):
+    def navclock_data(self, lines=None):
         # Stores clock solution data into a dictionary
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # clock:{
         #    "0": {
@@ -777,7 +894,7 @@ class Ublox(Device):
         #     }
         #     {...}
         # }
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         clock = {}
         clk = 0
         join = ''
@@ -792,8 +909,10 @@ class Ublox(Device):
         file.close()
         return clock
 
-    def nmea_data_gbs(self):
+    def nmea_data_gbs(self, lines=None):
         # Stores NMEA GBS data into a dictionary
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # satfaultdetection:{
         #    "0": {
@@ -805,7 +924,7 @@ class Ublox(Device):
         #     }
         #     {...}
         # }
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         satfaultdetection = {}
         i = 0
         for line in file:
@@ -822,8 +941,10 @@ class Ublox(Device):
         file.close()
         return satfaultdetection
 
-    def nmea_data_gsa(self):
+    def nmea_data_gsa(self, lines=None):
         # Stores NMEA GSA data into a dictionary
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # dopandactivesat:{
         # "0": {
@@ -838,7 +959,7 @@ class Ublox(Device):
         #    }
         #    "1": {...}
         # }
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         dopandactivesat = {}
         i = 0
         for line in file:
@@ -860,8 +981,10 @@ class Ublox(Device):
         file.close()
         return dopandactivesat
 
-    def nmea_data_vtg(self):
+    def nmea_data_vtg(self, lines=None):
         # Stores NMEA VTG data into a dictionary
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # courseandspeed: {
         #    "0": {
@@ -872,7 +995,7 @@ class Ublox(Device):
         #    "1":{...
         #    }
         # }
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         courseandspeed = {}
         i = 0
         for line in file:
@@ -887,8 +1010,10 @@ class Ublox(Device):
         file.close()
         return courseandspeed
 
-    def nmea_data_pubx3(self):
+    def nmea_data_pubx3(self, lines=None):
         # Stores NMEA PUBX 03 data into a dictionary
+        # Input:
+        # lines: processed lines to decode (see TailParser), None to decode the whole procdatafile
         # Return:
         # satinview: {
         #    "0": {
@@ -909,7 +1034,7 @@ class Ublox(Device):
         # where: az =
         #        elev =
         #
-        file = self.fileopen(self.procdatafile)
+        file = self.procfile(lines)
         satinview = {}
         k = 0
         for line in file:
@@ -996,6 +1121,15 @@ class Ublox(Device):
                 p += 1
         return pos
 
+    def capture(self, file):
+        # Starts the acquisition of the receiver data into a file, replacing repeated calls to store_data
+        # Input:
+        # file: file opened in binary mode where data will be written
+        # Return:
+        # the running Capture, to be stopped with its stop method
+        self.acquisition = Capture(self.device, file, listeners=[self.tracker.feed], poller=self.poller).start()
+        return self.acquisition
+
     def store_data(self, file):
         # Store into a file data comming from the receiver and make data processing if data are UBX message
         # Input:
@@ -0,0 +1,322 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# UBX protocol helpers: encoding of the commands, checksum and splitting of the byte stream coming from the
+# Ublox receiver into UBX messages and NMEA sentences
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import collections
+import math
+import struct
+import threading
+from concurrent.futures import Future
+
+SYNC = b'\xb5\x62'
+MAX_UBX_LENGTH = 8192  # longest UBX payload accepted before resynchronising, in bytes
+MAX_NMEA_LENGTH = 1024  # longest NMEA sentence accepted (PUBX,03 is far longer than 82 characters)
+
+# (class, id) of the messages
+ACK_NAK = (0x05, 0x00)
+ACK_ACK = (0x05, 0x01)
+CFG_MSG = (0x06, 0x01)
+CFG_RST = (0x06, 0x04)
+CFG_NAV5 = (0x06, 0x24)
+NAV_DOP = (0x01, 0x04)
+RXM_RAW = (0x02, 0x10)
+RXM_SVSI = (0x02, 0x20)
+AID_HUI = (0x0B, 0x02)
+AID_EPH = (0x0B, 0x31)
+NMEA_GGA = (0xF0, 0x00)
+
+# output messages switched on and off all together by Ublox.enable and Ublox.disable
+UBX_MESSAGES = (
+    # NAV
+    (0x01, 0x60), (0x01, 0x22), (0x01, 0x31), (0x01, 0x04), (0x01, 0x40), (0x01, 0x01), (0x01, 0x02),
+    (0x01, 0x32), (0x01, 0x06), (0x01, 0x03), (0x01, 0x30), (0x01, 0x20), (0x01, 0x21), (0x01, 0x11),
+    (0x01, 0x12), (0x01, 0x05), (0x01, 0x3A), (0x01, 0x61), (0x01, 0x39), (0x01, 0x09), (0x01, 0x34),
+    (0x01, 0x07), (0x01, 0x3C), (0x01, 0x35), (0x01, 0x3B), (0x01, 0x24), (0x01, 0x25), (0x01, 0x23),
+    (0x01, 0x26),
+    # RXM
+    (0x02, 0x30), (0x02, 0x31), (0x02, 0x10), (0x02, 0x13), (0x02, 0x20), (0x02, 0x61), (0x02, 0x14),
+    (0x02, 0x15), (0x02, 0x59), (0x02, 0x11),
+    # UPD
+    (0x09, 0x14),
+    # MON
+    (0x0A, 0x05), (0x0A, 0x09), (0x0A, 0x0B), (0x0A, 0x02), (0x0A, 0x06), (0x0A, 0x07), (0x0A, 0x21),
+    (0x0A, 0x2E), (0x0A, 0x08),
+    # AID
+    (0x0B, 0x30), (0x0B, 0x50), (0x0B, 0x33), (0x0B, 0x31), (0x0B, 0x32), (0x0B, 0x02), (0x0B, 0x01),
+    (0x0B, 0x00),
+    # TIM
+    (0x0D, 0x04), (0x0D, 0x03), (0x0D, 0x01), (0x0D, 0x06), (0x0D, 0x11), (0x0D, 0x16), (0x0D, 0x13),
+    (0x0D, 0x12), (0x0D, 0x15),
+    # ESF
+    (0x10, 0x02), (0x10, 0x10), (0x10, 0x15),
+    # MGA
+    (0x13, 0x80), (0x13, 0x21),
+    # LOG
+    (0x21, 0x0E), (0x21, 0x08), (0x21, 0x0B), (0x21, 0x0F), (0x21, 0x0D),
+    # SEC
+    (0x27, 0x01), (0x27, 0x03),
+    # HNR
+    (0x28, 0x00))
+
+# DTM   GBS    GGA    GLL    GRS    GSA    GST    GSV    RMC
+# VTG   ZDA    PUBX 00     PUBX 03    PUBX 04
+NMEA_MESSAGES = ((0xF0, 0x0A), (0xF0, 0x09), (0xF0, 0x00), (0xF0, 0x01), (0xF0, 0x06), (0xF0, 0x02), (0xF0, 0x07),
+                 (0xF0, 0x03), (0xF0, 0x04), (0xF0, 0x05), (0xF0, 0x08), (0xF1, 0x00), (0xF1, 0x03), (0xF1, 0x04))
+
+# navBbrMask of CFG-RST, the reset itself being a controlled software reset of the GNSS only
+RESETS = {'Cold RST': 0xA1FF, 'Warm RST': 0x0001, 'Hot RST': 0x0000}
+
+
+def checksum(data):
+    # Computes the 8-Bit Fletcher checksum of a UBX message
+    # Input:
+    # data: class, id, length and payload of the message
+    # Return:
+    # the two checksum bytes CK_A, CK_B
+    ck_a = 0
+    ck_b = 0
+    for byte in data:
+        ck_a = (ck_a + byte) & 0xff
+        ck_b = (ck_b + ck_a) & 0xff
+    return bytes((ck_a, ck_b))
+
+
+def message(cls, id, payload=b''):
+    # Builds a UBX message
+    # Input:
+    # cls, id: class and id of the message
+    # payload: bytes of the payload
+    # Return:
+    # the message, sync chars and checksum included
+    data = bytes((cls, id, len(payload) & 0xff, len(payload) >> 8)) + bytes(payload)
+    return SYNC + data + checksum(data)
+
+
+def cfg_msg(cls, id, rate):
+    # Builds the CFG-MSG message setting the output rate of a message on the current port
+    # Input:
+    # cls, id: class and id of the message
+    # rate: one message every rate navigation solutions, 0 to switch the message off
+    return message(*CFG_MSG, payload=bytes((cls, id, rate)))
+
+
+def cfg_rst(nav_bbr_mask, reset_mode=2):
+    # Builds the CFG-RST message
+    # Input:
+    # nav_bbr_mask: data of the battery backed RAM to clear
+    # reset_mode: 2 for a controlled software reset of the GNSS only
+    return message(*CFG_RST, payload=struct.pack('<HBB', nav_bbr_mask, reset_mode, 0))
+
+
+class AckTracker:
+    # Matches the ACK-ACK and ACK-NAK messages to the configuration messages waiting for them. The receiver
+    # answers the messages of a same class and id in the order they were sent, so that several commands can be
+    # in flight at the same time.
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def expect(self, cls, id):
+        # Registers a configuration message about to be sent
+        # Input:
+        # cls, id: class and id of the message
+        # Return:
+        # a Future whose result is True on ACK-ACK and False on ACK-NAK
+        future = Future()
+        with self.lock:
+            self.pending.setdefault((cls, id), collections.deque()).append(future)
+        return future
+
+    def feed(self, frames):
+        # Input:
+        # frames: list of ('UBX', message) or ('NMEA', sentence) tuples, as given by Framer.feed
+        for kind, frame in frames:
+            if kind != 'UBX' or frame[2:4] not in (bytes(ACK_ACK), bytes(ACK_NAK)) or len(frame) < 10:
+                continue
+            with self.lock:
+                waiting = self.pending.get((frame[6], frame[7]))
+                if waiting:
+                    waiting.popleft().set_result(frame[3] == ACK_ACK[1])
+
+    def forget(self, future):
+        # Cancels a future which will not be waited for any more, so that a late answer is not given to the
+        # next message of the same class and id
+        with self.lock:
+            for waiting in self.pending.values():
+                if future in waiting:
+                    waiting.remove(future)
+                    future.cancel()
+
+
+class PollScheduler:
+    # Polls messages at their own interval. The deadlines are kept on a fixed grid from the time each message
+    # was added, so that a late tick delays one poll but does not shift the following ones. The scheduler only
+    # gives back the bytes to send: it is ticked by the thread which owns the serial port.
+
+    def __init__(self):
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, cls, id, interval, now):
+        # Input:
+        # cls, id: class and id of the message
+        # interval: time between two polls in seconds
+        # now: time of the first poll, on the clock given to due
+        with self.lock:
+            self.entries[(cls, id)] = [interval, now, message(cls, id)]
+
+    def remove(self, cls, id):
+        with self.lock:
+            self.entries.pop((cls, id), None)
+
+    def due(self, now):
+        # Input:
+        # now: current time
+        # Return:
+        # the poll messages to send now, in a single bytes object
+        data = b''
+        with self.lock:
+            for entry in self.entries.values():
+                interval, deadline, poll = entry
+                if deadline <= now:
+                    data += poll
+                    entry[1] = deadline + interval * (math.floor((now - deadline) / interval) + 1)
+        return data
+
+
+class Transaction:
+    # Collects UBX messages to send them to the receiver with a single write. Used as a context manager, the
+    # messages are sent when leaving the with block, unless an error occurred. With a tracker, a future is
+    # kept in futures for each message to acknowledge, see AckTracker: the configuration messages whose answer is
+    # awaited by the caller, the polls being left out.
+
+    def __init__(self, device, tracker=None):
+        # Input:
+        # device: serial port of the receiver
+        # tracker: AckTracker of the receiver, or None
+        self.device = device
+        self.tracker = tracker
+        self.messages = []
+        self.futures = []
+
+    def add(self, cls, id, payload=b'', acknowledge=False):
+        # Input:
+        # cls, id, payload: message to send
+        # acknowledge: wait for the ACK-ACK or ACK-NAK of a configuration message, its future being in futures
+        self.messages.append(message(cls, id, payload))
+        if self.tracker is not None and acknowledge and cls == CFG_MSG[0]:
+            self.futures.append(self.tracker.expect(cls, id))
+        return self
+
+    def set_rate(self, cls, id, rate):
+        return self.add(*CFG_MSG, payload=bytes((cls, id, rate)), acknowledge=True)
+
+    def commit(self):
+        # Return:
+        # the number of messages sent
+        count = len(self.messages)
+        if count:
+            self.device.write(b''.join(self.messages))
+        self.messages = []
+        return count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        elif self.tracker is not None:
+            for future in self.futures:
+                self.tracker.forget(future)
+        return False
+
+
+def nmea_valid(sentence):
+    # Checks the checksum of a NMEA sentence, sentences without checksum are accepted
+    # Input:
+    # sentence: bytes from '$' to the end of line
+    star = sentence.rfind(b'*')
+    if star < 0:
+        return True
+    value = 0
+    for byte in sentence[1:star]:
+        value ^= byte
+    try:
+        return value == int(sentence[star + 1:star + 3], 16)
+    except ValueError:
+        return False
+
+
+class Framer:
+    # Splits the byte stream of the receiver into complete messages. Bytes can be fed in chunks of any size,
+    # the end of an incomplete message being kept until the next chunk arrives.
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.checksum_failures = 0
+        self.resyncs = 0
+
+    def feed(self, data):
+        # Input:
+        # data: bytes read from the receiver
+        # Return:
+        # frames: list of the complete messages, as ('UBX', message) or ('NMEA', sentence) tuples
+        buf = self.buffer
+        buf += data
+        frames = []
+        i = 0
+        # next sync chars, only searched again once passed so that long NMEA streams are scanned once
+        ubx = buf.find(SYNC)
+        while True:
+            if 0 <= ubx < i:
+                ubx = buf.find(SYNC, i)
+            nmea = buf.find(b'$', i, ubx if ubx >= 0 else len(buf))
+            start = nmea if nmea >= 0 else ubx
+            if start < 0:
+                # keep a possible first sync byte
+                keep = len(buf) - 1 if buf[-1:] == SYNC[:1] else len(buf)
+                if keep > i:
+                    self.resyncs += 1
+                i = keep
+                break
+            if start > i:
+                self.resyncs += 1
+            i = start
+            if start == ubx:
+                if len(buf) < start + 6:
+                    break
+                length = buf[start + 4] | buf[start + 5] << 8
+                if length > MAX_UBX_LENGTH:
+                    i = start + 1
+                    continue
+                end = start + 8 + length
+                if len(buf) < end:
+                    break
+                if checksum(buf[start + 2:end - 2]) != buf[end - 2:end]:
+                    self.checksum_failures += 1
+                    i = start + 1
+                    continue
+                frames.append(('UBX', bytes(buf[start:end])))
+            else:
+                end = buf.find(b'\n', start, start + MAX_NMEA_LENGTH)
+                if end < 0:
+                    if len(buf) - start >= MAX_NMEA_LENGTH:
+                        i = start + 1
+                        continue
+                    break
+                end += 1
+                if not nmea_valid(bytes(buf[start:end]).rstrip()):
+                    self.checksum_failures += 1
+                    i = start + 1
+                    continue
+                frames.append(('NMEA', bytes(buf[start:end])))
+            i = end
+        del buf[:i]
+        return frames
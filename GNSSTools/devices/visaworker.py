@@ -0,0 +1,109 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# I/O worker owning the pyvisa resource of the Spectracom: the commands of all the threads are sent one at a time
+# from a priority queue, the control and motion commands first, the log polling second and the diagnostics last,
+# so that a slow answer to a status query does not delay the steering of the scenario.
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import collections
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+CONTROL = 0
+LOGGING = 1
+DIAGNOSTICS = 2
+PRIORITIES = {CONTROL: 'control', LOGGING: 'logging', DIAGNOSTICS: 'diagnostics'}
+
+
+class VisaWorker:
+    # A command being sent is never interrupted: a control command waits at most for the end of the command in
+    # progress. Commands of the same priority are sent in the order they were given.
+
+    def __init__(self, resource, history=1000):
+        # Input:
+        # resource: pyvisa resource, only used by the worker thread from now on
+        # history: number of commands whose timing is kept
+        self.resource = resource
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        # (priority, message, queue wait, instrument latency) of the last commands, in seconds
+        self.records = collections.deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='visa-worker', daemon=True)
+        self.thread.start()
+
+    def submit(self, method, message, priority):
+        # Input:
+        # method: 'write' or 'query', method of the resource called with the message, or 'call'
+        # message: SCPI message, or function called with the resource for 'call'
+        # priority: CONTROL, LOGGING or DIAGNOSTICS
+        # Return:
+        # a Future whose result is the one of the resource method
+        if priority not in PRIORITIES:
+            raise ValueError('Unknown priority %s' % priority)
+        future = Future()
+        self.queue.put((priority, next(self.sequence), method, message, future, time.monotonic()))
+        return future
+
+    def write(self, message, priority=CONTROL):
+        return self.submit('write', message, priority)
+
+    def query(self, message, priority=DIAGNOSTICS):
+        return self.submit('query', message, priority)
+
+    def call(self, function, priority=DIAGNOSTICS):
+        # Runs a function using the resource for several reads and writes which must not be interrupted
+        # Input:
+        # function: called with the resource as argument
+        # Return:
+        # a Future whose result is the one of the function
+        return self.submit('call', function, priority)
+
+    def run(self):
+        # Worker thread
+        while True:
+            priority, _, method, message, future, queued = self.queue.get()
+            if method is None:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.monotonic()
+            try:
+                if method == 'call':
+                    result = message(self.resource)
+                else:
+                    result = getattr(self.resource, method)(message)
+            except Exception as error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            with self.lock:
+                self.records.append((priority, message, started - queued, time.monotonic() - started))
+
+    def stats(self):
+        # Return:
+        # dictionary {priority name: {'commands', 'mean_wait', 'max_wait', 'mean_latency', 'max_latency'}} over
+        # the commands of the history, the times in seconds
+        with self.lock:
+            records = list(self.records)
+        stats = {}
+        for priority, name in PRIORITIES.items():
+            waits = [wait for origin, _, wait, _ in records if origin == priority]
+            latencies = [latency for origin, _, _, latency in records if origin == priority]
+            stats[name] = {'commands': len(waits),
+                           'mean_wait': sum(waits) / len(waits) if waits else 0.0,
+                           'max_wait': max(waits, default=0.0),
+                           'mean_latency': sum(latencies) / len(latencies) if latencies else 0.0,
+                           'max_latency': max(latencies, default=0.0)}
+        return stats
+
+    def close(self):
+        # Stops the worker once the commands already given are sent
+        self.queue.put((len(PRIORITIES), next(self.sequence), None, None, None, time.monotonic()))
+        self.thread.join()
@@ -0,0 +1,83 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Steering of the Spectracom vehicle to a waypoint: the great-circle heading is sent once and the position is only
+# read again at the predicted arrival, or at the correction period for long legs, the log being polled at its
+# output rate in the meantime
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+from GNSSTools import tools
+from GNSSTools.devices.visaworker import CONTROL
+
+
+class WaypointPlanner:
+
+    def __init__(self, spectracom, poller, tolerance=5.0, correction=10.0, resend=0.5, patience=10):
+        # Input:
+        # spectracom: Spectracom generator
+        # poller: LogPoller of the scenario, which stores the log while waiting
+        # tolerance: distance to the waypoint in m at which it is reached
+        # correction: longest time between two reads of the position in s
+        # resend: smallest heading change in degrees sent to the generator
+        # patience: number of log epochs in a row without position after which steering fails
+        self.spectracom = spectracom
+        self.poller = poller
+        self.tolerance = tolerance
+        self.correction = correction
+        self.resend = resend
+        self.patience = patience
+        self.heading = None
+        self.commands = 0
+
+    def position(self):
+        # Return:
+        # current position of the vehicle, read from one LOG query
+        self.poller.poll()
+        return tools.gga_position(self.poller.last)
+
+    def speed(self):
+        # Return:
+        # current speed over ground of the vehicle in m/s
+        return float(self.spectracom.ask('SOURce:SCENario:SPEed?', CONTROL).split(',')[-1])
+
+    def steer(self, lat, long, speed=None):
+        # Heads to the waypoint and returns once it is reached
+        # Input:
+        # lat, long: waypoint in decimal degrees
+        # speed: speed of the vehicle in m/s, read from the generator if None
+        # Return:
+        # the last position read
+        # Raises:
+        # ValueError: if the vehicle does not move, or if the log gives no position for patience epochs
+        if speed is None:
+            speed = self.speed()
+        if speed <= 0:
+            raise ValueError('The vehicle must move to reach a waypoint')
+        # the position is only known once per log epoch
+        tolerance = max(self.tolerance, speed * self.poller.period)
+        self.heading = None
+        position = self.position()
+        empty = 0
+        while True:
+            if position is None:
+                empty += 1
+                if empty > self.patience:
+                    raise ValueError('No position in the log for %d epochs' % self.patience)
+                self.poller.run(self.poller.period)
+                position = self.position()
+                continue
+            empty = 0
+            remaining = tools.haversine(position.lat, position.long, lat, long)
+            heading = tools.bearing(position.lat, position.long, lat, long)
+            if remaining <= tolerance or (self.heading is not None and
+                                          abs((heading - self.heading + 180) % 360 - 180) > 90):
+                # reached, or passed between two reads
+                return position
+            if self.heading is None or abs((heading - self.heading + 180) % 360 - 180) >= self.resend:
+                self.spectracom.set_heading(heading)
+                self.heading = heading
+                self.commands += 1
+            self.poller.run(min(remaining / speed, self.correction))
+            position = self.position() or position
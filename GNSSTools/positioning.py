@@ -0,0 +1,413 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Single point positioning from the Ublox RXM-RAW pseudoranges: satellite positions from the broadcast
+# ephemeris, coordinates conversions, Klobuchar ionospheric model and a least squares solver vectorized
+# over all the epochs of a run. Visibility of the satellites along a trajectory from a YUMA almanac.
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import datetime
+import math
+import numpy as np
+
+C = 299792458.0  # speed of light in m/s
+MU = 3.986005e14  # WGS84 value for the earth's universal gravitational parameter for GPS user in meters^3/sec^2
+OMEGAEDOT = 7.2921151467e-5  # WGS84 value of the earth's rotation rate in rad/sec
+F_REL = -4.442807633e-10  # relativistic correction term constant in sec/meter^(1/2)
+WGS84_A = 6378137.0  # semi-major axis in meters
+WGS84_F = 1 / 298.257223563  # flattening
+
+# Broadcast ephemeris of one satellite, as decoded by Ublox.ephemeris_data
+EPH_DTYPE = np.dtype([('svid', 'u1'), ('wn', '<i4'), ('toe', '<f8'), ('toc', '<f8'), ('tgd', '<f8'),
+                      ('af0', '<f8'), ('af1', '<f8'), ('af2', '<f8'), ('sqrta', '<f8'), ('e', '<f8'),
+                      ('m0', '<f8'), ('deltan', '<f8'), ('omega0', '<f8'), ('omega', '<f8'),
+                      ('omegadot', '<f8'), ('i0', '<f8'), ('idot', '<f8'), ('cuc', '<f8'),
+                      ('cus', '<f8'), ('crc', '<f8'), ('crs', '<f8'), ('cic', '<f8'), ('cis', '<f8')])
+
+# Position solution of one epoch
+PVT_DTYPE = np.dtype([('epoch', '<u4'), ('rcvtow', '<i4'), ('week', '<i2'), ('x', '<f8'), ('y', '<f8'),
+                      ('z', '<f8'), ('clockbias', '<f8'), ('lat', '<f8'), ('long', '<f8'), ('alt', '<f8'),
+                      ('numsv', 'u1'), ('gdop', '<f8'), ('rms', '<f8')])
+
+# Satellite seen from the receiver at one epoch, tow in seconds, az and elev in decimal degrees
+SKY_DTYPE = np.dtype([('epoch', '<u4'), ('tow', '<f8'), ('svid', 'u1'), ('az', '<f8'), ('elev', '<f8')])
+
+# Almanac of one satellite, as given by a YUMA almanac file (alm_gps.txt of the Spectracom)
+ALM_DTYPE = np.dtype([('svid', 'u1'), ('health', '<u2'), ('e', '<f8'), ('toa', '<f8'), ('i0', '<f8'),
+                      ('omegadot', '<f8'), ('sqrta', '<f8'), ('omega0', '<f8'), ('omega', '<f8'), ('m0', '<f8'),
+                      ('af0', '<f8'), ('af1', '<f8'), ('week', '<i4')])
+# beginning of the labels of a YUMA almanac, in the order of ALM_DTYPE
+YUMA_LABELS = ('ID', 'Health', 'Eccentricity', 'Time of Applicability', 'Orbital Inclination',
+               'Rate of Right Ascen', 'SQRT(A)', 'Right Ascen at Week', 'Argument of Perigee', 'Mean Anom', 'Af0',
+               'Af1', 'week')
+GPS_EPOCH = datetime.date(1980, 1, 6)
+
+
+def ephemeris_table(ephemeris):
+    # Flattens the ephemeris decoded by Ublox.ephemeris_data into an array
+    # Input:
+    # ephemeris: dictionary returned by Ublox.ephemeris_data
+    # Return:
+    # array of EPH_DTYPE records sorted by svid and toe, duplicated ephemerides removed
+    rows = []
+    for group in ephemeris.values():
+        for eph in group.values():
+            rows.append(tuple(eph[name] for name in EPH_DTYPE.names))
+    table = np.array(rows, dtype=EPH_DTYPE)
+    table = table[np.lexsort((table['toe'], table['svid']))]
+    if len(table) > 1:
+        keep = np.ones(len(table), dtype=bool)
+        keep[1:] = (table['svid'][1:] != table['svid'][:-1]) | (table['toe'][1:] != table['toe'][:-1])
+        table = table[keep]
+    return table
+
+
+def select_ephemeris(table, svid, t):
+    # Picks for every measurement the ephemeris of the satellite with the closest reference time
+    # Input:
+    # table: array of EPH_DTYPE records sorted by svid and toe
+    # svid: array of satellite IDs
+    # t: array of GPS times of week in seconds
+    # Return:
+    # index: index in table of the chosen ephemeris, -1 when the satellite has no ephemeris
+    svid = np.asarray(svid, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    key = table['svid'] * 1e7 + table['toe']
+    pos = np.searchsorted(key, svid * 1e7 + t)
+    before = np.clip(pos - 1, 0, len(table) - 1)
+    after = np.clip(pos, 0, len(table) - 1)
+    index = np.where(np.abs(table['toe'][before] - t) <= np.abs(table['toe'][after] - t), before, after)
+    # the neighbour may belong to the next satellite
+    other = np.where(index == before, after, before)
+    index = np.where(table['svid'][index] == svid, index, other)
+    return np.where(table['svid'][index] == svid, index, -1)
+
+
+def satellite_positions(eph, t):
+    # Computes the ECEF positions and clock corrections of satellites, vectorized over measurements
+    # Input:
+    # eph: array of EPH_DTYPE records, one per measurement
+    # t: array of GPS times of week in seconds (transmission time)
+    # Return:
+    # xyz: array (n, 3) of ECEF positions in meters
+    # dt: array of satellite clock corrections in seconds (including relativistic effect and TGD)
+    t = np.asarray(t, dtype=np.float64)
+    a = eph['sqrta'] ** 2
+    n = np.sqrt(MU / a ** 3) + eph['deltan']
+    tk = _wrap_week(t - eph['toe'])
+    mk = eph['m0'] + n * tk
+    ek = mk
+    for _ in range(10):
+        ek = mk + eph['e'] * np.sin(ek)
+    vk = np.arctan2(np.sqrt(1 - eph['e'] ** 2) * np.sin(ek), np.cos(ek) - eph['e'])
+    phik = vk + eph['omega']
+    sin2, cos2 = np.sin(2 * phik), np.cos(2 * phik)
+    uk = phik + eph['cus'] * sin2 + eph['cuc'] * cos2
+    rk = a * (1 - eph['e'] * np.cos(ek)) + eph['crs'] * sin2 + eph['crc'] * cos2
+    ik = eph['i0'] + eph['idot'] * tk + eph['cis'] * sin2 + eph['cic'] * cos2
+    xkp = rk * np.cos(uk)
+    ykp = rk * np.sin(uk)
+    omegak = eph['omega0'] + (eph['omegadot'] - OMEGAEDOT) * tk - OMEGAEDOT * eph['toe']
+    xyz = np.empty(t.shape + (3,))
+    xyz[..., 0] = xkp * np.cos(omegak) - ykp * np.cos(ik) * np.sin(omegak)
+    xyz[..., 1] = xkp * np.sin(omegak) + ykp * np.cos(ik) * np.cos(omegak)
+    xyz[..., 2] = ykp * np.sin(ik)
+    tc = _wrap_week(t - eph['toc'])
+    dt = eph['af0'] + eph['af1'] * tc + eph['af2'] * tc ** 2 + F_REL * eph['e'] * eph['sqrta'] * np.sin(ek)
+    return xyz, dt - eph['tgd']
+
+
+def ecef_to_lla(xyz):
+    # Converts ECEF coordinates into WGS84 latitude, longitude and altitude
+    # Input:
+    # xyz: array (..., 3) of ECEF positions in meters
+    # Return:
+    # lat, long in decimal degrees, alt in meters
+    xyz = np.asarray(xyz, dtype=np.float64)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    e2 = WGS84_F * (2 - WGS84_F)
+    p = np.hypot(x, y)
+    lat = np.arctan2(z, p * (1 - e2))
+    for _ in range(5):
+        n = WGS84_A / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+        alt = p / np.cos(lat) - n
+        lat = np.arctan2(z, p * (1 - e2 * n / (n + alt)))
+    n = WGS84_A / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    alt = p / np.cos(lat) - n
+    return np.degrees(lat), np.degrees(np.arctan2(y, x)), alt
+
+
+def lla_to_ecef(lat, long, alt):
+    # Converts WGS84 latitude, longitude (decimal degrees) and altitude (meters) into ECEF coordinates
+    # Return:
+    # array (..., 3) of ECEF positions in meters
+    lat, long = np.radians(lat), np.radians(long)
+    alt = np.asarray(alt, dtype=np.float64)
+    e2 = WGS84_F * (2 - WGS84_F)
+    n = WGS84_A / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+    return np.stack(((n + alt) * np.cos(lat) * np.cos(long), (n + alt) * np.cos(lat) * np.sin(long),
+                     (n * (1 - e2) + alt) * np.sin(lat)), axis=-1)
+
+
+def azimuth_elevation(receiver, satellite):
+    # Computes the azimuth and elevation of satellites seen from receivers
+    # Input:
+    # receiver: array (..., 3) of ECEF receiver positions in meters
+    # satellite: array (..., 3) of ECEF satellite positions in meters, broadcastable with receiver
+    # Return:
+    # az, elev in decimal degrees, azimuth in [0, 360)
+    receiver = np.asarray(receiver, dtype=np.float64)
+    lat, long, _ = ecef_to_lla(receiver)
+    lat, long = np.radians(lat), np.radians(long)
+    d = np.asarray(satellite, dtype=np.float64) - receiver
+    east = -np.sin(long) * d[..., 0] + np.cos(long) * d[..., 1]
+    north = (-np.sin(lat) * np.cos(long) * d[..., 0] - np.sin(lat) * np.sin(long) * d[..., 1] +
+             np.cos(lat) * d[..., 2])
+    up = (np.cos(lat) * np.cos(long) * d[..., 0] + np.cos(lat) * np.sin(long) * d[..., 1] +
+          np.sin(lat) * d[..., 2])
+    az = np.degrees(np.arctan2(east, north)) % 360
+    elev = np.degrees(np.arctan2(up, np.hypot(east, north)))
+    return az, elev
+
+
+def _wrap_week(dt):
+    # Accounts for beginning or end of week crossovers
+    return dt - 604800 * np.round(dt / 604800)
+
+
+def klobuchar_delay(klobuchar, tow, lat, long, az, elev):
+    # Evaluates the Klobuchar ionospheric model (IS-GPS-200) for the GPS L1 frequency. All the array inputs are
+    # broadcast together, so a whole run is evaluated in one call.
+    # Input:
+    # klobuchar: one entry of the dictionary returned by Ublox.klobuchar_data
+    # tow: GPS time of week (or time of day) of the measurements in seconds
+    # lat, long: receiver position in decimal degrees
+    # az, elev: azimuth and elevation of the satellites in decimal degrees
+    # Return:
+    # delay: ionospheric delay in meters
+    alpha = [klobuchar['kloa3'], klobuchar['kloa2'], klobuchar['kloa1'], klobuchar['kloa0']]
+    beta = [klobuchar['klob3'], klobuchar['klob2'], klobuchar['klob1'], klobuchar['klob0']]
+    el = np.asarray(elev, dtype=np.float64) / 180
+    az = np.radians(az)
+    psi = 0.0137 / (el + 0.11) - 0.022
+    phii = np.clip(np.asarray(lat) / 180 + psi * np.cos(az), -0.416, 0.416)
+    lami = np.asarray(long) / 180 + psi * np.sin(az) / np.cos(phii * math.pi)
+    phim = phii + 0.064 * np.cos((lami - 1.617) * math.pi)
+    t = (4.32e4 * lami + np.asarray(tow)) % 86400
+    f = 1 + 16 * (0.53 - el) ** 3
+    amp = np.maximum(np.polyval(alpha, phim), 0)
+    per = np.maximum(np.polyval(beta, phim), 72000)
+    x = 2 * math.pi * (t - 50400) / per
+    delay = np.where(np.abs(x) < 1.57, f * (5e-9 + amp * (1 - x ** 2 / 2 + x ** 4 / 24)), f * 5e-9)
+    return C * delay
+
+
+def gps_week(date):
+    # Input:
+    # date: datetime.date
+    # Return:
+    # the full GPS week number of the date
+    return (date - GPS_EPOCH).days // 7
+
+
+def read_almanac(text):
+    # Parses a YUMA almanac
+    # Input:
+    # text: content of the almanac file
+    # Return:
+    # array of ALM_DTYPE records sorted by svid
+    rows = []
+    values = {}
+    for line in text.splitlines() + ['*']:
+        if line.startswith('*'):
+            if len(values) == len(YUMA_LABELS):
+                rows.append(tuple(values[name] for name in ALM_DTYPE.names))
+            values = {}
+            continue
+        label, _, value = line.partition(':')
+        for name, start in zip(ALM_DTYPE.names, YUMA_LABELS):
+            if label.strip().startswith(start):
+                values[name] = float(value)
+                break
+    table = np.array(rows, dtype=ALM_DTYPE)
+    return table[np.argsort(table['svid'], kind='stable')]
+
+
+def almanac_positions(almanac, t):
+    # Computes the ECEF positions of the satellites of an almanac
+    # Input:
+    # almanac: array of ALM_DTYPE records
+    # t: array (...) of GPS times of week in seconds, broadcastable with almanac
+    # Return:
+    # array (..., 3) of ECEF positions in meters
+    eph = np.zeros(almanac.shape, dtype=EPH_DTYPE)
+    for name in ('svid', 'e', 'i0', 'omegadot', 'sqrta', 'omega0', 'omega', 'm0', 'af0', 'af1'):
+        eph[name] = almanac[name]
+    eph['toe'] = eph['toc'] = almanac['toa']
+    t, eph = np.broadcast_arrays(np.asarray(t, dtype=np.float64), eph)
+    return satellite_positions(eph, t)[0]
+
+
+def visibility(almanac, tow, lat, long, alt, elevation_mask=5.0):
+    # Predicts the satellites seen along a trajectory, vectorized over the epochs and the satellites
+    # Input:
+    # almanac: array of ALM_DTYPE records
+    # tow: array of GPS times of week in seconds, one per epoch
+    # lat, long, alt: receiver position of each epoch in decimal degrees and meters
+    # elevation_mask: satellites below this elevation in degrees are not seen
+    # Return:
+    # az, elev: arrays (epochs, satellites) in decimal degrees, in the order of almanac
+    # count: number of healthy satellites above the mask at each epoch
+    # gdop: geometric dilution of precision of these satellites at each epoch, NaN with fewer than 4
+    tow = np.atleast_1d(np.asarray(tow, dtype=np.float64))
+    receiver = np.broadcast_to(lla_to_ecef(lat, long, alt), tow.shape + (3,))
+    satellite = almanac_positions(almanac, tow[:, None])
+    az, elev = azimuth_elevation(receiver[:, None, :], satellite)
+    seen = (elev >= elevation_mask) & (almanac['health'] == 0)
+    count = seen.sum(axis=1)
+    los = satellite - receiver[:, None, :]
+    h = np.concatenate((-los / np.linalg.norm(los, axis=-1)[..., None], np.ones(elev.shape + (1,))), axis=-1)
+    h = h * seen[..., None]
+    solvable = count >= 4
+    normal = np.einsum('esi,esj->eij', h, h) + np.eye(4) * (~solvable)[:, None, None]
+    gdop = np.sqrt(np.trace(np.linalg.inv(normal), axis1=1, axis2=2))
+    gdop[~solvable] = np.nan
+    return az, elev, count, gdop
+
+
+def sky_from_svsi(svsi):
+    # Flattens the RXM-SVSI data returned by Ublox.random_data into an array
+    # Input:
+    # svsi: third dictionary returned by Ublox.random_data
+    # Return:
+    # array of SKY_DTYPE records, satellites without a valid elevation left out
+    rows = []
+    for epoch, info in svsi.items():
+        for sat in info['info'].values():
+            if -90 <= sat['elev'] <= 90:
+                rows.append((epoch, info['itow'] / 1000.0, sat['svid'], sat['azim'], sat['elev']))
+    return np.array(rows, dtype=SKY_DTYPE)
+
+
+def sky_from_gsv(gsv, times=None):
+    # Flattens the NMEA GSV data returned by Device.nmea_gsv_store into an array
+    # Input:
+    # gsv: dictionary returned by Device.nmea_gsv_store
+    # times: UTC times in HHMMSS.DD of each GSV group (e.g. from the GGA sentences), None to leave tow unknown
+    # Return:
+    # array of SKY_DTYPE records, tow being the UTC time of day in seconds
+    rows = []
+    for epoch, sats in gsv.items():
+        if times is not None and epoch < len(times):
+            hhmmss = times[epoch]
+            tow = int(hhmmss[0:2]) * 3600 + int(hhmmss[2:4]) * 60 + float(hhmmss[4:])
+        else:
+            tow = np.nan
+        for sat in sats.values():
+            if sat['elevation'] != '' and sat['azimuth'] != '':
+                rows.append((epoch, tow, int(sat['Sat ID']), float(sat['azimuth']), float(sat['elevation'])))
+    return np.array(rows, dtype=SKY_DTYPE)
+
+
+def iono_delays(sky, klobuchar, lat, long):
+    # Computes the Klobuchar delay of every satellite of a sky table
+    # Input:
+    # sky: array of SKY_DTYPE records (sky_from_svsi, sky_from_gsv)
+    # klobuchar: one entry of the dictionary returned by Ublox.klobuchar_data
+    # lat, long: receiver position in decimal degrees, either fixed or one value per sky record
+    # Return:
+    # delay: array of ionospheric delays in meters, zero below the horizon
+    delay = klobuchar_delay(klobuchar, sky['tow'], lat, long, sky['az'], np.maximum(sky['elev'], 0))
+    return np.where(sky['elev'] >= 0, delay, 0)
+
+
+def solve(raw, ephemeris, klobuchar=None, iterations=8, elevation_mask=5.0, minquality=4):
+    # Computes a position and a receiver clock bias for every epoch of RXM-RAW measurements by iterative
+    # weighted least squares. All the epochs are solved together, satellites being padded per epoch.
+    # Input:
+    # raw: array of RAW_DTYPE records, as returned by Ublox.raw_data
+    # ephemeris: dictionary returned by Ublox.ephemeris_data, or array returned by ephemeris_table
+    # klobuchar: one entry of the dictionary returned by Ublox.klobuchar_data, None to skip the ionosphere
+    # iterations: number of least squares iterations
+    # elevation_mask: satellites below this elevation in degrees are discarded once the position is known
+    # minquality: minimum measurement quality indicator (mesqi) of the pseudoranges used
+    # Return:
+    # array of PVT_DTYPE records, one per epoch, NaN where fewer than 4 satellites are available.
+    # clockbias in meters, lat and long in decimal degrees, alt in meters, rms of the residuals in meters
+    table = ephemeris if isinstance(ephemeris, np.ndarray) else ephemeris_table(ephemeris)
+    raw = np.asarray(raw)
+    raw = raw[(raw['prmes'] > 0) & (raw['mesqi'] >= minquality)]
+    trx = raw['rcvtow'] / 1000.0
+    index = select_ephemeris(table, raw['sv'], trx)
+    raw, trx, eph = raw[index >= 0], trx[index >= 0], table[index[index >= 0]]
+
+    # one row per epoch, one column per satellite of the epoch
+    epochs, row = np.unique(raw['epoch'], return_inverse=True)
+    order = np.argsort(row, kind='stable')
+    counts = np.bincount(row, minlength=len(epochs))
+    col = np.empty(len(raw), dtype=np.int64)
+    col[order] = np.arange(len(raw)) - np.repeat(np.cumsum(counts) - counts, counts)
+    shape = (len(epochs), counts.max() if len(raw) else 0)
+    valid = np.zeros(shape, dtype=bool)
+    valid[row, col] = True
+
+    # satellite positions at transmission time
+    tau = raw['prmes'] / C
+    _, dt = satellite_positions(eph, trx - tau)
+    sat, dt = satellite_positions(eph, trx - tau - dt)
+    satecef = np.zeros(shape + (3,))
+    satecef[row, col] = sat
+    pr = np.zeros(shape)
+    pr[row, col] = raw['prmes'] + C * dt
+    tow = np.zeros(shape)
+    tow[row, col] = trx
+
+    state = np.zeros((len(epochs), 4))
+    weight = valid.astype(np.float64)
+    for it in range(iterations):
+        # rotation of the earth during the signal travel time
+        theta = OMEGAEDOT * (pr - state[:, 3:4]) / C * valid
+        satxyz = np.stack((np.cos(theta) * satecef[..., 0] + np.sin(theta) * satecef[..., 1],
+                           -np.sin(theta) * satecef[..., 0] + np.cos(theta) * satecef[..., 1],
+                           satecef[..., 2]), axis=-1)
+        los = satxyz - state[:, None, :3]
+        rho = np.linalg.norm(los, axis=-1)
+        rho[~valid] = 1
+        corr = np.zeros(shape)
+        known = np.linalg.norm(state[:, :3], axis=-1) > 6.0e6
+        if it > 0 and known.any():
+            lat, long, _ = ecef_to_lla(state[:, :3])
+            az, elev = azimuth_elevation(state[:, None, :3], satxyz)
+            elev = np.maximum(elev, 0.1)
+            corr = 2.47 / (np.sin(np.radians(elev)) + 0.0121)  # troposphere
+            if klobuchar is not None:
+                corr = corr + klobuchar_delay(klobuchar, tow, lat[:, None], long[:, None], az, elev)
+            weight = np.where(valid & (elev >= elevation_mask), np.sin(np.radians(elev)) ** 2, 0)
+            weight[~known] = valid[~known]
+            corr[~known] = 0
+        h = np.concatenate((-los / rho[..., None], np.ones(shape + (1,))), axis=-1)
+        residual = (pr - rho - state[:, 3:4] - corr) * (weight > 0)
+        hw = h * weight[..., None]
+        normal = np.einsum('esi,esj->eij', hw, h)
+        solvable = (weight > 0).sum(axis=1) >= 4
+        normal[~solvable] = np.eye(4)
+        delta = np.einsum('eij,ej->ei', np.linalg.pinv(normal), np.einsum('esi,es->ei', hw, residual))
+        state += delta * solvable[:, None]
+
+    solution = np.zeros(len(epochs), dtype=PVT_DTYPE)
+    first = np.cumsum(counts) - counts
+    solution['epoch'] = epochs
+    solution['rcvtow'] = raw['rcvtow'][order][first] if len(raw) else []
+    solution['week'] = raw['week'][order][first] if len(raw) else []
+    solution['x'], solution['y'], solution['z'], solution['clockbias'] = state.T
+    solution['lat'], solution['long'], solution['alt'] = ecef_to_lla(state[:, :3])
+    solution['numsv'] = (weight > 0).sum(axis=1)
+    cofactor = np.linalg.pinv(np.einsum('esi,esj->eij', h * (weight > 0)[..., None], h) +
+                             np.eye(4) * (~solvable)[:, None, None])
+    solution['gdop'] = np.sqrt(np.trace(cofactor, axis1=1, axis2=2))
+    solution['rms'] = np.sqrt((residual ** 2).sum(axis=1) / np.maximum((weight > 0).sum(axis=1), 1))
+    for name in ('x', 'y', 'z', 'clockbias', 'lat', 'long', 'alt', 'gdop', 'rms'):
+        solution[name][~solvable] = np.nan
+    return solution
@@ -10,6 +10,12 @@
 
 import math
 import configparser
+from collections import namedtuple
+
+# position of a GGA sentence: time in HHMMSS.DD, latitude and longitude in signed decimal degrees, altitude in m
+Position = namedtuple('Position', ['time', 'lat', 'long', 'alt'])
+# mean radius of the Earth in m
+EARTH_RADIUS = 6371008.8
 
 
 def get_sec(date):
@@ -83,6 +89,76 @@ def heading_compute(lat1, lat2, long1, long2):
     return heading
 
 
+def bearing(lat1, long1, lat2, long2):
+    # Initial great-circle heading from a position to another one
+    # Input:
+    # lat1, long1: departure position in decimal degrees
+    # lat2, long2: arrival position in decimal degrees
+    # Return:
+    # heading in degrees [0, 360), clockwise from the true north
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dlong = math.radians(long2 - long1)
+    y = math.sin(dlong) * math.cos(phi2)
+    x = math.cos(phi1) * math.sin(phi2) - math.sin(phi1) * math.cos(phi2) * math.cos(dlong)
+    return math.degrees(math.atan2(y, x)) % 360
+
+
+def destination(lat, long, heading, distance):
+    # Position reached following a great circle
+    # Input:
+    # lat, long: departure position in decimal degrees
+    # heading: initial heading in degrees, clockwise from the true north
+    # distance: distance travelled in m
+    # Return:
+    # (lat, long) of the arrival position in decimal degrees, the longitude in [-180, 180)
+    phi, theta = math.radians(lat), math.radians(heading)
+    delta = distance / EARTH_RADIUS
+    phi2 = math.asin(math.sin(phi) * math.cos(delta) + math.cos(phi) * math.sin(delta) * math.cos(theta))
+    dlong = math.atan2(math.sin(theta) * math.sin(delta) * math.cos(phi),
+                       math.cos(delta) - math.sin(phi) * math.sin(phi2))
+    return math.degrees(phi2), (long + math.degrees(dlong) + 180) % 360 - 180
+
+
+def nmea_sentence(body):
+    # Input:
+    # body: sentence without $ and checksum, GPGGA,...
+    # Return:
+    # the NMEA sentence with its checksum and end of line
+    checksum = 0
+    for character in body.encode():
+        checksum ^= character
+    return '$%s*%02X\r\n' % (body, checksum)
+
+
+def nmea_dm(value, width):
+    # Converts decimal degrees into the NMEA shape
+    # Input:
+    # value: latitude or longitude in decimal degrees
+    # width: number of digits of the degrees, 2 for a latitude and 3 for a longitude
+    # Return:
+    # (d..dmm.mmmm, 0 for a positive value and 1 for a negative one)
+    degrees = abs(value)
+    whole = int(degrees)
+    return '%0*d%07.4f' % (width, whole, (degrees - whole) * 60), int(value < 0)
+
+
+def nmea_fix(date, lat, long, alt, speed, heading, numsv=8):
+    # Input:
+    # date: datetime of the position
+    # lat, long, alt: position in decimal degrees and m
+    # speed, heading: speed over ground in m/s and course in degrees
+    # numsv: number of satellites used
+    # Return:
+    # the GGA and RMC sentences of the position
+    stamp = date.strftime('%H%M%S.') + '%03d' % (date.microsecond // 1000)
+    lat, south = nmea_dm(lat, 2)
+    long, west = nmea_dm(long, 3)
+    position = '%s,%s,%s,%s' % (lat, 'NS'[south], long, 'EW'[west])
+    return nmea_sentence('GPGGA,%s,%s,1,%02d,0.9,%.1f,M,0.0,M,,' % (stamp, position, numsv, alt)) + \
+        nmea_sentence('GPRMC,%s,A,%s,%.1f,%.1f,%s,,,A' % (stamp, position, speed * 3600 / 1852, heading,
+                                                         date.strftime('%d%m%y')))
+
+
 def synchronisation(list1, list2):
     # Compare the time input of each list and synchronise them
     # Input:
@@ -103,11 +179,15 @@ def synchronisation(list1, list2):
 # RMS 1D error
 
 def haversine(lat1, long1, lat2, long2):
-    a = (math.sin(((lat2-lat1)*(math.pi/180))/2))**2 + math.cos(lat1) * math.cos(lat2) *\
-                                                       (math.sin(((long2-long1)*(math.pi/180))/2))**2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = 6378137 * c
-    return d
+    # Great-circle distance between two positions
+    # Input:
+    # lat1, long1, lat2, long2: positions in decimal degrees
+    # Return:
+    # distance in m
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
 
 def rms_1d_alt(new_list1, new_list2):
     # Compute the root mean square error in altitude
@@ -244,6 +324,24 @@ def data(filename):
     return gpgga
 
 
+def gga_position(text):
+    # Parses the last GGA sentence with a position of a text, without going through a file
+    # Input:
+    # text: NMEA sentences, as answered to SOURce:SCENario:LOG? for instance
+    # Return:
+    # the Position, None if there is no GGA sentence with a position
+    position = None
+    for line in text.splitlines():
+        if line[3:6] == 'GGA':
+            split = line.split(',')
+            if len(split) > 9 and split[2] != '' and split[4] != '':
+                lat = dm_to_dd(float(split[2]) / 100)
+                long = dm_to_dd(float(split[4]) / 100)
+                position = Position(split[1], -lat if split[3] == 'S' else lat, -long if split[5] == 'W' else long,
+                                    float(split[9]) if split[9] != '' else 0.0)
+    return position
+
+
 def computation(file1='datatxt/spectracom_data.nmea', file2='datatxt/ublox_processed_data.txt'):
     # Go through all RMS computation process (open file, data processing to get the proper shape,
     # synchronisation, RMS computations
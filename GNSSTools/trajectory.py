@@ -0,0 +1,170 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Reference trajectory of a scenario computed offline: the motion set by each section of a tools.read_scen
+# scenario (heading, speed, acceleration, rate heading, turn rate, turn radius, speed over ground, vertical
+# speed) is integrated the way scenario_reading drives the Spectracom, the settings not given by a section being
+# reset at its end by set_default. The truth is then known at every epoch without depending on the LOG polling.
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import datetime
+import math
+import numpy as np
+from GNSSTools import tools
+
+# Reference position at one time, time in seconds from the scenario start, lat and long in decimal degrees, alt
+# in meters, heading in degrees and speed in m/s
+TRUTH_DTYPE = np.dtype([('time', '<f8'), ('section', '<u2'), ('lat', '<f8'), ('long', '<f8'), ('alt', '<f8'),
+                        ('heading', '<f8'), ('speed', '<f8')])
+
+
+def _value(scenario, section, field):
+    # Return:
+    # the number of a field of a section, None if it is not given
+    value = scenario[section][field] if field < len(scenario[section]) else ''
+    return float(value) if value not in ('', []) else None
+
+
+def _integrate(state, t, acceleration, rate, radius, vspeed):
+    # Moves the vehicle with constant settings
+    # Input:
+    # state: [lat, long, alt, heading, speed] at t = 0
+    # t: increasing array of times in seconds from the section start, t[0] = 0
+    # acceleration: m/s2, the speed not going under 0
+    # rate: heading rate in degrees/s
+    # radius: turn radius in m, 0 for none
+    # vspeed: vertical speed in m/s
+    # Return:
+    # lat, long, alt, heading, speed arrays at the times t
+    lat, long, alt, heading, speed = state
+    # time when a deceleration stops the vehicle
+    stop = -speed / acceleration if acceleration < 0 else np.inf
+    moving = np.minimum(t, stop)
+    speeds = speed + acceleration * moving
+    travelled = speed * moving + acceleration * moving ** 2 / 2
+    dt = np.diff(t)
+    ds = np.diff(travelled)
+    middle = (speeds[1:] + speeds[:-1]) / 2
+    turn = rate + (np.degrees(middle / radius) if radius else 0.0)
+    headings = heading + np.concatenate(([0.0], np.cumsum(turn * dt)))
+    # the step follows the heading of its middle
+    bearing = np.radians(headings[:-1] + turn * dt / 2)
+    lats = lat + np.degrees(np.concatenate(([0.0], np.cumsum(ds * np.cos(bearing)))) / tools.EARTH_RADIUS)
+    middle_lat = np.radians((lats[1:] + lats[:-1]) / 2)
+    east = ds * np.sin(bearing) / np.cos(middle_lat)
+    longs = long + np.degrees(np.concatenate(([0.0], np.cumsum(east)))) / tools.EARTH_RADIUS
+    return lats, (longs + 180) % 360 - 180, alt + vspeed * t, headings % 360, speeds
+
+
+def reference(scenario, rate=1.0, step=0.1):
+    # Computes the reference trajectory of a scenario
+    # Input:
+    # scenario: matrix returned by tools.read_scen
+    # rate: rate of the trajectory in Hz
+    # step: longest integration step in seconds
+    # Return:
+    # array of TRUTH_DTYPE records from the start to the end of the last section
+    # Raises:
+    # ValueError: if a section without duration must be reached without speed
+    state = [float(scenario[0][0]), float(scenario[0][1]), float(scenario[0][2]), 0.0, 0.0]
+    acceleration = rateheading = turnrate = radius = vspeed = 0.0
+    start = 0.0
+    chunks = []
+    for section in range(1, len(scenario) - 1):
+        position = [_value(scenario, section, field) for field in (0, 1, 2)]
+        heading, speed = _value(scenario, section, 4), _value(scenario, section, 5)
+        velocity = scenario[section][18] if len(scenario[section]) > 18 else ''
+        if heading is not None:
+            state[3] = heading
+        if speed is not None:
+            state[4] = speed
+        if velocity not in ('', []):
+            state[4], state[3] = (float(value) for value in velocity.split(',')[:2])
+        given = {field: _value(scenario, section, field) for field in (6, 7, 8, 9, 19)}
+        acceleration = acceleration if given[6] is None else given[6]
+        rateheading = rateheading if given[7] is None else given[7]
+        turnrate = turnrate if given[8] is None else given[8]
+        radius = radius if given[9] is None else given[9]
+        vspeed = vspeed if given[19] is None else given[19]
+        if scenario[section][3] == '':
+            # straight to the section position at the current speed, as the waypoint planner does
+            if state[4] <= 0:
+                raise ValueError('Section %d has no duration and no speed to reach its position' % section)
+            target = (position[0], position[1])
+            state[3] = tools.bearing(state[0], state[1], target[0], target[1])
+            duration = tools.haversine(state[0], state[1], target[0], target[1]) / state[4]
+            settings = (0.0, 0.0, 0.0, 0.0)
+        else:
+            if None not in position:
+                state[0:3] = position
+            duration = float(tools.get_sec(scenario[section][3]))
+            settings = (acceleration, rateheading + turnrate, radius, vspeed)
+        # output times of the section, and integration times between them
+        first = math.ceil(start * rate - 1e-9)
+        last = math.ceil((start + duration) * rate - 1e-9)
+        output = np.arange(first, last) / rate - start
+        inner = np.linspace(0, duration, max(int(math.ceil(duration / step)), 1) + 1)
+        t, index = np.unique(np.concatenate((inner, output)), return_inverse=True)
+        lats, longs, alts, headings, speeds = _integrate(state, t, *settings)
+        rows = index[len(inner):]
+        chunk = np.zeros(len(rows), dtype=TRUTH_DTYPE)
+        chunk['time'] = output + start
+        chunk['section'] = section
+        chunk['lat'], chunk['long'], chunk['alt'] = lats[rows], longs[rows], alts[rows]
+        chunk['heading'], chunk['speed'] = headings[rows], speeds[rows]
+        chunks.append(chunk)
+        state = [lats[-1], longs[-1], alts[-1], headings[-1], speeds[-1]]
+        if scenario[section][3] == '':
+            state[0:2] = target
+        start += duration
+        # set_default
+        if speed is None:
+            state[4] = 0.0
+        if velocity not in ('', []):
+            state[3] = state[4] = 0.0
+        if given[6] is None:
+            acceleration = 0.0
+        if given[7] is None:
+            rateheading = 0.0
+        if given[8] is None:
+            turnrate = 0.0
+        if given[9] is None:
+            radius = 0.0
+        if given[19] is not None:
+            vspeed = 0.0
+    end = np.zeros(1, dtype=TRUTH_DTYPE)
+    end['time'], end['section'] = start, len(scenario) - 2
+    end['lat'], end['long'], end['alt'], end['heading'], end['speed'] = state
+    return np.concatenate(chunks + [end])
+
+
+def interpolate(truth, times):
+    # Reference positions at any times, e.g. the epochs of a receiver
+    # Input:
+    # truth: array of TRUTH_DTYPE records returned by reference
+    # times: array of times in seconds from the scenario start
+    # Return:
+    # array of TRUTH_DTYPE records at the times, the section being the one of the previous reference record
+    times = np.asarray(times, dtype=np.float64)
+    result = np.zeros(times.shape, dtype=TRUTH_DTYPE)
+    result['time'] = times
+    index = np.clip(np.searchsorted(truth['time'], times, side='right') - 1, 0, len(truth) - 1)
+    result['section'] = truth['section'][index]
+    for name in ('lat', 'long', 'alt', 'speed'):
+        result[name] = np.interp(times, truth['time'], truth[name])
+    result['heading'] = np.interp(times, truth['time'], np.degrees(np.unwrap(np.radians(truth['heading'])))) % 360
+    return result
+
+
+def nmea(truth, start):
+    # Converts a reference trajectory into a NMEA trajectory file, GGA and RMC sentences at every record
+    # Input:
+    # truth: array of TRUTH_DTYPE records returned by reference
+    # start: datetime of the scenario start
+    # Return:
+    # the content of the file
+    return ''.join(tools.nmea_fix(start + datetime.timedelta(seconds=float(record['time'])), record['lat'],
+                                  record['long'], record['alt'], record['speed'], record['heading'])
+                   for record in truth)
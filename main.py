@@ -10,6 +10,8 @@
 import time
 from threading import Thread
 
+from GNSSTools import CaptureManager
+from GNSSTools import TelemetryLogger
 from GNSSTools import Spectracom
 from GNSSTools import tools
 from GNSSTools import Ublox
@@ -25,21 +27,27 @@ class AcquireData(Thread):
             spectracomcnx.scenario_reading(scenario)
         if self.nb == 2:
             begin = time.time()
-            ubloxfile = open(ubloxcnx.rawdatafile, 'wb')
+            manager = CaptureManager()
+            files = [open(ublox.rawdatafile, 'wb') for ublox in ubloxes]
+            for ublox, ubloxfile in zip(ubloxes, files):
+                manager.add(ublox, ubloxfile)
+            manager.start()
+            telemetryfile = open('datatxt/ublox_telemetry.jsonl', 'w')
+            telemetry = TelemetryLogger(manager, telemetryfile).start()
             while (time.time() < 300 + begin) or (thread_1.is_alive() is True):
-                ubloxcnx.store_data(ubloxfile)
-            ubloxfile.close()
-        if self.nb == 3:
-            while thread_1.is_alive() is True:
-                ubloxcnx.poll('HUI')
-                ubloxcnx.poll('EPH')
-                ubloxcnx.poll('RAW')
-                time.sleep(10)
+                time.sleep(0.5)
+            manager.stop()
+            telemetry.stop()
+            telemetryfile.close()
+            print(manager.throughput())
+            for ubloxfile in files:
+                ubloxfile.close()
 
 
 if __name__ == "__main__":
     # connexion
-    ubloxcnx = Ublox(com='COM6')
+    # receivers acquired together, the first one being compared to the Spectracom by tools.computation
+    ubloxes = [Ublox(com='COM6', link_rate=115200)]
     spectracomcnx = Spectracom('USB0::0x14EB::0x0060::200448::INSTR')
 
     # Read scenario
@@ -58,9 +66,15 @@ if __name__ == "__main__":
     spectracomcnx.set_position(float(scenario[0][0]), float(scenario[0][1]), float(scenario[0][2]))
 
     # set ublox parameters
-    ubloxcnx.reset(command='Cold RST')
-    ubloxcnx.enable(command='NMEA')
-    ubloxcnx.enable(command='UBX')
+    for ublox in ubloxes:
+        ublox.reset(command='Cold RST')
+        ublox.enable(command='NMEA')
+        ublox.enable(command='UBX')
+
+    # ionosphere and ephemerides every 10 seconds, set before the capture reads the ports so that the
+    # acknowledgements are read by schedule, the pseudo ranges staying at every solution as set by enable
+    for ublox in ubloxes:
+        ublox.schedule({'HUI': 10, 'EPH': 10})
 
     thread_1 = AcquireData(1)
     thread_2 = AcquireData(2)
@@ -69,13 +83,15 @@ if __name__ == "__main__":
     time.sleep(270)
 
     # read data comming from both the Spectracom and the Ublox at the same time while the scenario is running
-    thread_3 = AcquireData(3)
     thread_1.start()
-    thread_3.start()
     thread_1.join()
+    thread_2.join()
+    for ublox in ubloxes:
+        ublox.schedule({'HUI': None, 'EPH': None})
 
     spectracomcnx.control(control='stop')
-    ubloxcnx.miseenforme()
+    for ublox in ubloxes:
+        ublox.miseenforme()
 
     # computation of the root mean square error
     tools.computation()
@@ -0,0 +1,481 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Test acquisition of the receiver data
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import binascii
+import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from GNSSTools import Ublox
+from GNSSTools.devices import ubx
+from GNSSTools.devices.capture import Capture, CaptureManager, TelemetryLogger
+from GNSSTools.devices.container import ContainerReader, ContainerWriter
+from GNSSTools.devices.replay import ReplaySerial, log_stream
+from GNSSTools.devices.segments import RotatingWriter, SegmentStream, read_manifest
+from GNSSTools.devices.ublox import TailParser
+
+
+def stream_from_testfile():
+    # Receiver byte stream made of the messages of testfile.txt, with the matching store_data output
+    stream = b''
+    stored = b''
+    for line in open('testfile.txt').read().split('\n'):
+        if line[0:4] == 'b562':
+            frame = binascii.unhexlify(line[0:4]) + binascii.unhexlify(line[4:-4])
+            frame += ubx.checksum(frame[2:])
+            stream += frame
+            stored += binascii.hexlify(frame) + b'\n'
+        else:
+            stream += line.encode() + b'\r\n'
+            stored += line.encode() + b'\r\n'
+    return stream, stored
+
+
+def read_all(captures, size, timeout=10):
+    # Waits until each capture has read size bytes, checked by a listener each time messages arrive
+    # Return:
+    # True if every capture read them in time
+    events = []
+    for capture in captures:
+        event = threading.Event()
+
+        def listener(frames, capture=capture, event=event):
+            if capture.bytes_read >= size:
+                event.set()
+        capture.listeners.append(listener)
+        # the last messages may have come before the listener
+        if capture.bytes_read >= size:
+            event.set()
+        events.append(event)
+    end = time.monotonic() + timeout
+    return all(event.wait(max(end - time.monotonic(), 0)) for event in events)
+
+
+def decoded(ublox):
+    # Messages decoded from the processed data file of a receiver
+    return (ublox.klobuchar_data(), ublox.raw_data().tolist(), ublox.random_data(), ublox.nmea_data_gbs(),
+            ublox.nmea_data_gsa(), ublox.nmea_data_vtg(), ublox.nmea_data_pubx3(),
+            ublox.nmea_gga_store(ublox.procdatafile))
+
+
+class Port:
+    # Serial port giving back a byte stream by chunks of at most size bytes
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+        self.position = 0
+
+    @property
+    def in_waiting(self):
+        return min(self.size, len(self.data) - self.position)
+
+    def read(self, size=1):
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+
+class IdlePort(Port):
+    # Serial port without data counting how many times it is polled
+    def __init__(self):
+        super(IdlePort, self).__init__(b'', 1)
+        self.polls = 0
+
+    @property
+    def in_waiting(self):
+        self.polls += 1
+        return 0
+
+
+class WaitCounter(threading.Event):
+    # Stop event keeping the timeout of each wait, set by the last one of count waits
+    def __init__(self, count):
+        super(WaitCounter, self).__init__()
+        self.count = count
+        self.waits = []
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        if len(self.waits) == self.count:
+            self.set()
+        return super(WaitCounter, self).wait(timeout)
+
+
+class Pipe:
+    # Serial port made of a pipe, which can be watched by a selector
+    def __init__(self):
+        self.input, self.output = os.pipe()
+
+    def fileno(self):
+        return self.input
+
+    @property
+    def in_waiting(self):
+        import fcntl
+        import termios
+        return struct.unpack('i', fcntl.ioctl(self.input, termios.FIONREAD, b'\0\0\0\0'))[0]
+
+    def read(self, size=1):
+        return os.read(self.input, size)
+
+
+class TestCapture(unittest.TestCase):
+
+    def test_checksum(self):
+        self.assertEqual(ubx.checksum(b'\x06\x01\x03\x00\xF0\x00\x01'), b'\xFB\x10')
+
+    def test_message(self):
+        self.assertEqual(ubx.cfg_msg(0x0B, 0x02, 1), b'\xB5\x62\x06\x01\x03\x00\x0B\x02\x01\x18\x65')
+        self.assertEqual(ubx.cfg_rst(ubx.RESETS['Cold RST']), b'\xB5\x62\x06\x04\x04\x00\xFF\xA1\x02\x00\xB0\x47')
+        self.assertEqual(ubx.message(*ubx.AID_EPH), b'\xB5\x62\x0B\x31\x00\x00\x3C\xBF')
+
+    def test_transaction(self):
+        file = io.BytesIO()
+        with ubx.Transaction(file) as transaction:
+            for cls, id in ubx.NMEA_MESSAGES:
+                transaction.set_rate(cls, id, 0)
+        frames = ubx.Framer().feed(file.getvalue())
+        self.assertEqual(len(frames), len(ubx.NMEA_MESSAGES))
+        self.assertEqual(frames[2], ('UBX', b'\xB5\x62\x06\x01\x03\x00\xF0\x00\x00\xFA\x0F'))
+        self.assertEqual(transaction.commit(), 0)
+
+    def test_ack_tracker(self):
+        tracker = ubx.AckTracker()
+        file = io.BytesIO()
+        with ubx.Transaction(file, tracker) as transaction:
+            for cls, id in ubx.NMEA_MESSAGES[:3]:
+                transaction.set_rate(cls, id, 1)
+            transaction.add(*ubx.AID_EPH)
+            # a poll of a configuration, which is not waited for
+            transaction.add(*ubx.CFG_NAV5)
+        self.assertEqual(len(transaction.futures), 3)
+        self.assertEqual(list(tracker.pending), [ubx.CFG_MSG])
+        answers = ubx.message(*ubx.ACK_ACK, payload=bytes(ubx.CFG_MSG)) + \
+            ubx.message(*ubx.ACK_NAK, payload=bytes(ubx.CFG_MSG))
+        tracker.feed(ubx.Framer().feed(answers))
+        self.assertEqual([future.result(0) for future in transaction.futures[:2]], [True, False])
+        self.assertFalse(transaction.futures[2].done())
+        tracker.forget(transaction.futures[2])
+        tracker.feed(ubx.Framer().feed(answers))
+        self.assertTrue(transaction.futures[2].cancelled())
+
+    def test_poll_scheduler(self):
+        poller = ubx.PollScheduler()
+        poller.add(*ubx.RXM_RAW, interval=10, now=0)
+        poller.add(*ubx.AID_HUI, interval=4, now=1)
+        self.assertEqual(poller.due(0.5), ubx.message(*ubx.RXM_RAW))
+        self.assertEqual(poller.due(2), ubx.message(*ubx.AID_HUI))
+        self.assertEqual(poller.due(4.9), b'')
+        # late tick: one poll, the next one staying on the grid
+        self.assertEqual(poller.due(13.5), ubx.message(*ubx.RXM_RAW) + ubx.message(*ubx.AID_HUI))
+        self.assertEqual(poller.due(16.9), b'')
+        self.assertEqual(poller.due(17), ubx.message(*ubx.AID_HUI))
+        poller.remove(*ubx.AID_HUI)
+        self.assertEqual(poller.due(21), ubx.message(*ubx.RXM_RAW))
+
+    def test_framer(self):
+        stream, _ = stream_from_testfile()
+        framer = ubx.Framer()
+        frames = []
+        for i in range(0, len(stream), 7):
+            frames += framer.feed(stream[i:i + 7])
+        self.assertEqual([kind for kind, _ in frames], ['UBX'] * 3 + ['NMEA'] * 5 + ['UBX'] * 3 + ['NMEA'] * 4)
+        self.assertEqual(b''.join(frame for _, frame in frames), stream)
+        self.assertEqual(framer.checksum_failures, 0)
+        self.assertEqual(framer.resyncs, 0)
+
+    def test_framer_resync(self):
+        stream, _ = stream_from_testfile()
+        corrupted = b'\x00garbage' + stream[:20] + b'\xff' + stream[21:]
+        framer = ubx.Framer()
+        frames = framer.feed(corrupted)
+        self.assertEqual(len(frames), 14)
+        self.assertEqual(framer.checksum_failures, 1)
+        self.assertTrue(framer.resyncs >= 2)
+
+    def test_capture(self):
+        stream, stored = stream_from_testfile()
+        file = io.BytesIO()
+        tracker = ubx.AckTracker()
+        future = tracker.expect(*ubx.CFG_MSG)
+        ack = ubx.message(*ubx.ACK_ACK, payload=bytes(ubx.CFG_MSG))
+        capture = Capture(Port(stream * 100 + ack + stream * 100, 1000), file, listeners=[tracker.feed]).start()
+        self.assertTrue(future.result(5))
+        self.assertTrue(read_all([capture], len(stream) * 200 + len(ack)))
+        capture.stop()
+        self.assertEqual(file.getvalue(), stored * 100 + binascii.hexlify(ack) + b'\n' + stored * 100)
+
+    def test_capture_round_trip(self):
+        stream, _ = stream_from_testfile()
+        expected = decoded(Ublox('replay', device=ReplaySerial(b''), procdatafile='testfile.txt'))
+        with tempfile.TemporaryDirectory() as directory:
+            ublox = Ublox('replay', device=ReplaySerial(stream, speed=None, timeout=0.01),
+                          rawdatafile=os.path.join(directory, 'raw.txt'),
+                          procdatafile=os.path.join(directory, 'proc.txt'))
+            file = open(ublox.rawdatafile, 'wb')
+            capture = ublox.capture(file)
+            self.assertTrue(read_all([capture], len(stream)))
+            capture.stop()
+            file.close()
+            ublox.miseenforme()
+            received = decoded(ublox)
+            self.assertNotEqual(received[-1], {})
+            self.assertEqual(received, expected)
+
+    def test_rotating_writer(self):
+        stream, stored = stream_from_testfile()
+        with tempfile.TemporaryDirectory() as directory:
+            writer = RotatingWriter(directory, max_bytes=4000)
+            capture = Capture(Port(stream * 20, 500), writer).start()
+            self.assertTrue(read_all([capture], len(stream) * 20))
+            capture.stop()
+            writer.close()
+            segments = read_manifest(writer.manifest)
+            self.assertTrue(len(segments) > 2)
+            self.assertTrue(all(segment['compressed'] for segment in segments))
+            self.assertEqual(sum(segment['bytes'] for segment in segments), len(stored) * 20)
+            self.assertEqual(sorted(os.listdir(directory))[-1], 'ublox_raw_data_manifest.json')
+            self.assertEqual(SegmentStream(writer.manifest).read(), stored * 20)
+            stream = SegmentStream(writer.manifest)
+            stream.seek(len(stored) * 7 + 3)
+            self.assertEqual(stream.read(), (stored * 20)[len(stored) * 7 + 3:])
+            flat = os.path.join(directory, 'flat.txt')
+            open(flat, 'wb').write(stored * 20)
+            expected = TailParser(flat, os.path.join(directory, 'flat_proc.txt')).update(final=True)
+            tail = TailParser(writer.manifest, os.path.join(directory, 'proc.txt'))
+            self.assertEqual(tail.update(final=True), expected)
+
+    def test_container(self):
+        stream, stored = stream_from_testfile()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.gcap')
+            writer = ContainerWriter(filename)
+            capture = Capture(Port(stream * 20, 500), writer, source=3).start()
+            self.assertTrue(read_all([capture], len(stream) * 20))
+            capture.stop()
+            writer.write(b'$PSPEC,LOG\r\n', source=7)
+            writer.close()
+            container = ContainerReader(filename)
+            self.assertEqual(len(container), 15 * 20 + 1)
+            self.assertEqual(container[15][1:], (3, stream[:len(container[0][2])]))
+            self.assertEqual(container[-1][1:], (7, b'$PSPEC,LOG\r\n'))
+            self.assertTrue((container.timestamps()[1:] >= container.timestamps()[:-1]).all())
+            self.assertEqual(container.raw(source=3), stored * 20)
+            container.close()
+            # without index
+            data = open(filename, 'rb').read()
+            open(filename, 'wb').write(data[:len(data) - 8 * (15 * 20 + 1) - 24 - 5])
+            container = ContainerReader(filename)
+            self.assertEqual(len(container), 15 * 20)
+            container.close()
+            tail = TailParser(filename, os.path.join(directory, 'proc.txt'))
+            self.assertEqual(''.join(tail.update(final=True)).count('b562'), 6 * 20)
+
+    def test_container_round_trip(self):
+        stream, _ = stream_from_testfile()
+        expected = decoded(Ublox('replay', device=ReplaySerial(b''), procdatafile='testfile.txt'))
+        with tempfile.TemporaryDirectory() as directory:
+            writer = ContainerWriter(os.path.join(directory, 'capture.gcap'))
+            writer.write_frames(ubx.Framer().feed(stream))
+            writer.close()
+            container = ContainerReader(writer.filename)
+            ublox = Ublox('replay', device=ReplaySerial(b''), rawdatafile=os.path.join(directory, 'raw.txt'),
+                          procdatafile=os.path.join(directory, 'proc.txt'))
+            open(ublox.rawdatafile, 'wb').write(container.raw())
+            container.close()
+            ublox.miseenforme()
+            self.assertEqual(decoded(ublox), expected)
+
+    def test_container_tail(self):
+        stream, stored = stream_from_testfile()
+        frames = ubx.Framer().feed(stream)
+        with tempfile.TemporaryDirectory() as directory:
+            flat = os.path.join(directory, 'flat.txt')
+            open(flat, 'wb').write(stored * 2)
+            expected = TailParser(flat, os.path.join(directory, 'flat_proc.txt')).update(final=True)
+            writer = ContainerWriter(os.path.join(directory, 'capture.gcap'))
+            tail = TailParser(writer.filename, os.path.join(directory, 'proc.txt'))
+            writer.write_frames(frames)
+            writer.flush()
+            lines = tail.update()
+            # only the records written since are read by the next update
+            self.assertEqual(tail.offset, os.path.getsize(writer.filename))
+            writer.write_frames(frames)
+            writer.close()
+            lines += tail.update(final=True)
+            self.assertEqual(lines, expected)
+            self.assertEqual(tail.update(final=True), [])
+
+    def test_log_stream(self):
+        stream = log_stream('../data/database/scircle_ublox.txt')
+        framer = ubx.Framer()
+        frames = framer.feed(stream)
+        self.assertEqual(sum(kind == 'UBX' for kind, _ in frames), 8577)
+        self.assertEqual(framer.checksum_failures, 0)
+
+    def test_replay(self):
+        stream, stored = stream_from_testfile()
+        ublox = Ublox('replay', device=ReplaySerial(stream * 50, speed=None, timeout=0.01))
+        file = io.BytesIO()
+        capture = ublox.capture(file)
+        self.assertTrue(read_all([capture], len(stream) * 50))
+        capture.stop()
+        self.assertEqual(file.getvalue(), stored * 50)
+        # paced by the baud rate
+        clock = [0.0]
+        replay = ReplaySerial(stream, baudrate=len(stream) * 20, clock=lambda: clock[0])
+        self.assertEqual(replay.in_waiting, 0)
+        clock[0] = 0.25
+        self.assertEqual(replay.in_waiting, len(stream) // 2)
+        self.assertEqual(replay.read(len(stream)), stream[:len(stream) // 2])
+        self.assertAlmostEqual(replay.arrival(len(stream) - 1), 0.5)
+        clock[0] = 0.5
+        self.assertEqual(replay.read(len(stream)), stream[len(stream) // 2:])
+
+    def test_replay_container(self):
+        stream, _ = stream_from_testfile()
+        frames = ubx.Framer().feed(stream)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'capture.gcap')
+            writer = ContainerWriter(filename)
+            writer.write_frames(frames[:3], timestamp=10 ** 9)
+            writer.write_frames(frames[3:], timestamp=10 ** 9 + 200 * 10 ** 6)
+            writer.close()
+            clock = [0.0]
+            replay = ReplaySerial(filename, speed=2, clock=lambda: clock[0])
+            first = replay.read(len(stream))
+            self.assertEqual(first, b''.join(frame for _, frame in frames[:3]))
+            clock[0] = 0.099
+            self.assertEqual(replay.in_waiting, 0)
+            self.assertAlmostEqual(replay.arrival(replay.position), 0.1)
+            clock[0] = 0.1
+            self.assertEqual(first + replay.read(len(stream)), stream)
+
+    def test_replay_corruption(self):
+        stream, _ = stream_from_testfile()
+        first = ReplaySerial(stream * 20, speed=None, corruption=0.001, seed=1).read(len(stream) * 20)
+        second = ReplaySerial(stream * 20, speed=None, corruption=0.001, seed=1).read(len(stream) * 20)
+        self.assertEqual(first, second)
+        self.assertNotEqual(first, stream * 20)
+        framer = ubx.Framer()
+        framer.feed(first)
+        self.assertTrue(framer.checksum_failures > 0)
+        # the same bytes are corrupted on each pass of a loop
+        replay = ReplaySerial(stream * 20, speed=None, corruption=0.001, seed=1, loop=True)
+        self.assertEqual(replay.read(len(stream) * 20), first)
+        self.assertEqual(replay.read(len(stream) * 20), first)
+        # and whatever bytes are dropped by reset_input_buffer
+        clock = [0.0]
+        replay = ReplaySerial(stream * 20, baudrate=1000, corruption=0.001, seed=1, clock=lambda: clock[0])
+        clock[0] = 1.0
+        self.assertEqual(replay.read(50), first[:50])
+        clock[0] = 10.0
+        replay.reset_input_buffer()
+        clock[0] = 1000.0
+        self.assertEqual(replay.read(len(stream) * 20), first[1000:])
+
+    def test_capture_manager(self):
+        stream, stored = stream_from_testfile()
+        ubloxes = [Ublox('replay%d' % i, device=ReplaySerial(stream * 20, speed=None, timeout=0)) for i in range(3)]
+        files = [io.BytesIO() for _ in ubloxes]
+        manager = CaptureManager()
+        for ublox, file in zip(ubloxes, files):
+            manager.add(ublox, file)
+        threads = threading.active_count()
+        manager.start()
+        self.assertEqual(threading.active_count(), threads + 1)
+        self.assertTrue(read_all(manager.captures.values(), len(stream) * 20))
+        self.assertTrue(all(ublox.acquisition is not None for ublox in ubloxes))
+        manager.stop()
+        self.assertTrue(all(ublox.acquisition is None for ublox in ubloxes))
+        self.assertEqual([file.getvalue() for file in files], [stored * 20] * 3)
+        self.assertEqual(sorted(manager.throughput()), ['replay0', 'replay1', 'replay2'])
+
+    def test_capture_manager_idle(self):
+        port = IdlePort()
+        manager = CaptureManager(interval=0.02)
+        manager.add(Ublox('idle', device=port), io.BytesIO())
+        manager.stopped = WaitCounter(5)
+        manager.start()
+        manager.thread.join(10)
+        manager.stop()
+        # one poll for each wait of an interval while no data comes
+        self.assertEqual(manager.stopped.waits, [0.02] * 5)
+        self.assertEqual(port.polls, 5)
+
+    @unittest.skipIf(os.name == 'nt', 'serial ports can not be selected on Windows')
+    def test_capture_manager_selector(self):
+        stream, stored = stream_from_testfile()
+        pipes = [Pipe(), Pipe()]
+        files = [io.BytesIO(), io.BytesIO()]
+        manager = CaptureManager()
+        for i, (pipe, file) in enumerate(zip(pipes, files)):
+            manager.add(Ublox('pipe%d' % i, device=pipe), file)
+        manager.start()
+        os.write(pipes[0].output, stream)
+        os.write(pipes[1].output, stream[:100])
+        os.write(pipes[1].output, stream[100:])
+        self.assertTrue(read_all(manager.captures.values(), len(stream)))
+        manager.stop()
+        self.assertEqual([file.getvalue() for file in files], [stored] * 2)
+        for pipe in pipes:
+            os.close(pipe.input)
+            os.close(pipe.output)
+
+    def test_snapshot(self):
+        stream, _ = stream_from_testfile()
+        corrupted = stream * 10 + stream[:20] + b'\xff' + stream[21:]
+        log = io.StringIO()
+        capture = Capture(ReplaySerial(corrupted, speed=None, baudrate=9600, timeout=0.01), io.BytesIO())
+        logger = TelemetryLogger(capture, log, interval=0.05).start()
+        capture.start()
+        self.assertTrue(read_all([capture], len(corrupted)))
+        capture.stop()
+        logger.stop()
+        snapshot = json.loads(log.getvalue().splitlines()[-1])
+        self.assertEqual(snapshot['bytes_read'], len(corrupted))
+        self.assertEqual(snapshot['frames']['UBX 0B-31'], 10)
+        self.assertEqual(snapshot['frames']['UBX 02-10'], 11)
+        self.assertEqual(snapshot['frames']['NMEA GPGSV'], 33)
+        self.assertEqual(snapshot['checksum_failures'], 1)
+        self.assertEqual(snapshot['queue_depth'], 0)
+        self.assertTrue(snapshot['max_writer_lag'] >= snapshot['writer_lag'] >= 0)
+        self.assertTrue(len(log.getvalue().splitlines()) >= 1)
+
+    def test_telemetry_interval(self):
+        log = io.StringIO()
+        logger = TelemetryLogger(Capture(Port(b'', 1), io.BytesIO()), log, interval=0.01).start()
+        end = time.monotonic() + 10
+        while len(log.getvalue().splitlines()) < 3 and time.monotonic() < end:
+            time.sleep(0.01)
+        logger.stop()
+        # the lines written every interval and the last one written by stop
+        self.assertTrue(len(log.getvalue().splitlines()) >= 4)
+
+    def test_telemetry_rate(self):
+        stream, _ = stream_from_testfile()
+        log = io.StringIO()
+        capture = Capture(ReplaySerial(b'', speed=None, baudrate=9600), io.BytesIO())
+        capture.started = time.monotonic() - 10
+        logger = TelemetryLogger(capture, log)
+        for _ in range(2):
+            capture.receive(stream)
+            logger.log()
+        first, second = [json.loads(line) for line in log.getvalue().splitlines()]
+        # the rate of each line is measured since the previous one
+        self.assertAlmostEqual(first['rate'], len(stream) / first['elapsed'])
+        self.assertAlmostEqual(second['rate'], len(stream) / (second['elapsed'] - first['elapsed']))
+        self.assertAlmostEqual(second['utilization'], second['rate'] * 10 / 9600)
+        # without the logger's state the rate is measured since the start
+        snapshot = capture.snapshot()
+        self.assertAlmostEqual(snapshot['rate'], 2 * len(stream) / snapshot['elapsed'])
+        self.assertAlmostEqual(snapshot['utilization'], snapshot['rate'] * 10 / 9600)
@@ -6,11 +6,18 @@
 # AUTHOR
 # Anne-Marie Tobie
 
+import os
+import struct
+import tempfile
 import unittest
+import numpy as np
 from GNSSTools import Spectracom
 from GNSSTools import tools
 from GNSSTools import Ublox
 from GNSSTools import Device
+from GNSSTools.devices import ubx
+from GNSSTools.devices.replay import ReplaySerial
+from GNSSTools.devices.ublox import RawArchive, TailParser, load_raw
 
 
 
@@ -190,4 +197,81 @@ class TestDevices(unittest.TestCase):
             12: {'C/N0': '', 'elevation': '40', 'SV ID': '27', 'SV status': '-', 'azimuth': '283'},
             13: {'C/N0': '38', 'elevation': '11', 'SV ID': '29', 'SV status': 'U', 'azimuth': '114'},
             14: {'C/N0': '', 'elevation': '07', 'SV ID': '30', 'SV status': '-', 'azimuth': '359'}}}}
-        self.assertDictEqual(received, expected, 'NMEA PUBX 03 Fails')
\ No newline at end of file
+        self.assertDictEqual(received, expected, 'NMEA PUBX 03 Fails')
+
+    def test_raw_storage(self):
+        received = Ublox('replay', device=ReplaySerial(b''), procdatafile='testfile.txt').raw_data()
+        self.assertEqual(received['epoch'].tolist(), [0, 0])
+        self.assertEqual(received['rcvtow'].tolist(), [212594000, 212594000])
+        self.assertEqual(received['week'].tolist(), [1910, 1910])
+        self.assertEqual(received['sv'].tolist(), [12, 25])
+        self.assertEqual(received['prmes'].tolist(), [21234567.125, 23456789.25])
+        self.assertEqual(received['cpmes'].tolist(), [123456.75, -98765.5])
+        self.assertEqual(received['domes'].tolist(), [-1234.5, 2345.25])
+        self.assertEqual(received['cno'].tolist(), [45, 38])
+        self.assertEqual(received['mesqi'].tolist(), [7, 5])
+        self.assertEqual(received['lli'].tolist(), [0, 1])
+
+    def test_raw_archive(self):
+        raw = Ublox('replay', device=ReplaySerial(b''), procdatafile='testfile.txt').raw_data()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'raw.npy')
+            RawArchive(filename).append(raw)
+            archive = RawArchive(filename)
+            archive.append(raw)
+            received = load_raw(filename)
+            self.assertEqual(received['epoch'].tolist(), [0, 0, 1, 1])
+            self.assertEqual(received['sv'].tolist(), [12, 25, 12, 25])
+            archive.export(os.path.join(directory, 'raw.npz'))
+            self.assertEqual(load_raw(os.path.join(directory, 'raw.npz')).tolist(), received.tolist())
+            del received
+            # a valid .npy file whose header is longer than the one of RawArchive
+            saved = os.path.join(directory, 'saved.npy')
+            header = "{'descr': %r, 'fortran_order': False, 'shape': (2,), }" % np.lib.format.dtype_to_descr(raw.dtype)
+            header = header.ljust(384 - 11) + '\n'
+            open(saved, 'wb').write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode() +
+                                    raw.tobytes())
+            self.assertEqual(np.load(saved).tolist(), raw.tolist())
+            RawArchive(saved).append(raw)
+            received = load_raw(saved)
+            self.assertEqual(received['epoch'].tolist(), [0, 0, 1, 1])
+            self.assertEqual(received['prmes'].tolist(), raw['prmes'].tolist() * 2)
+            del received
+
+    def test_tail_parser(self):
+        lines = open('testfile.txt').read().split('\n')
+        nmea = [line + '\n' for line in lines if line[0:1] == '$']
+        ubx = [line + '\n' for line in lines if line[0:4] == 'b562']
+        raw = (''.join(nmea).replace('\n', '\r\n') + ''.join(ubx).replace('\n', '')).encode()
+        cut = raw.index(b'b5620210') + 20
+        with tempfile.TemporaryDirectory() as directory:
+            rawdatafile = os.path.join(directory, 'raw.txt')
+            procdatafile = os.path.join(directory, 'proc.txt')
+            open(rawdatafile, 'wb').write(raw[:cut])
+            tail = TailParser(rawdatafile, procdatafile)
+            first = tail.update()
+            self.assertEqual(first, nmea + ubx[0:2])
+            open(rawdatafile, 'ab').write(raw[cut:])
+            second = tail.update(final=True)
+            self.assertEqual(second, ubx[2:])
+            self.assertEqual(tail.offset, len(raw))
+            ublox = Ublox('replay', device=ReplaySerial(b''), rawdatafile=rawdatafile,
+                          procdatafile=os.path.join(directory, 'full.txt'))
+            ublox.miseenforme()
+            self.assertEqual(open(procdatafile).read(), open(ublox.procdatafile).read())
+            self.assertEqual(len(ublox.raw_data(second)), 2)
+            self.assertEqual(ublox.klobuchar_data(second), {})
+
+    def test_port_config(self):
+        received = Ublox('replay', device=ReplaySerial(b''), procdatafile='testfile.txt').port_config(115200)
+        self.assertEqual(received.hex(), 'b5620600140001000000d008000000c201000700030000000000c07e')
+
+    def test_schedule(self):
+        ublox = Ublox('replay', device=ReplaySerial(b''), procdatafile='testfile.txt')
+        received = ublox.schedule({'RAW': 10, 'HUI': 2.5, (0x01, 0x04): None}, timeout=0)
+        self.assertEqual(received, {'RAW': 'poll', 'HUI': 'poll', (0x01, 0x04): None})
+        # the rates in one write, HUI not being a whole number of navigation solutions
+        self.assertEqual(ublox.device.written, [ubx.cfg_msg(0x02, 0x10, 10) + ubx.cfg_msg(0x01, 0x04, 0)])
+        self.assertEqual(sorted(ublox.poller.entries), [(0x02, 0x10), (0x0B, 0x02)])
+        with self.assertRaises(ValueError):
+            ublox.schedule({'GGA': 1})
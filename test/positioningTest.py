@@ -0,0 +1,148 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Test single point positioning
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import datetime
+import unittest
+import numpy as np
+from GNSSTools import positioning
+from GNSSTools import Device
+from GNSSTools.devices.ublox import RAW_DTYPE
+
+
+KLOBUCHAR = {'kloa0': 8.381903171539307e-09, 'kloa1': 2.2351741790771484e-08, 'kloa2': -5.960464477539063e-08,
+             'kloa3': -1.1920928955078125e-07, 'klob0': 92160.0, 'klob1': 114688.0, 'klob2': -65536.0,
+             'klob3': -589824.0}
+
+
+def constellation(nsat=8):
+    # Circular orbits spread over 6 planes with a small clock offset on each satellite
+    table = np.zeros(nsat, dtype=positioning.EPH_DTYPE)
+    table['svid'] = np.arange(1, nsat + 1)
+    table['toe'] = table['toc'] = 302400
+    table['sqrta'] = 5153.7
+    table['i0'] = np.radians(55)
+    table['omega0'] = np.radians(60) * (np.arange(nsat) % 6) - 0.3
+    table['m0'] = np.radians(90) * (np.arange(nsat) // 6) + np.radians(30) * (np.arange(nsat) % 6)
+    table['af0'] = 1e-5 * np.arange(nsat)
+    return table
+
+
+def simulate(table, receiver, tow, clockbias):
+    # Pseudoranges consistent with the solver model, troposphere included. The receiver time of week is
+    # ahead of GPS time by the clock bias.
+    raw = np.zeros(len(table) * len(tow), dtype=RAW_DTYPE)
+    raw['epoch'] = np.repeat(np.arange(len(tow)), len(table))
+    raw['rcvtow'] = np.repeat(tow, len(table))
+    raw['sv'] = np.tile(table['svid'], len(tow))
+    raw['mesqi'] = 7
+    eph = np.tile(table, len(tow))
+    trx = raw['rcvtow'] / 1000.0 - clockbias / positioning.C
+    tau = np.full(len(raw), 0.07)
+    for _ in range(5):
+        sat, dt = positioning.satellite_positions(eph, trx - tau)
+        theta = positioning.OMEGAEDOT * tau
+        rotated = np.stack((np.cos(theta) * sat[:, 0] + np.sin(theta) * sat[:, 1],
+                            -np.sin(theta) * sat[:, 0] + np.cos(theta) * sat[:, 1], sat[:, 2]), axis=-1)
+        tau = np.linalg.norm(rotated - receiver, axis=-1) / positioning.C
+    elev = positioning.azimuth_elevation(receiver, rotated)[1]
+    tropo = 2.47 / (np.sin(np.radians(np.maximum(elev, 0.1))) + 0.0121)
+    raw['prmes'] = positioning.C * tau + clockbias - positioning.C * dt + tropo
+    return raw[elev > 5]
+
+
+def yuma(table, week=1094):
+    # YUMA almanac of the satellites of a table of EPH_DTYPE records, the second one unhealthy
+    text = ''
+    for i, eph in enumerate(table):
+        text += '******** Week %d almanac for PRN-%02d ********\n' % (week, eph['svid'])
+        for label, value in (('ID:', '%02d' % eph['svid']), ('Health:', '%03d' % (i == 1)),
+                             ('Eccentricity:', '%.10E' % eph['e']),
+                             ('Time of Applicability(s):', '%.4f' % eph['toe']),
+                             ('Orbital Inclination(rad):', '%.10f' % eph['i0']),
+                             ('Rate of Right Ascen(r/s):', '%.10E' % eph['omegadot']),
+                             ('SQRT(A)  (m 1/2):', '%.6f' % eph['sqrta']),
+                             ('Right Ascen at Week(rad):', '%.10E' % eph['omega0']),
+                             ('Argument of Perigee(rad):', '%.9f' % eph['omega']),
+                             ('Mean Anom(rad):', '%.10E' % eph['m0']), ('Af0(s):', '%.10E' % eph['af0']),
+                             ('Af1(s/s):', '%.10E' % eph['af1']), ('week:', '%d' % week)):
+            text += '%-27s%s\n' % (label, value)
+        text += '\n'
+    return text
+
+
+class TestPositioning(unittest.TestCase):
+
+    def test_lla_ecef(self):
+        xyz = positioning.lla_to_ecef(47.552031, -2.279517, 100.0)
+        lat, long, alt = positioning.ecef_to_lla(xyz)
+        self.assertAlmostEqual(float(lat), 47.552031, places=9)
+        self.assertAlmostEqual(float(long), -2.279517, places=9)
+        self.assertAlmostEqual(float(alt), 100.0, places=4)
+
+    def test_solve(self):
+        table = constellation(24)
+        receiver = positioning.lla_to_ecef(61.4498, 23.8570, 120.0)
+        tow = np.arange(302400000, 302410000, 1000)
+        raw = simulate(table, receiver, tow, 1234.5)
+        solution = positioning.solve(raw, table, elevation_mask=5.0)
+        self.assertEqual(len(solution), len(tow))
+        np.testing.assert_allclose(solution[['x', 'y', 'z']].tolist(), np.tile(receiver, (len(tow), 1)),
+                                   atol=1e-3)
+        np.testing.assert_allclose(solution['clockbias'], 1234.5, atol=1e-3)
+        self.assertTrue((solution['numsv'] >= 4).all())
+
+    def test_klobuchar_night(self):
+        # out of the daytime cosine, the delay at zenith is the constant 5 ns scaled by the obliquity factor
+        delay = positioning.klobuchar_delay(KLOBUCHAR, 7200, 0.0, 0.0, 0.0, 90.0)
+        self.assertAlmostEqual(float(delay), positioning.C * 5e-9 * (1 + 16 * 0.03 ** 3))
+
+    def test_klobuchar_broadcast(self):
+        tow = np.arange(0, 86400, 3600)[:, None]
+        elev = np.array([10.0, 45.0, 90.0])
+        delay = positioning.klobuchar_delay(KLOBUCHAR, tow, 61.45, 23.86, 180.0, elev)
+        self.assertEqual(delay.shape, (24, 3))
+        self.assertEqual(float(delay[5, 1]), float(positioning.klobuchar_delay(KLOBUCHAR, 18000, 61.45, 23.86,
+                                                                               180.0, 45.0)))
+        self.assertTrue((delay[:, 0] > delay[:, 2]).all())
+
+    def test_sky_from_gsv(self):
+        gsv = Device().nmea_gsv_store(datafile='testfile.txt')
+        sky = positioning.sky_from_gsv(gsv, ['000439.000'])
+        self.assertEqual(sky['svid'].tolist(), [1, 9, 11, 14, 18, 19, 22, 31, 32])
+        self.assertEqual(sky['tow'][0], 279.0)
+        delay = positioning.iono_delays(sky, KLOBUCHAR, 47.55, -2.28)
+        self.assertEqual(delay.shape, (9,))
+        self.assertTrue((delay > 0).all())
+
+    def test_read_almanac(self):
+        table = constellation(6)
+        almanac = positioning.read_almanac(yuma(table[::-1]))
+        self.assertEqual(almanac['svid'].tolist(), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(almanac['health'].tolist(), [0, 0, 0, 0, 1, 0])
+        np.testing.assert_allclose(almanac['m0'], table['m0'], rtol=1e-9)
+        np.testing.assert_allclose(almanac['af0'], table['af0'], rtol=1e-9)
+        self.assertTrue((almanac['week'] == 1094).all())
+        self.assertEqual(positioning.gps_week(datetime.date(2001, 1, 1)), 1095)
+
+    def test_visibility(self):
+        table = constellation(24)
+        almanac = positioning.read_almanac(yuma(table))
+        tow = np.arange(302400, 302400 + 3600, 60)
+        lat = np.linspace(61.4498, 61.5, len(tow))
+        az, elev, count, gdop = positioning.visibility(almanac, tow, lat, 23.8570, 120.0)
+        self.assertEqual(elev.shape, (len(tow), 24))
+        for epoch in (0, 30, 59):
+            receiver = positioning.lla_to_ecef(lat[epoch], 23.8570, 120.0)
+            sat, _ = positioning.satellite_positions(table, np.full(24, tow[epoch], dtype=np.float64))
+            expected = positioning.azimuth_elevation(receiver, sat)
+            np.testing.assert_allclose(az[epoch], expected[0], atol=1e-6)
+            np.testing.assert_allclose(elev[epoch], expected[1], atol=1e-6)
+            # the unhealthy satellite is not counted
+            self.assertEqual(count[epoch], ((expected[1] >= 5) & (np.arange(24) != 1)).sum())
+        self.assertTrue(((gdop > 1) | (count < 4)).all())
+        self.assertTrue(np.isnan(positioning.visibility(almanac[:3], tow, lat, 23.8570, 120.0)[3]).all())
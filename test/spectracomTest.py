@@ -0,0 +1,448 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Test the Spectracom commands without the generator
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import io
+import json
+import os
+import socket
+import threading
+import unittest
+from GNSSTools import Spectracom
+from GNSSTools import tools
+import positioningTest
+from GNSSTools.devices import transfer
+from GNSSTools.devices import LogPoller, VisaWorker, WaypointPlanner
+from GNSSTools.devices.simulator import SimulatedSpectracom, SimulatorServer
+from GNSSTools.devices.visaworker import CONTROL, LOGGING, DIAGNOSTICS
+
+
+class Instrument:
+    # pyvisa resource keeping the messages written, queries being answered from answers
+    def __init__(self, answers=None):
+        self.written = []
+        self.answers = answers or {}
+
+    def write(self, message):
+        self.written.append(message)
+        return len(message) + 2
+
+    def query(self, message):
+        self.written.append(message)
+        answer = self.answers.get(message, '')
+        if isinstance(answer, list):
+            return answer.pop(0)
+        if callable(answer):
+            return answer()
+        return answer
+
+
+class Flaky(SimulatedSpectracom):
+    # simulator whose first answers are cut after limit bytes
+    def __init__(self, limit, failures=1, **kwargs):
+        super(Flaky, self).__init__(**kwargs)
+        self.limit = limit
+        self.failures = failures
+        self.sent = 0
+
+    def read_bytes(self, count):
+        if self.failures and self.sent + count > self.limit:
+            self.failures -= 1
+            self.sent = 0
+            raise TimeoutError('cut')
+        self.sent += count
+        return super(Flaky, self).read_bytes(count)
+
+    def clear(self):
+        self.sent = 0
+        super(Flaky, self).clear()
+
+
+def connect(instrument, **kwargs):
+    return Spectracom('USB0::0x14EB::0x0060::200448::INSTR', resource=instrument, **kwargs)
+
+
+class TestSpectracom(unittest.TestCase):
+
+    def test_batching(self):
+        instrument = Instrument()
+        spectracom = connect(instrument)
+        scenario = tools.read_scen('../data/scenariotest/test_2.ini')
+        spectracom.set_default(scenario, 1)
+        self.assertEqual(len(instrument.written), 1)
+        self.assertEqual(instrument.written[0].split(';:')[0:2], ['SOURce:SCENario:ACCeleration IMM, 0.000000',
+                                                                  'SOURce:SCENario:RATEHEading IMM, 0.000000'])
+        spectracom.set_default(scenario, 1)
+        self.assertEqual(len(instrument.written), 1)
+        # the motion state is always sent
+        spectracom.set_speed(0)
+        spectracom.set_speed(0)
+        self.assertEqual(instrument.written[1:], ['SOURce:SCENario:SPEed imm, 0.000000'] * 2)
+        del instrument.written[1:]
+        spectracom.set_acceleration(1.5)
+        spectracom.set_acceleration(1.5)
+        self.assertEqual(instrument.written[1:], ['SOURce:SCENario:ACCeleration IMM, 1.500000'])
+        # the settings are sent again after a reset
+        spectracom.reset()
+        spectracom.set_acceleration(1.5)
+        self.assertEqual(instrument.written[2:], ['*RST', 'SOURce:SCENario:ACCeleration IMM, 1.500000'])
+
+    def test_batching_failure(self):
+        instrument = Instrument()
+        write = instrument.write
+        failures = [IOError('timeout')]
+
+        def failing(message):
+            if failures:
+                raise failures.pop()
+            return write(message)
+
+        instrument.write = failing
+        spectracom = connect(instrument)
+        with self.assertRaises(IOError):
+            spectracom.set_acceleration(1.5)
+        spectracom.set_acceleration(1.5)
+        self.assertEqual(instrument.written, ['SOURce:SCENario:ACCeleration IMM, 1.500000'])
+        # a batch whose message fails
+        failures.append(IOError('timeout'))
+        with self.assertRaises(IOError):
+            with spectracom.batching():
+                spectracom.set_cno(40)
+                spectracom.set_cno(40)
+        spectracom.set_cno(40)
+        spectracom.set_acceleration(1.5)
+        self.assertEqual(instrument.written[1:], ['SOURce:NOISE:CNO 40.000000'])
+
+    def test_batching_length(self):
+        instrument = Instrument()
+        spectracom = connect(instrument, max_message=80)
+        with spectracom.batching():
+            spectracom.set_heading(10)
+            with spectracom.batching():
+                spectracom.set_speed(2)
+            spectracom.set_cno(40)
+            self.assertEqual(instrument.written, [])
+        self.assertEqual(instrument.written, ['SOURce:SCENario:HEADing imm, 10.000000;:SOURce:SCENario:SPEed imm, '
+                                              '2.000000', 'SOURce:NOISE:CNO 40.000000'])
+
+    def test_position(self):
+        log = '$GPRMC,000439.000,A,4733.1219,N,00216.7710,W,000.0,356.9,280510,,*14\r\n' \
+              '$GPGGA,000439.000,4733.1219,N,00216.7710,W,1,3,0.0,51.3,M,48.7,M,,*43\r\n' \
+              '$GPGGA,000440.000,4733.1200,S,00216.7800,E,1,3,0.0,52.0,M,48.7,M,,*43\r\n'
+        instrument = Instrument({'SOURce:SCENario:LOG?': [log, '$GPGGA,,,,,,0,00,99.99,,,,,,*48\r\n']})
+        spectracom = connect(instrument)
+        savefile = io.StringIO()
+        position = spectracom.position(savefile)
+        self.assertEqual(position.time, '000440.000')
+        self.assertAlmostEqual(position.lat, -(47 + 33.12 / 60))
+        self.assertAlmostEqual(position.long, 2 + 16.78 / 60)
+        self.assertEqual(position.alt, 52.0)
+        self.assertEqual(savefile.getvalue(), log)
+        self.assertIsNone(spectracom.position())
+        self.assertEqual(instrument.written, ['SOURce:SCENario:LOG?'] * 2)
+
+    def test_log_poller(self):
+        first = '$GPRMC,000439.000,A,4733.1219,N,00216.7710,W,000.0,356.9,280510,,*14\r\n' \
+                '$GPGSV,1,1,01,05,45,090,40*40\r\n'
+        second = '$GPGGA,000439.000,4733.1219,N,00216.7710,W,1,3,0.0,51.3,M,48.7,M,,*43\r\n'
+        third = '$GPRMC,000440.000,A,4733.1219,N,00216.7710,W,000.0,356.9,280510,,*1A\r\n' \
+                '$GPGSV,1,1,01,05,45,090,40*40\r\n'
+        instrument = Instrument({'SOURce:SCENario:LOG?': [first, first + second + '\r\n', third, third]})
+        spectracom = connect(instrument)
+        savefile = io.StringIO()
+        poller = LogPoller(spectracom, savefile, history=1)
+        for _ in range(4):
+            poller.poll()
+        # the GSV sentence is stored again with the next epoch
+        self.assertEqual(savefile.getvalue(), first + second + third)
+        stats = poller.stats()
+        self.assertEqual((stats['polls'], stats['epochs'], stats['duplicates']), (4, 2, 4))
+
+    def test_log_poller_untimed_first(self):
+        gsv = '$GPGSV,1,1,01,05,45,090,40*40\r\n'
+        first = gsv + '$GPRMC,000439.000,A,4733.1219,N,00216.7710,W,000.0,356.9,280510,,*14\r\n'
+        second = gsv + '$GPRMC,000440.000,A,4733.1219,N,00216.7710,W,000.0,356.9,280510,,*1A\r\n'
+        instrument = Instrument({'SOURce:SCENario:LOG?': [first, second, second]})
+        savefile = io.StringIO()
+        poller = LogPoller(connect(instrument), savefile)
+        for _ in range(3):
+            poller.poll()
+        # the GSV sentence starting an answer belongs to the epoch of the answer
+        self.assertEqual(savefile.getvalue(), first + second)
+        self.assertEqual((poller.epochs, poller.duplicates), (2, 2))
+
+    def test_log_poller_rate(self):
+        instrument = Instrument({'SOURce:SCENario:LOG?': ''})
+        spectracom = connect(instrument)
+        poller = LogPoller(spectracom, io.StringIO(), rate=50)
+        poller.run(0.2)
+        stats = poller.stats()
+        self.assertEqual(stats['polls'], 10)
+        self.assertLess(stats['max_lateness'], 0.02)
+        self.assertAlmostEqual(stats['poll_rate'], 50, delta=10)
+
+    def test_visa_worker(self):
+        instrument = Instrument({'SOURce:SCENario:LOG?': 'log', 'SOURce:SCENario:SPEed?': '2.0'})
+        started, release = threading.Event(), threading.Event()
+        query = instrument.query
+
+        def blocking(message):
+            answer = query(message)
+            started.set()
+            release.wait()
+            return answer
+
+        instrument.query = blocking
+        worker = VisaWorker(instrument)
+        log = worker.query('SOURce:SCENario:LOG?', LOGGING)
+        started.wait(1)
+        speed = worker.query('SOURce:SCENario:SPEed?', DIAGNOSTICS)
+        logs = [worker.query('SOURce:SCENario:LOG?', LOGGING) for _ in range(2)]
+        heading = worker.write('SOURce:SCENario:HEADing imm, 10.000000', CONTROL)
+        release.set()
+        self.assertEqual(speed.result(timeout=1), '2.0')
+        self.assertEqual(heading.result(timeout=1), len('SOURce:SCENario:HEADing imm, 10.000000') + 2)
+        self.assertEqual([future.result() for future in [log] + logs], ['log'] * 3)
+        # the command in progress is finished, then the control first and the diagnostics last
+        self.assertEqual(instrument.written, ['SOURce:SCENario:LOG?', 'SOURce:SCENario:HEADing imm, 10.000000',
+                                              'SOURce:SCENario:LOG?', 'SOURce:SCENario:LOG?',
+                                              'SOURce:SCENario:SPEed?'])
+        worker.close()
+        stats = worker.stats()
+        self.assertEqual([stats[name]['commands'] for name in ('control', 'logging', 'diagnostics')], [1, 3, 1])
+        self.assertGreater(stats['diagnostics']['max_wait'], stats['control']['max_wait'])
+        self.assertRaises(ValueError, worker.write, '*RST', 3)
+
+    def test_great_circle(self):
+        self.assertAlmostEqual(tools.bearing(47.0, 2.0, 48.0, 2.0), 0.0)
+        self.assertAlmostEqual(tools.bearing(0.0, 2.0, 0.0, 1.0), 270.0)
+        self.assertAlmostEqual(tools.bearing(60.0, 0.0, 60.0, 10.0), 85.667, places=3)
+        self.assertAlmostEqual(tools.haversine(47.0, 2.0, 48.0, 2.0), 111195.08, places=1)
+        self.assertAlmostEqual(tools.haversine(0.0, 0.0, 0.0, 180.0), 3.14159265 * tools.EARTH_RADIUS, places=0)
+
+    def test_waypoint(self):
+        gga = '$GPGGA,000439.000,%s,N,00200.0000,E,1,3,0.0,51.3,M,48.7,M,,*43\r\n'
+        for arrival in ('4700.0600', '4700.1200'):
+            answers = [gga % '4700.0000']
+            instrument = Instrument({'SOURce:SCENario:LOG?': lambda: answers.pop(0) if len(answers) > 1 else answers[0],
+                                     'SOURce:SCENario:SPEed?': '1000.000000'})
+            spectracom = connect(instrument)
+            poller = LogPoller(spectracom, io.StringIO(), rate=100)
+            planner = WaypointPlanner(spectracom, poller)
+            answers.append(gga % arrival)
+            position = planner.steer(47.001, 2.0)
+            # reached at the predicted arrival, or passed
+            self.assertAlmostEqual(position.lat, 47.001 if arrival == '4700.0600' else 47.002)
+            commands = [message for message in instrument.written if message != 'SOURce:SCENario:LOG?']
+            self.assertEqual(commands, ['SOURce:SCENario:SPEed?', 'SOURce:SCENario:HEADing imm, 0.000000'])
+            self.assertEqual(planner.commands, 1)
+            # about 11 log epochs of 10 ms before the predicted arrival
+            self.assertLess(instrument.written.count('SOURce:SCENario:LOG?'), 20)
+            self.assertRaises(ValueError, planner.steer, 47.001, 2.0, 0.0)
+        # a log without position
+        spectracom = connect(Instrument({'SOURce:SCENario:LOG?': ''}))
+        planner = WaypointPlanner(spectracom, LogPoller(spectracom, io.StringIO(), rate=100), patience=3)
+        self.assertRaises(ValueError, planner.steer, 47.001, 2.0, 10.0)
+
+    def test_simulator(self):
+        now = [0.0]
+        simulator = SimulatedSpectracom(47.0, 2.0, 50.0, rate=1, clock=lambda: now[0])
+        spectracom = connect(simulator)
+        self.assertEqual(spectracom.ask('SOURce:SCENario:LOG?'), '')
+        spectracom.set_datetime('01-01-2001', '15:01:00.0')
+        with spectracom.batching():
+            spectracom.set_heading(90)
+            spectracom.set_speed(10)
+            spectracom.set_cno(40)
+        spectracom.control('start')
+        now[0] = 100.5
+        log = spectracom.ask('SOURce:SCENario:LOG?')
+        position = tools.gga_position(log)
+        self.assertEqual(position.time, '150240.000')
+        self.assertAlmostEqual(tools.haversine(47.0, 2.0, position.lat, position.long), 1000, delta=0.5)
+        self.assertAlmostEqual(position.alt, 50.0)
+        lines = log.splitlines()
+        self.assertEqual([line[3:6] for line in lines], ['GGA', 'RMC', 'GSV', 'GSV'])
+        self.assertEqual(lines[2][-5:-3], '40')
+        # same epoch, same sentences
+        now[0] = 100.9
+        self.assertEqual(spectracom.ask('SOURce:SCENario:LOG?'), log)
+        spectracom.set_acceleration(-1)
+        now[0] = 200
+        self.assertEqual(spectracom.ask('SOURce:SCENario:SPEed?'), '0.000000')
+        lat, long, alt = (float(value) for value in spectracom.ask('SOURce:SCENario:POSition?').split(','))
+        self.assertAlmostEqual(tools.haversine(47.0, 2.0, lat, long), 1059, delta=0.5)
+        self.assertEqual(spectracom.ask('SOURce:NOISE:CNO?'), '40.000000')
+        self.assertEqual((simulator.written, simulator.queried), (4, 6))
+
+    def test_simulator_waypoint(self):
+        simulator = SimulatedSpectracom(47.0, 2.0, 50.0, rate=20)
+        spectracom = connect(simulator)
+        spectracom.control('start')
+        spectracom.set_speed(1000)
+        planner = WaypointPlanner(spectracom, LogPoller(spectracom, io.StringIO(), rate=20))
+        position = planner.steer(47.0045, 2.003)
+        self.assertLess(tools.haversine(position.lat, position.long, 47.0045, 2.003), 60)
+        self.assertEqual(planner.commands, 1)
+
+    def test_simulator_server(self):
+        server = SimulatorServer(SimulatedSpectracom(47.0, 2.0, 50.0)).start()
+        try:
+            self.assertTrue(server.address.startswith('TCPIP::127.0.0.1::'))
+            with socket.create_connection(server.server_address[:2], timeout=2) as client:
+                client.sendall(b'SOURce:SCENario:SPEed imm, 3.5;:SOURce:SCENario:CONTrol start\n'
+                               b'SOURce:SCENario:SPEed?\n')
+                answer = b''
+                while not answer.endswith(b'\x04'):
+                    answer += client.recv(1024)
+                self.assertEqual(answer, b'3.500000\x04')
+                client.sendall(b'SOURce:SCENario:LOG?\n')
+                answer = b''
+                while not answer.endswith(b'\x04'):
+                    answer += client.recv(1024)
+                self.assertIsNotNone(tools.gga_position(answer[:-1].decode()))
+        finally:
+            server.stop()
+
+    def test_simulator_server_upload(self):
+        simulator = SimulatedSpectracom(47.0, 2.0, 50.0)
+        server = SimulatorServer(simulator).start()
+        try:
+            content = '$GPGGA,1\r\n$GPRMC,2\r\n'
+            with socket.create_connection(server.server_address[:2], timeout=2) as client:
+                client.sendall(('MMEMory:DATA "test.nmea",%s\n' % transfer.block(content)).encode() +
+                               b'SOURce:SCENario:SPEed?\n')
+                answer = b''
+                while not answer.endswith(b'\x04'):
+                    answer += client.recv(1024)
+                self.assertEqual(answer, b'0.000000\x04')
+            self.assertEqual(simulator.files['test.nmea'], content)
+            self.assertEqual(simulator.settings, {})
+        finally:
+            server.stop()
+
+    def test_snapshot(self):
+        simulator = SimulatedSpectracom(47.0, 2.0, 50.0)
+        spectracom = connect(simulator, max_message=200)
+        spectracom.set_speed(2.5)
+        spectracom.set_propa('Rural', 0.0, 0.0, 0.0)
+        state = spectracom.snapshot()
+        self.assertEqual(len(state), len(Spectracom.STATE))
+        self.assertEqual(state['position'], (47.0, 2.0, 50.0))
+        self.assertEqual(state['speed'], 2.5)
+        self.assertEqual(state['propagation_model'], 'Rural,0.000000,0.000000,0.000000')
+        # the 24 queries in compound messages of at most 200 characters
+        self.assertEqual(simulator.queried, 4)
+        self.assertEqual(spectracom.snapshot(['heading', 'speed']), {'heading': 0.0, 'speed': 2.5})
+        # an instrument answering only the first query of a compound message
+        instrument = Instrument({'SOURce:SCENario:HEADing?;:SOURce:SCENario:SPEed?': '1.0',
+                                 'SOURce:SCENario:HEADing?': '1.0', 'SOURce:SCENario:SPEed?': '3.0'})
+        self.assertEqual(connect(instrument).snapshot(['heading', 'speed']), {'heading': 1.0, 'speed': 3.0})
+
+    def test_record(self):
+        spectracom = connect(SimulatedSpectracom(47.0, 2.0, 50.0), statefile='testfile_state.jsonl')
+        try:
+            spectracom.record(1)
+            spectracom.record(2)
+            with open('testfile_state.jsonl') as file:
+                lines = [json.loads(line) for line in file]
+        finally:
+            os.remove('testfile_state.jsonl')
+        self.assertEqual([line['section'] for line in lines], [1, 2])
+        self.assertEqual(lines[1]['position'], [47.0, 2.0, 50.0])
+        self.assertEqual(spectracom.snapshots[0]['position'], (47.0, 2.0, 50.0))
+        # the snapshots are only written to a file when one is given
+        spectracom = connect(SimulatedSpectracom(47.0, 2.0, 50.0))
+        self.assertIsNone(spectracom.statefile)
+        spectracom.record(1)
+        self.assertEqual(len(spectracom.snapshots), 1)
+
+    def test_almanac(self):
+        text = positioningTest.yuma(positioningTest.constellation(8))
+        simulator = SimulatedSpectracom(61.4498, 23.8570, 120.0, files={'alm_gps.txt': text})
+        spectracom = connect(simulator, almanach='testfile_almanach.txt')
+        spectracom.set_datetime('01-01-2001', '15:01:00.0')
+        try:
+            almanac = spectracom.get_almanach()
+            self.assertIs(spectracom.get_almanach(), almanac)
+            self.assertEqual(simulator.written, 3)
+            # saved for the next runs of the same week
+            self.assertEqual(connect(simulator, almanach='testfile_almanach.txt').get_almanach(1095).tolist(),
+                             almanac.tolist())
+            self.assertEqual(simulator.written, 3)
+        finally:
+            os.remove('testfile_almanach.txt')
+            os.remove('testfile_almanach_1095.npy')
+        self.assertEqual(almanac['svid'].tolist(), list(range(1, 9)))
+        az, elev, count, gdop = spectracom.visibility(([302400, 302460], 61.4498, 23.8570, 120.0))
+        self.assertEqual(elev.shape, (2, 8))
+
+    def test_play(self):
+        now = [0.0]
+        simulator = SimulatedSpectracom(clock=lambda: now[0])
+        spectracom = connect(simulator)
+        scenario = tools.read_scen('../data/scenariotest/test_2.ini')
+        self.assertRaises(ValueError, spectracom.play, scenario)
+        spectracom.set_datetime('12-31-2001', '23:59:30.0')
+        truth = spectracom.play(scenario)
+        self.assertEqual(simulator.files['gnsstools.scen'],
+                         '[scenario]\nstart=12-31-2001 23:59:30.0\ntrajectory=gnsstools.nmea\n')
+        self.assertEqual(simulator.files['gnsstools.nmea'].count('GPGGA'), len(truth))
+        self.assertEqual(simulator.settings['MMEMORY:CDIRECTORY'], 'scenarios')
+        # the generator follows the trajectory alone, across midnight
+        for epoch in (0, 45, 60, 61, 200):
+            now[0] = epoch + 0.5
+            position = tools.gga_position(spectracom.ask('SOURce:SCENario:LOG?'))
+            self.assertLess(tools.haversine(position.lat, position.long, truth['lat'][epoch], truth['long'][epoch]),
+                            0.5)
+        self.assertEqual(position.time, '000250.000')
+        self.assertEqual(simulator.written, 6)
+
+    def test_download(self):
+        content = ''.join('%08d observation\n' % i for i in range(2000))
+        simulator = Flaky(10000, files={'latest.obs': content})
+        spectracom = connect(simulator, latest='testfile_latest.obs')
+        progress = []
+        try:
+            self.assertEqual(spectracom.download('latest.obs', 'testfile_latest.obs', chunk_size=4096,
+                                                 progress=lambda done, size: progress.append((done, size))),
+                             len(content))
+            with open('testfile_latest.obs') as file:
+                self.assertEqual(file.read(), content)
+            self.assertFalse(os.path.exists('testfile_latest.obs.part'))
+            # the first transfer is cut, the second one keeps the chunks already written
+            self.assertEqual(progress[0], (4096, len(content)))
+            self.assertEqual(progress[-1], (len(content), len(content)))
+            self.assertEqual([done for done, _ in progress].count(4096), 2)
+            # a part of another file is written again
+            with open('testfile_latest.obs.part', 'w') as file:
+                file.write('x' * 5000)
+            simulator.failures = 0
+            self.assertEqual(spectracom.get_latest(), len(content))
+            with open('testfile_latest.obs') as file:
+                self.assertEqual(file.read(), content)
+            # too many failures
+            simulator.failures, simulator.limit = 3, 100
+            self.assertRaises(TimeoutError, spectracom.download, 'latest.obs', 'testfile_latest.obs', retries=2)
+        finally:
+            for name in ('testfile_latest.obs', 'testfile_latest.obs.part'):
+                if os.path.exists(name):
+                    os.remove(name)
+        self.assertEqual(simulator.settings['MMEMORY:CDIRECTORY'], 'observations')
+        instrument = Instrument()
+        instrument.read_bytes = lambda count: b'12'
+        self.assertRaises(ValueError, transfer.read_block, instrument, 'testfile_block.txt')
+        # an answer ending with a two bytes termination
+        answer = io.BytesIO((transfer.block('a\nb') + '\r\nnext').encode())
+        instrument.read_bytes, instrument.read_termination = answer.read, '\r\n'
+        try:
+            self.assertEqual(transfer.read_block(instrument, 'testfile_block.txt'), 3)
+            with open('testfile_block.txt') as file:
+                self.assertEqual(file.read(), 'a\nb')
+        finally:
+            os.remove('testfile_block.txt')
+        self.assertEqual(answer.read(), b'next')
@@ -0,0 +1,85 @@
+# Tampere University of Technology
+#
+# DESCRIPTION
+# Test the reference trajectories computed from the scenarios
+#
+# AUTHOR
+# Anne-Marie Tobie
+
+import datetime
+import unittest
+import numpy as np
+from GNSSTools import tools
+from GNSSTools import trajectory
+
+
+class TestTrajectory(unittest.TestCase):
+
+    def test_static(self):
+        truth = trajectory.reference(tools.read_scen('../data/scenariotest/test_1.ini'))
+        self.assertEqual(len(truth), 61)
+        np.testing.assert_allclose(truth['lat'], 48.856699, rtol=1e-12)
+        np.testing.assert_allclose(truth['long'], 2.3508, rtol=1e-12)
+        self.assertTrue((truth['speed'] == 0).all())
+
+    def test_square(self):
+        truth = trajectory.reference(tools.read_scen('../data/scenariotest/test_2.ini'), rate=2)
+        self.assertEqual(len(truth), 481)
+        self.assertEqual(truth['time'][-1], 240.0)
+        self.assertEqual(truth['section'][[0, 119, 120, 479]].tolist(), [1, 1, 2, 4])
+        # 600 m south, the corner being reached at the end of the first section
+        corner = trajectory.interpolate(truth, [60.0])[0]
+        self.assertAlmostEqual(tools.haversine(48.856699, 2.3508, corner['lat'], corner['long']), 600, delta=0.01)
+        self.assertAlmostEqual(tools.bearing(48.856699, 2.3508, corner['lat'], corner['long']), 180, places=6)
+        # back to the start
+        self.assertLess(tools.haversine(48.856699, 2.3508, truth['lat'][-1], truth['long'][-1]), 0.1)
+
+    def test_circle(self):
+        truth = trajectory.reference(tools.read_scen('../data/scenariotest/test_3.ini'), rate=10)
+        # 3 degrees/s during 120 s, a full circle of 10 * 120 m
+        distances = [tools.haversine(47.552031, -2.279517, lat, long) for lat, long in truth[['lat', 'long']]]
+        self.assertLess(distances[-1], 0.1)
+        self.assertAlmostEqual(max(distances), 2 * 1200 / (2 * np.pi), delta=0.05)
+        np.testing.assert_allclose(truth['heading'][:1200], (3 * truth['time'][:1200]) % 360, atol=1e-9)
+
+    def test_acceleration(self):
+        truth = trajectory.reference(tools.read_scen('../data/scenariotest/test_4.ini'))
+        np.testing.assert_allclose(truth['speed'][:120], 5 * truth['time'][:120])
+        self.assertAlmostEqual(tools.haversine(60.0, 30.0, truth['lat'][60], truth['long'][60]), 2.5 * 60 ** 2,
+                               delta=0.5)
+        # linear between the records
+        middle = trajectory.interpolate(truth, [60.5])[0]
+        self.assertAlmostEqual(middle['speed'], 302.5)
+        # the speed is reset at the end of the section
+        self.assertEqual(truth['speed'][-1], 0.0)
+        self.assertAlmostEqual(tools.haversine(60.0, 30.0, truth['lat'][-1], truth['long'][-1]), 36000, delta=1)
+
+    def test_waypoint(self):
+        scenario = tools.read_scen('../data/scenariotest/test_2.ini')
+        scenario[2][0:4] = ['48.85', '2.3508', '20.0', '']
+        truth = trajectory.reference(scenario)
+        # the 145 m left to the waypoint at 10 m/s
+        section = truth[truth['section'] == 2]
+        self.assertEqual((section['time'][0], section['time'][-1]), (60, 74))
+        self.assertAlmostEqual(section['heading'][0], 180)
+        # within a step of the arrival at the turn back north
+        arrival = 60 + (tools.haversine(48.856699, 2.3508, 48.85, 2.3508) - 600) / 10
+        reached = trajectory.interpolate(trajectory.reference(scenario, rate=10), [arrival])
+        self.assertLess(tools.haversine(reached['lat'][0], reached['long'][0], 48.85, 2.3508), 1)
+        scenario[2][5] = ''
+        scenario[1][5] = ''
+        self.assertRaises(ValueError, trajectory.reference, scenario)
+
+    def test_nmea(self):
+        truth = trajectory.reference(tools.read_scen('../data/scenariotest/test_3.ini'))
+        text = trajectory.nmea(truth, datetime.datetime(2001, 1, 1, 15, 1))
+        lines = text.splitlines()
+        self.assertEqual(len(lines), 2 * len(truth))
+        self.assertEqual(lines[3][0:17], '$GPRMC,150101.000')
+        position = tools.gga_position(lines[2])
+        self.assertLess(tools.haversine(position.lat, position.long, truth['lat'][1], truth['long'][1]), 0.2)
+        self.assertEqual(float(lines[3].split(',')[8]), 3.0)
+
+
+if __name__ == '__main__':
+    unittest.main()